@@ -111,6 +111,14 @@ LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/'
 
 WSGI_APPLICATION = "lfms.wsgi.application"
+# The Procfile serves the whole web tier from lfms.asgi on uvicorn workers,
+# so the workload_events stream can hold connections open without tying up
+# a worker each. The synchronous views and the ORM still run as before, but
+# Django hands each sync request to a thread through sync_to_async, which
+# costs a thread switch per request and caps concurrency at the thread
+# pool. lfms.wsgi is kept for running the site without the event stream,
+# where the dashboards fall back to polling.
+ASGI_APPLICATION = "lfms.asgi.application"
 
 # API Configuration
 API_URL = os.getenv('API_URL', config(
@@ -123,6 +131,10 @@ X_SUBDOMAIN = os.getenv('X_SUBDOMAIN', config(
     'X_SUBDOMAIN', default='your_subdomain'))
 X_AUTH_TOKEN = os.getenv('X_AUTH_TOKEN', config(
     'X_AUTH_TOKEN', default='your_auth_token'))
+# Shared secret the Current RMS webhook requests are signed with, webhooks
+# are refused until it is set
+CURRENT_RMS_WEBHOOK_SECRET = os.getenv('CURRENT_RMS_WEBHOOK_SECRET', config(
+    'CURRENT_RMS_WEBHOOK_SECRET', default=''))
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -175,7 +187,14 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "lfms.storage.StaticFilesStorage",
+    },
+}
 
 # Email configurations
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -198,6 +217,109 @@ CELERY_IGNORE_RESULT = False
 CELERY_TASK_IGNORE_RESULT = False
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
+# Options for every direct Redis connection, the cache and the dashboard
+# events, which skip certificate checks when Redis is reached over SSL
+REDIS_SSL_OPTIONS = (
+    {'ssl_cert_reqs': None}
+    if os.getenv('USE_CELERY_SSL', 'False').lower() == 'true'
+    else {}
+)
+
+# Cache
+# Redis (the Celery broker) when configured, otherwise per-process memory
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+            'OPTIONS': REDIS_SSL_OPTIONS,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds a cached api_workload response is served before a background
+# refresh is queued, and before it is dropped altogether
+WORKLOAD_CACHE_TTL = int(os.getenv('WORKLOAD_CACHE_TTL', 300))
+WORKLOAD_CACHE_MAX_AGE = int(os.getenv('WORKLOAD_CACHE_MAX_AGE', 3600))
+# The days api_workload may be asked for. Each is cached and refreshed from
+# the API separately, so other values are refused
+WORKLOAD_SUMMARY_DAYS = tuple(
+    int(days) for days in os.getenv('WORKLOAD_SUMMARY_DAYS', '7,14,28').split(','))
+
+# Dashboard events: change notifications are published over Redis pub/sub
+# and streamed to the open dashboards, see workload/events.py. Without a
+# Redis URL nothing is published and the dashboards fall back to polling.
+# A keep-alive comment is sent every WORKLOAD_EVENTS_HEARTBEAT_SECONDS, under
+# the router's 55 second idle timeout, and browsers wait
+# WORKLOAD_EVENTS_RETRY_MS before reconnecting a dropped stream.
+WORKLOAD_EVENTS_REDIS_URL = os.getenv('WORKLOAD_EVENTS_REDIS_URL', os.environ.get('REDIS_URL'))
+WORKLOAD_EVENTS_HEARTBEAT_SECONDS = int(os.getenv('WORKLOAD_EVENTS_HEARTBEAT_SECONDS', 25))
+WORKLOAD_EVENTS_RETRY_MS = int(os.getenv('WORKLOAD_EVENTS_RETRY_MS', 5000))
+
+# Logging: the workload app logs at WORKLOAD_LOG_LEVEL, INFO by default so
+# the per-row sync detail logged at DEBUG is never formatted in production
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '%(levelname)s %(asctime)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+    },
+    'loggers': {
+        'workload': {
+            'handlers': ['console'],
+            'level': os.getenv('WORKLOAD_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Workload sync configuration
+# Rows per bulk_create / bulk_update chunk in the workshop workload sync
+SYNC_BATCH_SIZE = int(os.getenv('SYNC_BATCH_SIZE', 500))
+# How often the incremental sync runs the sweep that catches
+# opportunities entering or leaving the window without being edited
+SYNC_SWEEP_INTERVAL_MINUTES = int(os.getenv('SYNC_SWEEP_INTERVAL_MINUTES', 360))
+# Opportunities per shard task when the sync is fanned out across workers
+SYNC_SHARD_SIZE = int(os.getenv('SYNC_SHARD_SIZE', 200))
+# Seconds the single-flight sync lock is held without a heartbeat renewing
+# it, so a run on a worker that died stops blocking the next one
+SYNC_LOCK_LEASE_SECONDS = int(os.getenv('SYNC_LOCK_LEASE_SECONDS', 300))
+# The Redis the sync lock and its follow-up requests are kept in. Without
+# it the lock falls back to the per-process cache and only keeps syncs in
+# one process from overlapping, see workload/sync_lock.py
+SYNC_LOCK_REDIS_URL = os.getenv('SYNC_LOCK_REDIS_URL', os.environ.get('REDIS_URL'))
+# Webhook resyncs: how old a signed request may be, and how long events for
+# the same opportunity are gathered into one resync
+WEBHOOK_SIGNATURE_TOLERANCE_SECONDS = int(os.getenv('WEBHOOK_SIGNATURE_TOLERANCE_SECONDS', 300))
+WEBHOOK_DEBOUNCE_SECONDS = int(os.getenv('WEBHOOK_DEBOUNCE_SECONDS', 10))
+# Concurrent opportunity item fetches, and the cap on requests per second
+# sent to the Current RMS host (0 disables the cap)
+ITEM_FETCH_WORKERS = int(os.getenv('ITEM_FETCH_WORKERS', 4))
+CURRENT_RMS_RATE_LIMIT = float(os.getenv('CURRENT_RMS_RATE_LIMIT', 5))
+# Concurrent page fetches per paginated listing once the first page gives
+# the row count, and the connections kept open to the Current RMS host
+PAGE_FETCH_WORKERS = int(os.getenv('PAGE_FETCH_WORKERS', 4))
+CURRENT_RMS_POOL_SIZE = int(os.getenv('CURRENT_RMS_POOL_SIZE', 16))
+# Current RMS client timeouts (seconds) and retry policy for 429/5xx
+CURRENT_RMS_CONNECT_TIMEOUT = float(os.getenv('CURRENT_RMS_CONNECT_TIMEOUT', 5))
+CURRENT_RMS_READ_TIMEOUT = float(os.getenv('CURRENT_RMS_READ_TIMEOUT', 30))
+CURRENT_RMS_MAX_RETRIES = int(os.getenv('CURRENT_RMS_MAX_RETRIES', 3))
+CURRENT_RMS_BACKOFF_FACTOR = float(os.getenv('CURRENT_RMS_BACKOFF_FACTOR', 0.5))
+CURRENT_RMS_MAX_RETRY_AFTER = float(os.getenv('CURRENT_RMS_MAX_RETRY_AFTER', 30))
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
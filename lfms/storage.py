@@ -0,0 +1,12 @@
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """
+    Whitenoise's compressed, hashed static files, with the paths in
+    JavaScript module imports rewritten to the hashed names too, so a
+    module such as workload/js/events.js is cached along with the scripts
+    that import it
+    """
+
+    support_js_module_import_aggregation = True
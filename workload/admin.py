@@ -1,9 +1,10 @@
 from django.contrib import admin
 from django.db.models import Sum
+from django.utils.html import format_html, format_html_join
 from .models import (
     Opportunity, Tag, ScenicCalcItems, ScenicCalcItem,
     ScenicCalcTotal, CustomInput, Carpenters, Carpenter,
-    ActiveProducts, Owner, Client, Venue
+    ActiveProducts, Owner, Client, Venue, SyncRun
 )
 
 
@@ -56,3 +57,66 @@ admin.site.register(Owner)
 admin.site.register(Client)
 admin.site.register(Venue)
 admin.site.register(ScenicCalcTotal)
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ("started_at", "mode", "status", "duration", "opportunities_processed", "shards",
+                    "http_calls", "http_bytes", "query_count")
+    list_filter = ("mode", "status")
+    readonly_fields = ("mode", "status", "days", "watermark", "swept", "opportunities_processed", "shards",
+                       "started_at", "finished_at", "duration", "phase_timings", "row_counts",
+                       "http_and_queries")
+    exclude = ("metrics",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def http_calls(self, obj):
+        return obj.metrics.get("http", {}).get("calls", 0)
+
+    def http_bytes(self, obj):
+        return obj.metrics.get("http", {}).get("bytes", 0)
+
+    def query_count(self, obj):
+        return obj.metrics.get("query_count", 0)
+
+    def phase_timings(self, obj):
+        return metrics_table(
+            ("Phase", "Seconds"), obj.metrics.get("phases", {}).items())
+
+    def row_counts(self, obj):
+        rows = obj.metrics.get("rows", {})
+        outcomes = sorted({outcome for counts in rows.values() for outcome in counts})
+        return metrics_table(
+            ("Model", *outcomes),
+            ((name, *(counts.get(outcome, 0) for outcome in outcomes)) for name, counts in rows.items()))
+
+    def http_and_queries(self, obj):
+        http = obj.metrics.get("http", {})
+        return metrics_table(
+            ("Counter", "Value"),
+            [
+                *((f"HTTP {name}", value) for name, value in http.items()),
+                ("Query seconds", obj.metrics.get("query_seconds", 0)),
+                *((f"Queries on {name}", count) for name, count in obj.metrics.get("queries", {}).items()),
+            ])
+
+    http_calls.short_description = "HTTP calls"
+    http_bytes.short_description = "HTTP bytes"
+    query_count.short_description = "Queries"
+    phase_timings.short_description = "Phase timings"
+    row_counts.short_description = "Rows"
+    http_and_queries.short_description = "HTTP and queries"
+
+
+def metrics_table(header, rows):
+    """Render SyncRun metrics as a small HTML table for the admin"""
+    return format_html(
+        "<table><thead><tr>{}</tr></thead><tbody>{}</tbody></table>",
+        format_html_join("", "<th>{}</th>", ((column,) for column in header)),
+        format_html_join("", "<tr>{}</tr>", (
+            (format_html_join("", "<td>{}</td>", ((value,) for value in row)),)
+            for row in rows
+        )),
+    )
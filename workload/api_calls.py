@@ -1,118 +1,392 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+import logging
+import math
+import threading
+import time
 import requests
 
+from .sync_stats import record_http, submit_in_context
 
-def get_opportunities(
-        page=1, per_page=25, state_eq=2, status_eq=1, owner_name_eq=None):
+logger = logging.getLogger(__name__)
+
+
+class CappedRetry(Retry):
     """
-    Get opportunities from the API with pagination
+    A urllib3 Retry that honours Retry-After but never sleeps for longer
+    than max_retry_after, so a slow upstream cannot hold a worker past its
+    time limit.
     """
-    # API configurations
-    url = settings.API_URL
-    subdomain = settings.X_SUBDOMAIN
-    auth_token = settings.X_AUTH_TOKEN
 
-    payload = {}
+    def __init__(self, *args, max_retry_after=30, **kwargs):
+        self.max_retry_after = max_retry_after
+        super().__init__(*args, **kwargs)
 
-    # API headers
-    headers = {
-        'X-SUBDOMAIN': subdomain,
-        'X-AUTH-TOKEN': auth_token,
-    }
+    def new(self, **kw):
+        kw.setdefault("max_retry_after", self.max_retry_after)
+        return super().new(**kw)
 
-    opportunities = []
-
-    while True:
-        # API parameters
-        params = {
-            'page': page,
-            'per_page': per_page,
-            'q[state_eq]': state_eq,
-            'q[status_eq]': status_eq,
-            'q[s][]': 'starts_at asc',
-        }
-
-        # Add optional parameter if provided
-        if owner_name_eq is not None:
-            params['q[owner_name_eq]'] = owner_name_eq
-
-        response = requests.request(
-            "GET", url, params=params, headers=headers, data=payload)
-
-        if response.status_code == 200:
-            data = response.json()
-            print(f'Fetched page {page} of \
-{data["meta"]["total_row_count"]} opportunities')
-
-            # Add current page data to opportunities list
-            opportunities.extend(data["opportunities"])
-
-            # Check if there are more pages to fetch
-            if data["meta"]["total_row_count"] > data[
-                    "meta"]["per_page"] * data["meta"]["page"]:
-                # Increment page number
-                page += 1
-            else:
-                # Break the loop if all data is fetched
-                break
-        else:
-            print(f'Error: {response.status_code}')
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
             return None
+        return min(retry_after, self.max_retry_after)
+
+
+class CurrentRMSClient:
+    """
+    A shared client for the Current RMS API.
+
+    Keeps one requests.Session with keep-alive connection pooling and the
+    auth headers set once, applies a default timeout to every call and
+    retries 429/5xx responses with exponential backoff.
+    """
+
+    def __init__(
+            self,
+            subdomain=None,
+            auth_token=None,
+            timeout=None,
+            max_retries=None,
+            backoff_factor=None,
+            max_retry_after=None,
+            pool_size=None):
+        self.timeout = timeout or (
+            settings.CURRENT_RMS_CONNECT_TIMEOUT,
+            settings.CURRENT_RMS_READ_TIMEOUT,
+        )
+
+        retry = CappedRetry(
+            total=settings.CURRENT_RMS_MAX_RETRIES if max_retries is None else max_retries,
+            backoff_factor=settings.CURRENT_RMS_BACKOFF_FACTOR if backoff_factor is None else backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            max_retry_after=settings.CURRENT_RMS_MAX_RETRY_AFTER if max_retry_after is None else max_retry_after,
+        )
+        pool_size = pool_size or settings.CURRENT_RMS_POOL_SIZE
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'X-SUBDOMAIN': subdomain or settings.X_SUBDOMAIN,
+            'X-AUTH-TOKEN': auth_token or settings.X_AUTH_TOKEN,
+        })
+
+    def get(self, url, params=None, timeout=None):
+        """
+        Send a GET request, returning the response or None if the request
+        failed outright after its retries
+        """
+        try:
+            response = self.session.get(
+                url, params=params, timeout=timeout or self.timeout)
+        except requests.RequestException as e:
+            logger.warning("Request to %s failed: %s", url, e)
+            record_http(0, failed=True)
+            return None
+
+        record_http(len(response.content), failed=not response.ok)
+        return response
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Get the shared Current RMS client, creating it on first use so that
+    each worker process builds its own connection pool
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = CurrentRMSClient()
+    return _client
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that at most `rate` per second are made,
+    shared across every thread that uses the same limiter.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        """Block until the caller's slot comes round"""
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url):
+    """
+    Get the shared rate limiter for the host of the given url, spacing
+    calls at settings.CURRENT_RMS_RATE_LIMIT.
+
+    Every caller shares the one limiter per host, so the cap holds however
+    many tasks and threads are calling. It is only replaced when the
+    setting itself changes.
+    """
+    host = urlparse(url).netloc
+    rate = settings.CURRENT_RMS_RATE_LIMIT
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None or limiter.rate != rate:
+            limiter = RateLimiter(rate)
+            _rate_limiters[host] = limiter
+    return limiter
+
+
+class PageCursor:
+    """
+    The position of a page walk: the next page to be handed to the caller
+    and, once the first page is in, the total number of rows.
+
+    A walk that fails can be resumed by passing the same cursor back in,
+    which starts again from the page that could not be fetched.
+    """
+
+    def __init__(self, page=1):
+        self.page = page
+        self.total_row_count = None
+        self.done = False
+
+    def __repr__(self):
+        return f'PageCursor(page={self.page}, total_row_count={self.total_row_count})'
+
+
+class PageFetchError(Exception):
+    """Raised when a page of a listing cannot be fetched, carrying the cursor to resume from"""
+
+    def __init__(self, url, cursor):
+        self.url = url
+        self.cursor = cursor
+        super().__init__(f'Failed to fetch page {cursor.page} of {url}')
+
+
+def fetch_page(client, limiter, url, params, page, label):
+    """
+    Fetch one page of a listing, returning the decoded response or None if
+    it could not be fetched
+    """
+    limiter.wait()
+    response = client.get(url, params={**params, 'page': page})
+
+    if response is None:
+        return None
+    if response.status_code != 200:
+        logger.warning("Failed to fetch page %s of %s: HTTP %s", page, label, response.status_code)
+        return None
+
+    data = response.json()
+    logger.debug("Fetched page %s of %s %s", page, data["meta"]["total_row_count"], label)
+    return data
+
+
+def iter_pages(url, params, record_key, label, cursor=None, max_workers=None):
+    """
+    Yield the records of a paginated listing one page at a time.
+
+    The first page is fetched on its own to learn total_row_count. After
+    that up to max_workers of the following pages are fetched ahead
+    concurrently, paced by the host's shared rate limiter, so only a
+    bounded window of pages is ever held in memory and they are still
+    yielded in page order.
+
+    Parameters:
+    - url: The listing endpoint
+    - params: The query parameters, without the page number
+    - record_key: The key of the records in each page of the response
+    - label: The name of the records used in the progress output
+    - cursor: A PageCursor to start or resume from, advanced as each page
+    is consumed
+    - max_workers: The number of pages fetched ahead, defaults to
+    settings.PAGE_FETCH_WORKERS
+
+    Raises:
+    - PageFetchError if a page cannot be fetched, with the cursor left on
+    that page
+    """
+    if cursor is None:
+        cursor = PageCursor()
+    if max_workers is None:
+        max_workers = settings.PAGE_FETCH_WORKERS
+
+    client = get_client()
+    limiter = get_rate_limiter(url)
+
+    data = fetch_page(client, limiter, url, params, cursor.page, label)
+    if data is None:
+        raise PageFetchError(url, cursor)
+
+    meta = data["meta"]
+    cursor.total_row_count = meta["total_row_count"]
+    last_page = math.ceil(meta["total_row_count"] / meta["per_page"])
+    next_page = cursor.page + 1
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    pending = deque()
+    try:
+        while True:
+            while next_page <= last_page and len(pending) < max(1, max_workers):
+                pending.append(submit_in_context(
+                    executor, fetch_page, client, limiter, url, params, next_page, label))
+                next_page += 1
+
+            yield data[record_key]
+            cursor.page += 1
+
+            if not pending:
+                break
+            data = pending.popleft().result()
+            if data is None:
+                raise PageFetchError(url, cursor)
+    finally:
+        # Pages fetched ahead are dropped if the caller stops early
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    return opportunities
+    cursor.done = True
+
+
+def iter_records(url, params, record_key, label, cursor=None):
+    """Yield the records of a paginated listing one at a time, see iter_pages"""
+    for records in iter_pages(url, params, record_key, label, cursor=cursor):
+        yield from records
+
+
+def collect_records(records):
+    """
+    Gather a record iterator into a list, or None if any page could not be
+    fetched
+    """
+    try:
+        return list(records)
+    except PageFetchError as e:
+        logger.warning("Giving up on the listing: %s", e)
+        return None
+
+
+def opportunity_params(
+        per_page=25, state_eq=2, status_eq=1, owner_name_eq=None,
+        updated_at_gt=None, starts_at_gteq=None, starts_at_lteq=None):
+    """
+    Build the opportunity listing query parameters. The starts_at bounds
+    are datetimes sent as ransack predicates so the API only returns
+    opportunities starting within them.
+    """
+    params = {
+        'per_page': per_page,
+        'q[state_eq]': state_eq,
+        'q[status_eq]': status_eq,
+        'q[s][]': 'starts_at asc',
+    }
+
+    # Add optional parameter if provided
+    if owner_name_eq is not None:
+        params['q[owner_name_eq]'] = owner_name_eq
+    if updated_at_gt is not None:
+        params['q[updated_at_gt]'] = updated_at_gt.isoformat()
+    if starts_at_gteq is not None:
+        params['q[starts_at_gteq]'] = starts_at_gteq.isoformat()
+    if starts_at_lteq is not None:
+        params['q[starts_at_lteq]'] = starts_at_lteq.isoformat()
+
+    return params
+
+
+def iter_opportunities(cursor=None, **filters):
+    """
+    Yield opportunities from the API as their pages arrive, optionally
+    only those updated after the updated_at_gt datetime.
+
+    Takes the same filters as get_opportunities. Raises PageFetchError
+    with the cursor to resume from if a page cannot be fetched.
+    """
+    return iter_records(
+        settings.API_URL, opportunity_params(**filters),
+        'opportunities', 'opportunities', cursor=cursor)
+
+
+def get_opportunities(
+        page=1, per_page=25, state_eq=2, status_eq=1, owner_name_eq=None,
+        updated_at_gt=None, starts_at_gteq=None, starts_at_lteq=None):
+    """
+    Get opportunities from the API with pagination, optionally only those
+    updated after the updated_at_gt datetime and starting between the
+    starts_at_gteq and starts_at_lteq datetimes
+    """
+    return collect_records(iter_opportunities(
+        cursor=PageCursor(page), per_page=per_page, state_eq=state_eq,
+        status_eq=status_eq, owner_name_eq=owner_name_eq,
+        updated_at_gt=updated_at_gt, starts_at_gteq=starts_at_gteq,
+        starts_at_lteq=starts_at_lteq))
+
+
+def iter_users(cursor=None, per_page=100, filtermode='user'):
+    """
+    Yield users from the API as their pages arrive
+    """
+    params = {
+        'per_page': per_page,
+        'filtermode': filtermode,
+    }
+
+    return iter_records(
+        settings.USERS_API_URL, params, 'members', 'users', cursor=cursor)
 
 
 def get_users(page=1, per_page=100, filtermode='user'):
     """
     Get users from the API
     """
-    # API configurations
-    url = settings.USERS_API_URL
-    subdomain = settings.X_SUBDOMAIN
-    auth_token = settings.X_AUTH_TOKEN
+    return collect_records(iter_users(
+        cursor=PageCursor(page), per_page=per_page, filtermode=filtermode))
 
-    payload = {}
 
-    # API headers
-    headers = {
-        'X-SUBDOMAIN': subdomain,
-        'X-AUTH-TOKEN': auth_token,
+def iter_products(
+        cursor=None,
+        per_page=20,
+        filtermode='active',
+        product_group='Scenic Calcs'):
+    """
+    Yield products from the API as their pages arrive
+    """
+    params = {
+        'per_page': per_page,
+        'filtermode': filtermode,
+        'q[name_or_product_group_name_or_tags_name_cont]': product_group,
     }
 
-    users = []
-
-    while True:
-        # API parameters
-        params = {
-            'page': page,
-            'per_page': per_page,
-            'filtermode': filtermode,
-        }
-
-        response = requests.request(
-            "GET", url, params=params, headers=headers, data=payload)
-
-        if response.status_code == 200:
-            data = response.json()
-            print(f'Fetched page {page} of \
-{data["meta"]["total_row_count"]} users')
-
-            # Add current page data to users list
-            users.extend(data["members"])
-
-            # Check if there are more pages to fetch
-            if data["meta"]["total_row_count"] > data[
-                        "meta"]["per_page"] * data["meta"]["page"]:
-                # Increment page number
-                page += 1
-            else:
-                # Break the loop if all data is fetched
-                break
-        else:
-            print(f'Error: {response.status_code}')
-            return None
-
-    return users
+    return iter_records(
+        settings.PRODUCTS_API_URL, params, 'products', 'products',
+        cursor=cursor)
 
 
 def get_products(
@@ -123,54 +397,36 @@ def get_products(
     """
     Get products from the API
     """
-    # API configurations
-    url = settings.PRODUCTS_API_URL
-    subdomain = settings.X_SUBDOMAIN
-    auth_token = settings.X_AUTH_TOKEN
+    return collect_records(iter_products(
+        cursor=PageCursor(page), per_page=per_page, filtermode=filtermode,
+        product_group=product_group))
 
-    payload = {}
 
-    # API headers
-    headers = {
-        'X-SUBDOMAIN': subdomain,
-        'X-AUTH-TOKEN': auth_token,
-    }
-
-    products = []
-
-    while True:
-        params = {
-            'page': page,
-            'per_page': per_page,
-            'filtermode': filtermode,
-            'q[name_or_product_group_name_or_tags_name_cont]': product_group,
-        }
-
-        response = requests.request(
-            "GET", url, params=params, headers=headers, data=payload)
+class OpportunityNotFound(Exception):
+    """Raised when Current RMS has no opportunity with the requested id"""
 
-        if response.status_code == 200:
-            data = response.json()
 
-            print(f'Fetched page {page} of \
-{data["meta"]["total_row_count"]} products')
+def get_opportunity(opportunity_id):
+    """
+    Get one opportunity from the API, or None if the request failed.
 
-            # Add the current page of data to the products list
-            products.extend(data["products"])
+    Raises OpportunityNotFound if the opportunity does not exist, as once
+    it has been deleted.
+    """
+    url = f'{settings.API_URL}/{opportunity_id}'
+    response = get_client().get(url)
 
-            # Check if there are more pages to fetch
-            if data["meta"]["total_row_count"] > data[
-                    "meta"]["per_page"] * data["meta"]["page"]:
-                # Increment page number
-                page += 1
-            else:
-                # Break the loop if all data is fetched
-                break
-        else:
-            print(f'Error: {response.status_code}')
-            return None
+    if response is None:
+        return None
+    if response.status_code == 404:
+        logger.warning("Opportunity %s was not found in Current RMS (404)", opportunity_id)
+        raise OpportunityNotFound(opportunity_id)
+    if response.status_code != 200:
+        logger.warning(
+            "Failed to fetch opportunity %s: HTTP %s", opportunity_id, response.status_code)
+        return None
 
-    return products
+    return response.json()["opportunity"]
 
 
 def get_opportunity_items(
@@ -183,36 +439,30 @@ def get_opportunity_items(
     """
     # API configurations
     url = f'{settings.API_URL}/{opportunity_id}/opportunity_items'
-    print(url)
-    subdomain = settings.X_SUBDOMAIN
-    auth_token = settings.X_AUTH_TOKEN
-
-    payload = {}
+    logger.debug("Fetching items from %s", url)
+    client = get_client()
 
     opportunity_items = []
 
-    # API headers
-    headers = {
-        'X-SUBDOMAIN': subdomain,
-        'X-AUTH-TOKEN': auth_token,
-    }
-
     params = {
         'q[opportunity_item_type_eq]': item_type_eq,
         'q[weight_eq]': weight_eq,
         'q[rate_definition_id_eq]': rate_definition_id_eq,
     }
 
-    response = requests.request(
-        "GET", url, params=params, headers=headers, data=payload)
+    response = client.get(url, params=params)
 
+    if response is None:
+        return None
     if response.status_code == 200:
         data = response.json()
 
         # Add the current page of data to the opportunity items list
         opportunity_items.extend(data["opportunity_items"])
     else:
-        print(f'Error: {response.status_code}')
+        logger.warning(
+            "Failed to fetch items for opportunity %s: HTTP %s",
+            opportunity_id, response.status_code)
         return None
 
     return opportunity_items
@@ -38,10 +38,26 @@ class WorkloadConfig(AppConfig):
                     'interval': schedule,
                     'task': 'fetch_workshop_workload_task',
                     'args': json.dumps([91]),
+                    'kwargs': json.dumps({'mode': 'incremental'}),
                 }
             )
 
             if not created:
                 task.interval = schedule
                 task.args = json.dumps([91])
+                task.kwargs = json.dumps({'mode': 'incremental'})
                 task.save()
+
+            cache_schedule, _ = IntervalSchedule.objects.get_or_create(
+                every=5,
+                period=IntervalSchedule.MINUTES,
+            )
+
+            PeriodicTask.objects.update_or_create(
+                name='Refresh warehouse workload cache',
+                defaults={
+                    'interval': cache_schedule,
+                    'task': 'refresh_workload_cache_task',
+                    'args': json.dumps([14]),
+                }
+            )
@@ -0,0 +1,336 @@
+"""
+An offline stand-in for the Current RMS API, for benchmarking the sync
+and the workload endpoints without touching the live service.
+
+A fixture holds the opportunities, their items and the products the API
+would return. It is either generated with synthetic_fixture or recorded
+from the live API with record_fixture and saved as JSON. replay_fixture
+then serves it through a requests transport adapter mounted on the shared
+client, so the benchmark runs the real client, paging, filtering and
+sync code.
+"""
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+from django.test import override_settings
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from . import api_calls
+from .api_calls import CurrentRMSClient, get_opportunities, get_opportunity_items, get_products
+from .sync import EXCLUDED_PRODUCT_IDS
+from .utils import date_window_filters
+
+BENCHMARK_HOST = 'https://current-rms.benchmark'
+BENCHMARK_URLS = {
+    'API_URL': f'{BENCHMARK_HOST}/api/v1/opportunities',
+    'USERS_API_URL': f'{BENCHMARK_HOST}/api/v1/members',
+    'PRODUCTS_API_URL': f'{BENCHMARK_HOST}/api/v1/products',
+}
+
+# The (state, status) pairs of the opportunities the sync and the
+# api_workload summary list
+OPPORTUNITY_STATES = (
+    (2, 1, 'Provisional'),
+    (2, 5, 'Reserved'),
+    (2, 0, 'Open'),
+    (3, 0, 'Confirmed'),
+    (3, 20, 'Active'),
+)
+
+API_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+def api_datetime(value):
+    """Format a datetime the way Current RMS returns it"""
+    return value.astimezone(timezone.utc).strftime(API_DATETIME_FORMAT)
+
+
+def synthetic_fixture(opportunities=1000, days=91, seed=1):
+    """
+    Generate a fixture of synthetic opportunities starting over the next
+    `days` days, with owners, clients and venues shared between them the
+    way real bookings are and up to eight items each.
+
+    Parameters:
+    - opportunities: The number of opportunities to generate
+    - days: The number of days ahead the opportunities start within
+    - seed: The random seed, so the same arguments give the same fixture
+
+    Returns:
+    - A dict of opportunities, items keyed by opportunity id and products
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    owner_count = max(1, min(40, opportunities // 20))
+    client_count = max(1, opportunities // 5)
+    venue_count = max(1, opportunities // 10)
+    product_ids = list(range(1, 31)) + sorted(EXCLUDED_PRODUCT_IDS)
+
+    records = []
+    items = {}
+    for index in range(opportunities):
+        current_id = 100000 + index
+        state, status, status_name = rng.choice(OPPORTUNITY_STATES)
+        starts_at = now + timedelta(hours=1 + rng.randrange(max(1, (days - 1) * 24)))
+        owner_id = rng.randint(1, owner_count)
+        client_id = rng.randint(1, client_count)
+        venue_id = rng.randint(1, venue_count)
+
+        records.append({
+            'id': current_id,
+            'number': str(current_id),
+            'subject': f'Benchmark job {current_id}',
+            'state': state,
+            'status': status,
+            'status_name': status_name,
+            'custom_fields': {'dry_hire': 'No', 'dry_hire_transport': 'No'},
+            'starts_at': api_datetime(starts_at),
+            'ends_at': api_datetime(starts_at + timedelta(days=rng.randint(1, 5))),
+            'load_starts_at': api_datetime(starts_at - timedelta(hours=2)) if index % 3 == 0 else None,
+            'deliver_starts_at': api_datetime(starts_at - timedelta(hours=4)) if index % 3 == 1 else None,
+            'updated_at': api_datetime(now - timedelta(minutes=rng.randrange(60 * 24 * 30))),
+            'weight_total': f'{rng.uniform(0, 2000):.2f}',
+            'tag_list': [f'tag-{rng.randint(1, 10)}'],
+            'owner': {
+                'id': owner_id,
+                'uuid': str(uuid.UUID(int=owner_id)),
+                'name': f'Owner {owner_id}',
+                'active': True,
+                'bookable': False,
+                'membership_id': owner_id,
+                'membership_type': 'User',
+                'lawful_basis_type_id': 1,
+                'lawful_basis_type_name': 'Legitimate interest',
+                'tag_list': ['staff'],
+            },
+            'member': {
+                'id': client_id,
+                'uuid': str(uuid.UUID(int=10 ** 6 + client_id)),
+                'name': f'Client {client_id}',
+                'active': True,
+                'tag_list': [f'client-{client_id % 5}'],
+            },
+            'destination': {
+                'address': {
+                    'id': venue_id,
+                    'name': f'Venue {venue_id}',
+                    'street': f'{venue_id} High Street',
+                    'city': 'London',
+                    'postcode': 'N1 1AA',
+                    'country': 'United Kingdom',
+                },
+            } if index % 5 else {},
+        })
+        items[str(current_id)] = [
+            {
+                'id': current_id * 10 + position,
+                'opportunity_id': current_id,
+                'item_id': rng.choice(product_ids),
+                'item_type': 'Product',
+                'opportunity_item_type': 2,
+                'opportunity_item_type_name': 'Principal',
+                'name': f'Scenic calc {position} - {current_id}',
+                'quantity': str(rng.randint(1, 40)),
+                'description': '',
+            }
+            for position in range(rng.randint(0, 8))
+        ]
+
+    records.sort(key=lambda record: record['starts_at'])
+    return {
+        'opportunities': records,
+        'items': items,
+        'products': [
+            {'id': product_id, 'name': f'Scenic calc product {product_id}',
+             'type': 'Product', 'description': ''}
+            for product_id in product_ids
+        ],
+        'members': [],
+    }
+
+
+def record_fixture(days=91):
+    """
+    Record a fixture from the live API: the opportunities starting within
+    the next `days` days in every state the sync and the summary list,
+    their items and the active products
+
+    Returns:
+    - The fixture dict, or None if a listing could not be fetched
+    """
+    window = date_window_filters(days)
+    opportunities = {}
+    for state, status, _ in OPPORTUNITY_STATES:
+        records = get_opportunities(state_eq=state, status_eq=status, **window)
+        if records is None:
+            return None
+        for record in records:
+            opportunities[record['id']] = record
+
+    products = get_products()
+    if products is None:
+        return None
+
+    return {
+        'opportunities': sorted(opportunities.values(), key=lambda record: record['starts_at'] or ''),
+        'items': {
+            str(current_id): get_opportunity_items(current_id) or []
+            for current_id in opportunities
+        },
+        'products': products,
+        'members': [],
+    }
+
+
+def load_fixture(path):
+    """Load a fixture saved as JSON"""
+    with open(path) as fixture_file:
+        return json.load(fixture_file)
+
+
+def save_fixture(fixture, path):
+    """Save a fixture as JSON"""
+    with open(path, 'w') as fixture_file:
+        json.dump(fixture, fixture_file)
+
+
+class FixtureAdapter(BaseAdapter):
+    """
+    A requests transport adapter that answers Current RMS listing, single
+    opportunity and item requests from a fixture, applying the ransack
+    filters the client sends and paging the results the way the API does.
+
+    Parameters:
+    - fixture: The fixture dict to serve
+    - latency: Seconds each response is delayed by, to stand in for the
+    round trip to the API
+    """
+
+    def __init__(self, fixture, latency=0.0):
+        super().__init__()
+        self.fixture = fixture
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes = 0
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/')
+
+        opportunities_path = urlparse(BENCHMARK_URLS['API_URL']).path
+        if path.endswith('/opportunity_items'):
+            current_id = path.split('/')[-2]
+            body = {'opportunity_items': self.fixture['items'].get(current_id, [])}
+        elif path.rsplit('/', 1)[0] == opportunities_path:
+            current_id = int(path.rsplit('/', 1)[1])
+            record = next((
+                record for record in self.fixture['opportunities'] if record['id'] == current_id
+            ), None)
+            if record is None:
+                return self.build_response(request, 404, {'errors': ['Not found']})
+            body = {'opportunity': record}
+        elif path == opportunities_path:
+            body = self.page('opportunities', self.filter_opportunities(query), query)
+        elif path == urlparse(BENCHMARK_URLS['PRODUCTS_API_URL']).path:
+            body = self.page('products', self.fixture['products'], query)
+        elif path == urlparse(BENCHMARK_URLS['USERS_API_URL']).path:
+            body = self.page('members', self.fixture.get('members', []), query)
+        else:
+            return self.build_response(request, 404, {'errors': ['Not found']})
+
+        if self.latency:
+            time.sleep(self.latency)
+        return self.build_response(request, 200, body)
+
+    def close(self):
+        pass
+
+    def filter_opportunities(self, query):
+        """The fixture opportunities matching the ransack predicates in the query"""
+        records = self.fixture['opportunities']
+        for key, field in (('q[state_eq]', 'state'), ('q[status_eq]', 'status')):
+            if key in query:
+                records = [record for record in records if str(record.get(field)) == query[key]]
+        if 'q[owner_name_eq]' in query:
+            records = [record for record in records
+                       if (record.get('owner') or {}).get('name') == query['q[owner_name_eq]']]
+
+        for key, field, keep in (
+                ('q[updated_at_gt]', 'updated_at', lambda value, bound: value > bound),
+                ('q[starts_at_gteq]', 'starts_at', lambda value, bound: value >= bound),
+                ('q[starts_at_lteq]', 'starts_at', lambda value, bound: value <= bound)):
+            if key in query:
+                bound = datetime.fromisoformat(query[key])
+                records = [
+                    record for record in records
+                    if record.get(field) and keep(parse_api_datetime(record[field]), bound)
+                ]
+        return records
+
+    def page(self, record_key, records, query):
+        """One page of records with the meta block the API sends"""
+        per_page = int(query.get('per_page', 20))
+        page = int(query.get('page', 1))
+        start = (page - 1) * per_page
+        return {
+            record_key: records[start:start + per_page],
+            'meta': {
+                'total_row_count': len(records),
+                'per_page': per_page,
+                'page': page,
+                'page_count': max(1, math.ceil(len(records) / per_page)),
+            },
+        }
+
+    def build_response(self, request, status_code, body):
+        response = Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode()
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        with self.lock:
+            self.calls += 1
+            self.bytes += len(response._content)
+        return response
+
+
+def parse_api_datetime(value):
+    """Parse a Current RMS timestamp into an aware datetime"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+@contextmanager
+def replay_fixture(fixture, latency=0.0):
+    """
+    Serve the fixture in place of the Current RMS API while the block runs.
+
+    The API urls are pointed at the benchmark host, the rate limit is
+    lifted and the shared client is swapped for one whose session sends
+    every request to a FixtureAdapter, which is yielded so callers can
+    read its call counts.
+    """
+    adapter = FixtureAdapter(fixture, latency=latency)
+    client = CurrentRMSClient(subdomain='benchmark', auth_token='benchmark')
+    client.session.mount(BENCHMARK_HOST, adapter)
+
+    previous_client = api_calls._client
+    api_calls._client = client
+    try:
+        with override_settings(CURRENT_RMS_RATE_LIMIT=0, **BENCHMARK_URLS):
+            yield adapter
+    finally:
+        api_calls._client = previous_client
+        client.session.close()
@@ -0,0 +1,103 @@
+"""
+Change notifications pushed to the workload dashboards.
+
+The sync tasks, the webhook resync and custom input edits publish a small
+JSON event on a Redis pub/sub channel whenever the data behind a dashboard
+changes. The workload_events view streams the channel to every open screen
+as server-sent events, so screens refetch only when told to instead of
+polling on a timer.
+
+Events are notifications, not data: a "workshop" event carries the new
+snapshot version and, for custom input edits, the opportunity ids edited,
+and a "workload" event the days of the api_workload summary refreshed.
+Screens fetch the data itself from the existing ETag-guarded endpoints.
+"""
+import json
+import logging
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+EVENTS_CHANNEL = "workload:events"
+
+_publisher = None
+
+
+def get_publisher():
+    """The process-wide Redis client events are published with"""
+    global _publisher
+    if _publisher is None:
+        _publisher = redis.Redis.from_url(
+            settings.WORKLOAD_EVENTS_REDIS_URL, **settings.REDIS_SSL_OPTIONS)
+    return _publisher
+
+
+def publish_change(event_type, **data):
+    """
+    Publish a change event to the open dashboards once the current
+    transaction commits, so a screen never refetches ahead of the write.
+
+    Publishing is best effort: without WORKLOAD_EVENTS_REDIS_URL it does
+    nothing, and a Redis error is logged rather than failing the write.
+    """
+    if not settings.WORKLOAD_EVENTS_REDIS_URL:
+        return
+
+    message = json.dumps({"type": event_type, **data})
+
+    def publish():
+        try:
+            get_publisher().publish(EVENTS_CHANNEL, message)
+        except redis.RedisError as e:
+            logger.warning("Could not publish %s event: %s", event_type, e)
+
+    transaction.on_commit(publish)
+
+
+def format_event(event_type, data):
+    """A server-sent event frame"""
+    return f"event: {event_type}\ndata: {data}\n\n"
+
+
+async def event_stream(heartbeat=None):
+    """
+    Stream the events channel as server-sent events until the client goes.
+
+    A comment is sent every `heartbeat` seconds, WORKLOAD_EVENTS_HEARTBEAT_SECONDS
+    by default, while nothing is published, so proxies that drop idle
+    connections keep it open. Django cancels the generator when the client
+    disconnects, which unsubscribes and closes the connection.
+    """
+    if heartbeat is None:
+        heartbeat = settings.WORKLOAD_EVENTS_HEARTBEAT_SECONDS
+
+    client = redis.asyncio.Redis.from_url(
+        settings.WORKLOAD_EVENTS_REDIS_URL, **settings.REDIS_SSL_OPTIONS)
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(EVENTS_CHANNEL)
+        # Tell the browser how long to wait before reconnecting
+        yield f"retry: {settings.WORKLOAD_EVENTS_RETRY_MS}\n\n"
+
+        while True:
+            message = await pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+
+            data = message["data"]
+            if isinstance(data, bytes):
+                data = data.decode()
+            try:
+                event_type = json.loads(data)["type"]
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Dropped malformed workload event: %r", data)
+                continue
+            yield format_event(event_type, data)
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,140 @@
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from workload.benchmark import (
+    load_fixture, record_fixture, replay_fixture, save_fixture, synthetic_fixture
+)
+from workload.models import SyncRun
+from workload.tasks import fetch_workshop_workload
+from workload.utils import refresh_workload_summary
+from workload.views import api_workload, get_workshop_workload_data
+
+BENCHMARK_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'workload-benchmark'},
+}
+
+
+class Rollback(Exception):
+    """Raised to roll back everything the benchmark wrote once it ends"""
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Benchmark the workshop workload sync and the workload endpoints against '
+        'an offline stand-in for the Current RMS API, reporting wall time, queries, '
+        'API calls and peak memory. Everything written is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--opportunities', type=int, nargs='+', default=[100, 1000],
+            help='The synthetic fixture sizes to benchmark, e.g. 100 1000 10000')
+        parser.add_argument(
+            '--fixture', help='Replay a recorded fixture instead of synthetic ones')
+        parser.add_argument(
+            '--record', metavar='PATH',
+            help='Record a fixture from the live API to PATH and exit')
+        parser.add_argument(
+            '--save-fixture', metavar='PATH',
+            help='Save the largest synthetic fixture to PATH')
+        parser.add_argument('--days', type=int, default=91)
+        parser.add_argument('--summary-days', type=int, default=14,
+                            choices=settings.WORKLOAD_SUMMARY_DAYS,
+                            help='The days asked of api_workload')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Milliseconds added to every stand-in API response')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--no-memory', action='store_true',
+            help='Skip tracemalloc, which slows the timed code down')
+
+    def handle(self, *args, **options):
+        """A command to benchmark the sync and endpoints without the live API"""
+        if options['record']:
+            fixture = record_fixture(options['days'])
+            if fixture is None:
+                raise CommandError('Could not fetch a listing from the API')
+            save_fixture(fixture, options['record'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Recorded {len(fixture['opportunities'])} opportunities to {options['record']}"))
+            return
+
+        if options['fixture']:
+            fixtures = [(options['fixture'], load_fixture(options['fixture']))]
+        else:
+            fixtures = [
+                (str(size), synthetic_fixture(size, days=options['days'], seed=options['seed']))
+                for size in options['opportunities']
+            ]
+            if options['save_fixture']:
+                save_fixture(fixtures[-1][1], options['save_fixture'])
+
+        self.measure_memory = not options['no_memory']
+        self.stdout.write(
+            f"{'fixture':>10} {'step':<18} {'seconds':>9} {'queries':>8} {'api calls':>10} {'peak MB':>8}")
+        for name, fixture in fixtures:
+            self.benchmark_fixture(name, fixture, options)
+
+    def benchmark_fixture(self, name, fixture, options):
+        """Runs every step against one fixture, rolling back what they wrote"""
+        days = options['days']
+        factory = RequestFactory()
+        summary_request = factory.get('/workload/api/workload/', {'days': options['summary_days']})
+        workshop_request = factory.get('/workload/get_workshop_workload_data/')
+
+        steps = (
+            ('sync initial', lambda: fetch_workshop_workload(days, mode=SyncRun.MODE_FULL)),
+            ('sync unchanged', lambda: fetch_workshop_workload(days, mode=SyncRun.MODE_FULL)),
+            ('workshop data', lambda: get_workshop_workload_data(workshop_request)),
+            # A cold api_workload queues this refresh and answers 202
+            ('summary refresh', lambda: refresh_workload_summary(options['summary_days'])),
+            ('api_workload warm', lambda: api_workload(summary_request)),
+        )
+
+        try:
+            with override_settings(CACHES=BENCHMARK_CACHES), \
+                    replay_fixture(fixture, latency=options['latency'] / 1000) as adapter, \
+                    transaction.atomic():
+                cache.clear()
+                for step, call in steps:
+                    self.report(name, step, call, adapter)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def report(self, name, step, call, adapter):
+        """Times one step, counting its queries, API calls and peak memory"""
+        calls_before = adapter.calls
+        if self.measure_memory:
+            tracemalloc.start()
+
+        # The sync's progress output and logs would bury the table
+        logging.disable(logging.INFO)
+        try:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), \
+                    CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                call()
+                seconds = time.perf_counter() - started
+        finally:
+            logging.disable(logging.NOTSET)
+
+        peak = '-'
+        if self.measure_memory:
+            peak = f'{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}'
+            tracemalloc.stop()
+
+        self.stdout.write(
+            f'{name:>10} {step:<18} {seconds:>9.3f} {len(queries):>8} '
+            f'{adapter.calls - calls_before:>10} {peak:>8}')
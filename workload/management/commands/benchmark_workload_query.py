@@ -0,0 +1,118 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from workload.models import Opportunity
+from workload.utils import active_opportunities_starting_within
+
+INDEX_NAME = 'opp_active_effective_start_idx'
+
+# Planner settings that stop PostgreSQL using any index, set for the
+# benchmark transaction only, so nothing is dropped and no lock is taken
+WITHOUT_INDEX_SETTINGS = ('enable_indexscan', 'enable_indexonlyscan', 'enable_bitmapscan')
+
+
+class Rollback(Exception):
+    """Raised to roll back the generated opportunities once the benchmark ends"""
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Time the dashboard effective start query as years of opportunities '
+        'accumulate. The generated rows are rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=5)
+        parser.add_argument('--per-day', type=int, default=20,
+                            help='Opportunities generated per day of history')
+        parser.add_argument('--days', type=int, default=91,
+                            help='The dashboard window queried')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--without-index', action='store_true',
+            help=(f'Compare against the query without {INDEX_NAME} by turning '
+                  'index scans off for the benchmark transaction. PostgreSQL only.'))
+        parser.add_argument(
+            '--explain', action='store_true',
+            help='Print the query plan at each scale')
+
+    def handle(self, *args, **options):
+        """A command to benchmark the dashboard query against accumulated history"""
+        if options['without_index'] and connection.vendor != 'postgresql':
+            raise CommandError('--without-index needs PostgreSQL to turn index scans off')
+
+        try:
+            with transaction.atomic():
+                if options['without_index']:
+                    with connection.cursor() as cursor:
+                        for setting in WITHOUT_INDEX_SETTINGS:
+                            cursor.execute(f'SET LOCAL {setting} = off')
+
+                self.stdout.write(f"{'years':>5} {'rows':>9} {'matched':>8} {'best ms':>9} {'mean ms':>9}")
+                next_id = (Opportunity.objects.aggregate(Max('current_id'))['current_id__max'] or 0) + 1
+                self.create_window(next_id, options)
+                next_id += options['days'] * options['per_day']
+
+                for year in range(1, options['years'] + 1):
+                    self.create_history_year(next_id, year, options['per_day'])
+                    next_id += 365 * options['per_day']
+                    self.report(year, options)
+
+                raise Rollback
+        except Rollback:
+            pass
+
+    def create_window(self, first_id, options):
+        """Creates the active opportunities the dashboard window returns"""
+        now = timezone.now()
+        Opportunity.objects.bulk_create([
+            self.build_opportunity(first_id + i, now + timedelta(days=i // options['per_day']), True)
+            for i in range(options['days'] * options['per_day'])
+        ], batch_size=1000)
+
+    def create_history_year(self, first_id, year, per_day):
+        """Creates a year of past opportunities, which the sync has long deactivated"""
+        year_start = timezone.now() - timedelta(days=365 * year)
+        Opportunity.objects.bulk_create([
+            self.build_opportunity(first_id + i, year_start + timedelta(days=i // per_day), False)
+            for i in range(365 * per_day)
+        ], batch_size=1000)
+
+    def build_opportunity(self, current_id, starts_at, is_active):
+        return Opportunity(
+            current_id=current_id,
+            order_number=str(current_id),
+            opportunity_name=f'Benchmark {current_id}',
+            dry_hire='No',
+            dry_hire_transport='No',
+            status=1,
+            status_name='Provisional',
+            starts_at=starts_at,
+            ends_at=starts_at + timedelta(days=1),
+            load_starts_at=starts_at if current_id % 3 == 0 else None,
+            deliver_starts_at=starts_at if current_id % 3 == 1 else None,
+            is_active=is_active,
+        )
+
+    def report(self, year, options):
+        """Times the dashboard query at the current scale"""
+        queryset = active_opportunities_starting_within(options['days']).order_by('effective_start')
+        timings = []
+        for _ in range(options['repeat']):
+            started = time.perf_counter()
+            matched = len(list(queryset.values_list('id', flat=True)))
+            timings.append((time.perf_counter() - started) * 1000)
+
+        rows = Opportunity.objects.count()
+        self.stdout.write(
+            f'{year:>5} {rows:>9} {matched:>8} '
+            f'{min(timings):>9.2f} {sum(timings) / len(timings):>9.2f}'
+        )
+        if options['explain']:
+            self.stdout.write(queryset.values_list('id', flat=True).explain())
@@ -0,0 +1,44 @@
+import json
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from workload.webhooks import (
+    OPPORTUNITY_ACTIONS, SIGNATURE_HEADER, TIMESTAMP_HEADER, build_event, sign_payload
+)
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Send a signed Current RMS style opportunity webhook to a running '
+        'server, standing in for Current RMS when testing the webhook resync'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('opportunity_id', type=int)
+        parser.add_argument('--action', choices=OPPORTUNITY_ACTIONS, default='update')
+        parser.add_argument(
+            '--url', default='http://localhost:8000/workload/webhooks/current-rms/')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='Send the event this many times, to see it debounced')
+        parser.add_argument(
+            '--secret', help='Sign with this secret instead of CURRENT_RMS_WEBHOOK_SECRET')
+
+    def handle(self, *args, **options):
+        """A command to send a fake Current RMS webhook"""
+        secret = options['secret'] or settings.CURRENT_RMS_WEBHOOK_SECRET
+        if not secret:
+            raise CommandError('Set CURRENT_RMS_WEBHOOK_SECRET or pass --secret')
+
+        body = json.dumps(build_event(options['opportunity_id'], options['action'])).encode()
+        for _ in range(options['repeat']):
+            timestamp = str(int(time.time()))
+            response = requests.post(options['url'], data=body, timeout=10, headers={
+                'Content-Type': 'application/json',
+                TIMESTAMP_HEADER: timestamp,
+                SIGNATURE_HEADER: sign_payload(body, timestamp, secret),
+            })
+            self.stdout.write(f'{response.status_code} {response.text}')
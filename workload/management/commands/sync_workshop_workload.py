@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from workload.models import SyncRun
+from workload.tasks import fetch_workshop_workload, fetch_workshop_workload_sharded
+
+
+class Command(BaseCommand):
+
+    help = 'Run the workshop workload sync, a full resync unless --incremental is given'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=91)
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only sync opportunities updated since the last run')
+        parser.add_argument(
+            '--queue', action='store_true',
+            help='Queue the sync on a Celery worker instead of running it here')
+        parser.add_argument(
+            '--sharded', action='store_true',
+            help='Queue a sync fanned out across the Celery workers in shards')
+
+    def handle(self, *args, **options):
+        """A command to trigger the workshop workload sync on demand"""
+        mode = SyncRun.MODE_INCREMENTAL if options['incremental'] else SyncRun.MODE_FULL
+
+        if options['sharded']:
+            task = fetch_workshop_workload_sharded.delay(options['days'], mode=mode)
+            self.stdout.write(f'Queued sharded {mode} sync as task {task.id}')
+            return
+
+        if options['queue']:
+            task = fetch_workshop_workload.delay(options['days'], mode=mode)
+            self.stdout.write(f'Queued {mode} sync as task {task.id}')
+            return
+
+        result = fetch_workshop_workload(options['days'], mode=mode)
+        self.stdout.write(self.style.SUCCESS(f'Sync finished: {result}'))
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-18 10:56
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workload', '0011_workshopsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='opportunity',
+            index=models.Index(django.db.models.functions.comparison.Coalesce('load_starts_at', 'deliver_starts_at', 'starts_at'), condition=models.Q(('is_active', True)), name='opp_active_effective_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sceniccalcitem',
+            index=models.Index(fields=['current_id'], name='calc_item_current_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sceniccalcitem',
+            index=models.Index(fields=['opportunity_id', 'current_item_id', 'is_active'], name='calc_item_opp_item_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sceniccalcitems',
+            index=models.Index(fields=['opportunity', 'is_active'], name='calc_items_opp_active_idx'),
+        ),
+    ]
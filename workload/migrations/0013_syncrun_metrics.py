@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workload', '0012_dashboard_and_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workload', '0013_syncrun_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='shards',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -115,6 +117,14 @@ class Opportunity(models.Model):
     class Meta:
         ordering = ['-updated_at']
         verbose_name_plural = 'Opportunities'
+        indexes = [
+            # The dashboards filter active opportunities on this start date
+            models.Index(
+                Coalesce('load_starts_at', 'deliver_starts_at', 'starts_at'),
+                name='opp_active_effective_start_idx',
+                condition=Q(is_active=True),
+            ),
+        ]
 
 
 class ScenicCalcItems(models.Model):
@@ -132,6 +142,9 @@ class ScenicCalcItems(models.Model):
     
     class Meta:
         verbose_name_plural = 'Scenic calc item groups'
+        indexes = [
+            models.Index(fields=['opportunity', 'is_active'], name='calc_items_opp_active_idx'),
+        ]
 
 
 class ScenicCalcItem(models.Model):
@@ -154,6 +167,15 @@ class ScenicCalcItem(models.Model):
     def __str__(self):
         return f"{self.name} (Qty: {self.quantity})"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['current_id'], name='calc_item_current_id_idx'),
+            models.Index(
+                fields=['opportunity_id', 'current_item_id', 'is_active'],
+                name='calc_item_opp_item_active_idx',
+            ),
+        ]
+
 
 class ScenicCalcTotal(models.Model):
     opportunity = models.OneToOneField(Opportunity, on_delete=models.CASCADE, related_name='scenic_calc_total')
@@ -187,27 +209,31 @@ class CustomInput(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     previously_updated_at = models.DateTimeField(null=True, blank=True)
 
+    def apply_previous_values(self, old):
+        """Preserve the stored values of old on the previous_* fields before they change"""
+        if old.updated_at:
+            self.previously_updated_at = old.updated_at
+        if old.working_days is not None:
+            self.previous_working_days = old.working_days
+        if old.start_build_date is not None:
+            self.previous_start_build_date = old.start_build_date
+        if old.planned_finish_date is not None:
+            self.previous_planned_finish_date = old.planned_finish_date
+        if old.include_weekends is not None:
+            self.previous_include_weekends = old.include_weekends
+        if old.num_of_carpenters is not None:
+            self.previous_num_of_carpenters = old.num_of_carpenters
+        # if old.date_out is not None:
+        #     self.previous_date_out = old.date_out
+        # if old.time_out is not None:
+        #     self.previous_time_out = old.time_out
+
     def save(self, *args, **kwargs):
         # If the record already exists, prevserve the current data before it changes
         if self.pk is not None:
             try:
                 old = CustomInput.objects.get(pk=self.pk)
-                if old.updated_at:
-                    self.previously_updated_at = old.updated_at
-                if old.working_days is not None:
-                    self.previous_working_days = old.working_days
-                if old.start_build_date is not None:
-                    self.previous_start_build_date = old.start_build_date
-                if old.planned_finish_date is not None:
-                    self.previous_planned_finish_date = old.planned_finish_date
-                if old.include_weekends is not None:
-                    self.previous_include_weekends = old.include_weekends
-                if old.num_of_carpenters is not None:
-                    self.previous_num_of_carpenters = old.num_of_carpenters
-                # if old.date_out is not None:
-                #     self.previous_date_out = old.date_out
-                # if old.time_out is not None:
-                #     self.previous_time_out = old.time_out
+                self.apply_previous_values(old)
             except CustomInput.DoesNotExist:
                 pass
         super().save(*args, **kwargs)
@@ -256,3 +282,62 @@ class ActiveProducts(models.Model):
     
     class Meta:
         verbose_name_plural = 'Active products'
+
+
+class SyncRun(models.Model):
+    MODE_FULL = 'full'
+    MODE_INCREMENTAL = 'incremental'
+    MODE_CHOICES = [
+        (MODE_FULL, 'Full'),
+        (MODE_INCREMENTAL, 'Incremental'),
+    ]
+
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCESS = 'success'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCESS, 'Success'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default=MODE_FULL)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    days = models.PositiveIntegerField()
+    watermark = models.DateTimeField(null=True, blank=True)
+    swept = models.BooleanField(default=False)
+    opportunities_processed = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # The number of shard tasks a sharded run fanned out, 0 when it ran as one task
+    shards = models.PositiveIntegerField(default=0)
+    # Row counts, phase timings, HTTP and query counters from SyncStats
+    metrics = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"{self.get_mode_display()} sync at {self.started_at} ({self.status})"
+
+    @property
+    def duration(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    class Meta:
+        ordering = ['-started_at']
+
+
+class WorkshopSnapshot(models.Model):
+    """
+    The serialised workshop workload dashboard data, rebuilt whenever the
+    sync runs or a custom input changes. The id doubles as its version.
+    """
+    payload = models.TextField()
+    opportunity_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Workshop snapshot v{self.id} ({self.created_at})"
+
+    class Meta:
+        ordering = ['-id']
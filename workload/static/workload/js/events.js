@@ -0,0 +1,67 @@
+const EVENTS_URL = '/workload/events/';
+
+/**
+ * Subscribes to the change notifications the server pushes to the dashboards
+ * Calls onChange with the event type and its data when one of the given event types arrives,
+ * and with 'reconnect' when the stream comes back after a drop, as events may have been missed.
+ * Falls back to calling onChange with 'poll' every pollInterval if the server does not stream
+ * events, e.g. when it answers 204 because no Redis is configured.
+ * @param {string[]} eventTypes - The event types to listen for, e.g. ['workshop']
+ * @param {function} onChange - Called with (eventType, data) whenever the data may have changed
+ * @param {number} pollInterval - Milliseconds between polls when falling back to polling
+ */
+export function subscribeToChanges(eventTypes, onChange, pollInterval) {
+    const startPolling = () => setInterval(() => onChange('poll', null), pollInterval);
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource(EVENTS_URL);
+    let opened = false;
+
+    source.onopen = () => {
+        if (opened) {
+            onChange('reconnect', null);
+        }
+        opened = true;
+    };
+    source.onerror = () => {
+        // The browser retries dropped streams by itself, but gives up for good on a
+        // response that is not an event stream
+        if (source.readyState === EventSource.CLOSED) {
+            console.warn('Change notifications unavailable, polling instead');
+            startPolling();
+        }
+    };
+
+    for (const eventType of eventTypes) {
+        source.addEventListener(eventType, event => {
+            let data = null;
+            try {
+                data = JSON.parse(event.data);
+            } catch (error) {
+                console.error('Error parsing change notification:', error);
+            }
+            onChange(eventType, data);
+        });
+    }
+}
+
+/**
+ * Calls callback whenever the date changes
+ * So dashboards can roll their calendars over without polling the server
+ * @param {function} callback - Called once the date has changed
+ * @param {number} checkInterval - Milliseconds between checks of the date
+ */
+export function onNewDay(callback, checkInterval = 60 * 1000) {
+    let today = new Date().toDateString();
+    setInterval(() => {
+        const now = new Date().toDateString();
+        if (now !== today) {
+            today = now;
+            callback();
+        }
+    }, checkInterval);
+}
@@ -1,25 +1,63 @@
+import { onNewDay, subscribeToChanges } from './events.js';
+
+const POLL_INTERVAL = 2 * 60 * 60 * 1000;  // Only used if the server does not push changes
+
 // Ensure the DOM is fully loaded before running the script
 document.addEventListener('DOMContentLoaded', function() {
     console.log('DOM fully loaded and parsed');
     rollingCalendar(28);
     fetchData(14);
     getQuotes();
-    setInterval( () => {
+    // The workload data is refetched only when the server says it has changed: a sync writing a
+    // new workshop snapshot means the summary may be stale, and a workload event that it was rebuilt
+    subscribeToChanges(['workshop', 'workload'], (eventType, data) => {
+        if (eventType === 'workload' && data && data.days !== 14) {
+            return;
+        }
+        fetchData(14);
+    }, POLL_INTERVAL);
+    setInterval(getQuotes, POLL_INTERVAL);
+    // Redrawing the calendar clears it, so fetch the data again in full rather than revalidating
+    onNewDay(() => {
         rollingCalendar(28);
+        workloadEtag = null;
         fetchData(14);
-        getQuotes();
-    }, 2 * 60 * 60 * 1000);
+    });
 });
 
 
+let workloadEtag = null;  // ETag of the last workload data received
+
+
 /**
  * Function to fetch the data from the API from the backend
+ * Sends the ETag of the last response, and leaves the display as it is when the server answers 304
+ * When the server answers 202 the data is still being built, so it is asked again after Retry-After
  * @returns {Promise} - The data from the API
  */
 function fetchData(days) {
-    fetch(`/workload/api/workload/?days=${days}`)
-        .then(response => response.json())
+    const headers = workloadEtag ? { 'If-None-Match': workloadEtag } : {};
+
+    fetch(`/workload/api/workload/?days=${days}`, { headers: headers, cache: 'no-store' })
+        .then(response => {
+            if (response.status === 304) {
+                return null;
+            }
+            if (response.status === 202) {
+                const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 5;
+                setTimeout(() => fetchData(days), retryAfter * 1000);
+                return null;
+            }
+            if (!response.ok) {
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            workloadEtag = response.headers.get('ETag');
+            return response.json();
+        })
         .then (data => {
+            if (!data) {
+                return;
+            }
             const total = parseFloat(data.provisional_weight) + parseFloat(data.reserved_weight) + parseFloat(data.confirmed_weight);
             console.log(total);
             setTrafficLightColour(total);
@@ -1,8 +1,15 @@
+import { onNewDay, subscribeToChanges } from './events.js';
+
 let overlay = document.getElementById('loading-overlay');
 let opportunityData;
 let previousOpportunityData = null;  // Variable to store the previous opportunity data
 let oppIds;
 let previousOppIds = null;
+let workshopDataEtag = null;  // ETag of the last workload data received
+let workshopSnapshotVersion = null;  // Snapshot version of the last workload data received
+const NOT_MODIFIED = 'not-modified';
+let customInputCache = {};  // Latest custom input data per opportunity id
+let pendingCustomInputs = null;  // Opportunity ids waiting on the next bulk custom input request
 
 // Ensure the DOM is fully loaded before running the script
 document.addEventListener('DOMContentLoaded', function() {
@@ -38,25 +45,47 @@ document.addEventListener('DOMContentLoaded', function() {
         // Store the previous opportunity data in local storage
         localStorage.setItem('previousOppIds', JSON.stringify(previousOppIds));
     });
-    setInterval( () => {
-        rollingCalendar(91);
-        fetchData().then(data => {
-            opportunityData = getScenicTagOpportunities(data);
-            opportunityData = sortOpportunitiesByStartDate(opportunityData);
-            previousOpportunityData = createPreviousOpportunityObjects(opportunityData);
-            oppIds = getOppIds(opportunityData);
-            displayOpportunities(opportunityData, previousOpportunityData, previousOppIds);
-            clickDisplayNone();
-            previousOppIds = oppIds;
-            // Update the previous opportunity data in local storage
-            localStorage.setItem('previousOppIds', JSON.stringify(previousOppIds));
-        });
+    // Refetch only when the server says a new snapshot has been published, skipping
+    // announcements of a version already on screen
+    subscribeToChanges(['workshop'], (eventType, data) => {
+        if (data && workshopSnapshotVersion !== null && data.version <= workshopSnapshotVersion) {
+            return;
+        }
+        refreshWorkload();
     }, 2 * 60 * 60 * 1000);
+    // Redrawing the calendar clears it, so fetch the data again in full rather than revalidating
+    onNewDay(() => {
+        workshopDataEtag = null;
+        refreshWorkload();
+    });
 });
 
+/**
+ * Redraws the calendar and the opportunities when the workload data has changed
+ */
+function refreshWorkload() {
+    rollingCalendar(91);
+    fetchData().then(data => {
+        // Nothing has changed since the last fetch, so keep the current display
+        if (!data || data === NOT_MODIFIED) {
+            return;
+        }
+        opportunityData = getScenicTagOpportunities(data);
+        opportunityData = sortOpportunitiesByStartDate(opportunityData);
+        previousOpportunityData = createPreviousOpportunityObjects(opportunityData);
+        oppIds = getOppIds(opportunityData);
+        displayOpportunities(opportunityData, previousOpportunityData, previousOppIds);
+        clickDisplayNone();
+        previousOppIds = oppIds;
+        // Update the previous opportunity data in local storage
+        localStorage.setItem('previousOppIds', JSON.stringify(previousOppIds));
+    });
+}
+
 /**
  * Function to fetch the data from the API from the backend
- * @returns {Promise} - The data from the API
+ * Sends the ETag of the last response so the server can answer 304 when nothing has changed
+ * @returns {Promise} - The data from the API, or NOT_MODIFIED if it is unchanged since the last fetch
  * @param {number} days - The number of days to fetch the data for
  */
 function fetchData() {
@@ -64,14 +93,25 @@ function fetchData() {
     void overlay.offsetWidth;
     overlay.classList.add('show');
 
-    return fetch(`/workload/get_workshop_workload_data/`)
+    const headers = workshopDataEtag ? { 'If-None-Match': workshopDataEtag } : {};
+
+    return fetch(`/workload/get_workshop_workload_data/`, { headers: headers, cache: 'no-store' })
         .then(response => {
+            if (response.status === 304) {
+                return NOT_MODIFIED;
+            }
             if (!response.ok) {
                 throw new Error(`HTTP error! Status: ${response.status}`);
             }
+            workshopDataEtag = response.headers.get('ETag');
+            workshopSnapshotVersion = parseInt(response.headers.get('X-Snapshot-Version'), 10) || null;
+            customInputCache = {};
             return response.json();
         })
         .then(data => {
+            if (data === NOT_MODIFIED) {
+                return data;
+            }
             if (!data.result) {
                 throw new Error("No result returned from server.");
             }
@@ -88,6 +128,42 @@ function fetchData() {
         });
 }
 
+/**
+ * Fetches the latest custom input data for an opportunity.
+ * Lookups made in the same tick are batched into one request to the bulk endpoint,
+ * and the results are cached until the workload data is refetched or the opportunity is edited.
+ * @param {number} id - The opportunity id
+ * @returns {Promise<object|null>} - The custom input data, or null if the opportunity was not found
+ */
+function fetchCustomInput(id) {
+    if (customInputCache[id]) {
+        return Promise.resolve(customInputCache[id]);
+    }
+
+    if (!pendingCustomInputs) {
+        const batch = { ids: new Set() };
+        batch.request = new Promise(resolve => setTimeout(resolve, 0))
+            .then(() => {
+                pendingCustomInputs = null;
+                return fetch(`/workload/opportunities/custom_inputs/?ids=${[...batch.ids].join(',')}`, { cache: 'no-store' });
+            })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error! Status: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                Object.assign(customInputCache, data.results);
+                return data.results;
+            });
+        pendingCustomInputs = batch;
+    }
+
+    pendingCustomInputs.ids.add(id);
+    return pendingCustomInputs.request.then(results => results[id] || null);
+}
+
 /**
  * Polls the status of a background task until it is completed.
  *
@@ -258,10 +334,8 @@ async function createOpportunityElement(currentOpportunity, previousOpportunity
     let customInputData = null;
     if (exists) {
         try{
-            const response = await fetch(`/workload/opportunities/${currentOpportunityId}/custom_input/`);
-            if (response.ok) {
-                customInputData = await response.json();
-            } else {
+            customInputData = await fetchCustomInput(currentOpportunityId);
+            if (!customInputData) {
                 console.error(`Failed to fetch custom input data for opportunity ${currentOpportunityId}`);
             }
         } catch (err) {
@@ -1181,6 +1255,7 @@ async function saveEdits(opportunity, button) {
             }),
         });
 
+        delete customInputCache[id];
         if (scenicModal) {
                 scenicModal.hide();
             }
@@ -1392,10 +1467,8 @@ async function compareScenicCalcModals(currentOpportunityElement, startBuildDate
     let customInputData = null;
     if (exists) {
         try{
-            const response = await fetch(`/workload/opportunities/${id}/custom_input/`);
-            if (response.ok) {
-                customInputData = await response.json();
-            } else {
+            customInputData = await fetchCustomInput(id);
+            if (!customInputData) {
                 console.error(`Failed to fetch custom input data for opportunity ${id}`);
             }
         } catch (err) {
@@ -1688,6 +1761,7 @@ async function updateCarpenters(opportunity, input) {
             })
         });
 
+        delete customInputCache[id];
         if (!response.ok) {
             console.error(`Failed to update num_of_carpenters for opportunity ${id}`)
         }
@@ -1930,6 +2004,7 @@ async function updateWeekendsInput(opportunity, newState) {
             }),
         });
 
+        delete customInputCache[opportunityId];
         if (!response.ok) {
             console.error(`Failed to update include_weekends for opportunity ${opportunityId}`);
         }
@@ -0,0 +1,996 @@
+"""
+Batched upsert path for the workshop workload sync.
+
+Rows for each model are loaded in one query keyed by their Current RMS id,
+diffed in memory and written back with bulk_create / bulk_update in chunks,
+keeping the previous_* history of the tracked fields.
+"""
+import copy
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (
+    Owner,
+    Client,
+    Opportunity,
+    Venue,
+    Tag,
+    ScenicCalcItems,
+    ScenicCalcItem,
+    ScenicCalcTotal,
+    ActiveProducts,
+    CustomInput
+)
+from .sync_stats import record, phase
+from .utils import (
+    parse_datetime_safe,
+    parse_decimal_safe,
+    calculate_working_days,
+    set_opp_date_and_time_out,
+    create_start_build_date,
+    apply_history,
+    has_changes,
+    changed_fields,
+    history_values,
+    history_update_fields,
+    fetch_opportunities_within_date,
+    get_opps_with_items
+)
+
+logger = logging.getLogger(__name__)
+
+_party_map = ContextVar("party_map", default=None)
+
+OPPORTUNITY_PREVIOUS_FIELDS = ["opportunity_name", "status_name"]
+CUSTOM_INPUT_PREVIOUS_FIELDS = ["date_out", "time_out"]
+SCENIC_TOTAL_PREVIOUS_FIELDS = ["grand_total"]
+# Products never counted towards a grand total, even when listed as active
+EXCLUDED_PRODUCT_IDS = frozenset({4597, 4977})
+SCENIC_ITEMS_UPDATE_FIELDS = [
+    "is_active", "item_total", "previous_item_total", "previously_updated_at",
+]
+CUSTOM_INPUT_VALUE_FIELDS = [
+    "num_of_carpenters", "include_weekends", "built", "date_out", "time_out",
+    "working_days", "start_build_date",
+]
+CUSTOM_INPUT_UPDATE_FIELDS = [
+    "num_of_carpenters", "include_weekends", "built", "date_out", "time_out",
+    "previous_date_out", "previous_time_out", "previously_updated_at",
+    "previous_working_days", "previous_start_build_date",
+    "previous_planned_finish_date", "previous_include_weekends",
+    "previous_num_of_carpenters", "working_days", "start_build_date",
+]
+
+
+def get_batch_size():
+    """Returns the chunk size used for bulk reads and writes"""
+    return getattr(settings, "SYNC_BATCH_SIZE", 500)
+
+
+def chunked(values, size):
+    """Yields successive chunks of size from a list"""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def load_existing(model, key_fields, keys, **filters):
+    """
+    Loads the existing rows for the given keys, chunking the IN clause.
+
+    Parameters:
+        model: The model class to query.
+        key_fields: A tuple of field attnames that make up the key.
+        keys: The keys to load, tuples when there is more than one key field.
+        filters: Any extra filters applied to the query.
+
+    Returns:
+        A dict of key to instance. Where a key matches several rows the one
+        with the lowest pk wins, as .first() would.
+    """
+    composite = len(key_fields) > 1
+    lookup_values = list({key[0] if composite else key for key in keys})
+    existing = {}
+
+    for chunk in chunked(lookup_values, get_batch_size()):
+        queryset = model.objects.filter(
+            **{f"{key_fields[0]}__in": chunk}, **filters).order_by("pk")
+        for obj in queryset:
+            if composite:
+                key = tuple(getattr(obj, field) for field in key_fields)
+            else:
+                key = getattr(obj, key_fields[0])
+            existing.setdefault(key, obj)
+
+    return existing
+
+
+def bulk_write(model, to_create, to_update, unchanged=0):
+    """
+    Writes new and changed instances in chunks, and records the counts
+    against the run in progress.
+
+    to_update holds (instance, update_fields) pairs. Instances changing the
+    same columns are written together, so each row only writes what
+    changed. bulk_update skips save(), so auto_now fields are stamped here
+    and written alongside. unchanged is how many rows were skipped as
+    matching the stored values.
+    """
+    record(
+        model,
+        created=len(to_create),
+        updated=len(to_update),
+        unchanged=unchanged,
+    )
+    batch_size = get_batch_size()
+
+    if to_create:
+        model.objects.bulk_create(to_create, batch_size=batch_size)
+
+    if to_update:
+        auto_now_fields = [
+            field.name for field in model._meta.concrete_fields
+            if getattr(field, "auto_now", False)
+        ]
+        now = timezone.now()
+        groups = defaultdict(list)
+        for obj, update_fields in to_update:
+            for field in auto_now_fields:
+                setattr(obj, field, now)
+            fields = tuple(sorted({*update_fields, *auto_now_fields}))
+            groups[fields].append(obj)
+
+        for fields, objs in groups.items():
+            model.objects.bulk_update(objs, list(fields), batch_size=batch_size)
+
+
+def bulk_upsert(
+    model,
+    rows,
+    key_fields=("current_id",),
+    previous_fields=(),
+    existing=None,
+    **filters,
+):
+    """
+    Creates or updates a model's rows from a dict of key to defaults.
+
+    Rows whose incoming values all match the stored ones are not written,
+    so their updated_at and previous_* values keep describing the last
+    real change. Changed rows only write the columns that changed, along
+    with their history.
+
+    Parameters:
+        model: The model class to upsert.
+        rows: A dict of key to the defaults for that row.
+        key_fields: A tuple of field attnames that make up the key.
+        previous_fields: Fields whose old value moves to previous_<field>.
+        existing: Optional pre-loaded dict of key to instance.
+        filters: Any extra filters applied when loading existing rows.
+
+    Returns:
+        A dict of key to the saved instance, and the number created.
+    """
+    if existing is None:
+        existing = load_existing(model, key_fields, rows.keys(), **filters)
+    instances = {}
+    to_create = []
+    to_update = []
+    unchanged = 0
+
+    for key, defaults in rows.items():
+        instance = existing.get(key)
+
+        if instance is None:
+            lookup = dict(zip(key_fields, key if len(key_fields) > 1 else (key,)))
+            instance = model(**lookup, **defaults)
+            to_create.append(instance)
+        elif not has_changes(instance, history_values(defaults)):
+            unchanged += 1
+        else:
+            update_fields = history_update_fields(
+                model, changed_fields(instance, defaults), previous_fields)
+            apply_history(instance, defaults, previous_fields)
+            to_update.append((instance, update_fields))
+
+        instances[key] = instance
+
+    bulk_write(model, to_create, to_update, unchanged=unchanged)
+
+    return instances, len(to_create)
+
+
+class PartyIdentityMap:
+    """
+    The Owner, Client and Venue rows resolved so far in a sync run, with the
+    values and tags each was written with.
+
+    The same parties appear on many opportunities, and across every batch
+    of a run: the main listing, the sweep's new opportunities and the
+    one-at-a-time retries after a failed batch. A party already resolved
+    with the same payload is handed out again without being loaded,
+    compared or written. Entries written under a savepoint are staged and
+    only kept once it is released, so a rolled back row is never reused.
+    """
+
+    def __init__(self):
+        self.resolved = {}
+        self.staged = {}
+
+    def get(self, model, current_id, values, tags):
+        """The instance resolved for the same payload this run, or None"""
+        entry = self.resolved.get((model, current_id))
+        if entry is None or entry[1] != (values, tags):
+            return None
+        return entry[0]
+
+    def stage(self, model, current_id, instance, values, tags):
+        self.staged[(model, current_id)] = (instance, (values, tags))
+
+    def commit(self):
+        """Keep the staged entries once their savepoint has been released"""
+        self.resolved.update(self.staged)
+        self.staged.clear()
+
+    def discard(self):
+        """Drop the staged entries after their savepoint was rolled back"""
+        self.staged.clear()
+
+
+@contextmanager
+def party_identity_map():
+    """Share one PartyIdentityMap between every batch synced in the block"""
+    token = _party_map.set(PartyIdentityMap())
+    try:
+        yield _party_map.get()
+    finally:
+        _party_map.reset(token)
+
+
+def upsert_parties(model, rows, parties, tags=None, tag_ids=None):
+    """
+    Upserts the Owner, Client or Venue rows the parties map has not already
+    resolved with the same payload, and reconciles their tags.
+
+    Parameters:
+        model: Owner, Client or Venue.
+        rows: A dict of current_id to the defaults for that row.
+        parties: The PartyIdentityMap for the run.
+        tags: A dict of current_id to tag names, for models with tags.
+        tag_ids: A dict of tag name to Tag pk, from resolve_tags.
+
+    Returns:
+        A dict of current_id to instance for every row.
+    """
+    tags = tags or {}
+    instances = {}
+    pending = {}
+    for current_id, values in rows.items():
+        instance = parties.get(model, current_id, values, tags.get(current_id))
+        if instance is None:
+            pending[current_id] = values
+        else:
+            instances[current_id] = instance
+
+    if len(pending) < len(rows):
+        record(model, cached=len(rows) - len(pending))
+    if not pending:
+        return instances
+
+    written, _ = bulk_upsert(model, pending)
+    instances.update(written)
+    if tags:
+        reconcile_tags(model, {
+            written[current_id].pk: tags[current_id] for current_id in pending
+        }, tag_ids)
+
+    for current_id, values in pending.items():
+        parties.stage(
+            model, current_id, written[current_id], values, tags.get(current_id))
+
+    return instances
+
+
+def sync_active_products(active_products):
+    """Upserts the active Scenic Calc products fetched from Current RMS"""
+    rows = {
+        ap["id"]: {
+            "name": ap.get("name"),
+            "product_type": ap.get("type"),
+            "description": ap.get("description")
+        }
+        for ap in active_products
+    }
+    bulk_upsert(ActiveProducts, rows)
+
+
+def resolve_tags(tag_names):
+    """
+    Returns a dict of tag name to Tag pk for every name given, creating the
+    missing tags in one bulk insert.
+
+    Names longer than a tag name can hold are skipped with a warning.
+    """
+    max_length = Tag._meta.get_field("name").max_length
+    names = set()
+    for name in tag_names:
+        if len(name) > max_length:
+            logger.warning(f"Skipping tag longer than {max_length} characters: {name}")
+            continue
+        names.add(name)
+
+    tag_ids = {}
+    for chunk in chunked(list(names), get_batch_size()):
+        tag_ids.update(
+            Tag.objects.filter(name__in=chunk).values_list("name", "pk"))
+
+    missing = names - tag_ids.keys()
+    if missing:
+        # ignore_conflicts does not return pks on every backend, and another
+        # worker may have created some of these names first, so re-read them
+        Tag.objects.bulk_create(
+            [Tag(name=name) for name in missing],
+            batch_size=get_batch_size(),
+            ignore_conflicts=True,
+        )
+        record(Tag, created=len(missing))
+        for chunk in chunked(list(missing), get_batch_size()):
+            tag_ids.update(
+                Tag.objects.filter(name__in=chunk).values_list("name", "pk"))
+
+    return tag_ids
+
+
+def reconcile_tags(model, assignments, tag_ids):
+    """
+    Brings the tags of many instances in line with the payload, writing only
+    the through rows that were added or removed.
+
+    Parameters:
+        model: A model class with a tags ManyToManyField to Tag.
+        assignments: A dict of instance pk to its list of tag names.
+        tag_ids: A dict of tag name to Tag pk, from resolve_tags.
+    """
+    if not assignments:
+        return
+
+    field = model._meta.get_field("tags")
+    through = field.remote_field.through
+    source = f"{field.m2m_field_name()}_id"
+    target = f"{field.m2m_reverse_field_name()}_id"
+
+    wanted = {
+        pk: {tag_ids[name] for name in names if name in tag_ids}
+        for pk, names in assignments.items()
+    }
+
+    current = defaultdict(dict)
+    for chunk in chunked(list(wanted), get_batch_size()):
+        for through_pk, source_pk, tag_pk in through.objects.filter(
+                **{f"{source}__in": chunk}
+        ).values_list("pk", source, target):
+            current[source_pk][tag_pk] = through_pk
+
+    to_add = []
+    to_remove = []
+    for pk, tag_pks in wanted.items():
+        existing = current[pk]
+        to_add.extend(
+            through(**{source: pk, target: tag_pk})
+            for tag_pk in tag_pks - existing.keys()
+        )
+        to_remove.extend(
+            through_pk for tag_pk, through_pk in existing.items()
+            if tag_pk not in tag_pks
+        )
+
+    record(through, created=len(to_add), deleted=len(to_remove))
+    if to_add:
+        through.objects.bulk_create(
+            to_add, batch_size=get_batch_size(), ignore_conflicts=True)
+    for chunk in chunked(to_remove, get_batch_size()):
+        through.objects.filter(pk__in=chunk).delete()
+
+
+def load_active_product_ids():
+    """
+    Loads the ids of the products that count towards a grand total, once
+    per run, so the per-item checks are set lookups rather than queries.
+    """
+    return frozenset(
+        ActiveProducts.objects.values_list("current_id", flat=True)
+    ) - EXCLUDED_PRODUCT_IDS
+
+
+def build_opportunity_plan(opp_data):
+    """
+    Parses one opportunity payload and its items into plain rows.
+
+    Raises KeyError / TypeError on malformed payloads so the caller can
+    skip the opportunity, as the per-row sync did.
+    """
+    opportunity_data = opp_data.get("opportunity")
+    items = opp_data.get("items", [])
+    owner_data = opportunity_data.get("owner")
+    client_data = opportunity_data.get("member")
+
+    owner = {
+        "current_uuid": owner_data["uuid"],
+        "name": owner_data["name"],
+        "active": owner_data["active"],
+        "bookable": owner_data["bookable"],
+        "membership_id": owner_data["membership_id"],
+        "membership_type": owner_data["membership_type"],
+        "lawful_basis_id": owner_data["lawful_basis_type_id"],
+        "lawful_basis_type_name": owner_data["lawful_basis_type_name"],
+    }
+
+    client = {
+        "current_uuid": client_data["uuid"],
+        "name": client_data["name"],
+        "description": client_data.get("description", ""),
+        "active": client_data["active"],
+    }
+
+    destination = opportunity_data.get("destination") or {}
+    dest = destination.get("address") or {}
+    venue = None
+    if dest:
+        venue = {
+            "name": dest.get("name", ""),
+            "street": dest.get("street", ""),
+            "postcode": dest.get("postcode", ""),
+            "city": dest.get("city", ""),
+            "county": dest.get("county", ""),
+            "country": dest.get("country", ""),
+        }
+
+    opportunity = {
+        "order_number": opportunity_data.get("number", ""),
+        "opportunity_name": opportunity_data.get("subject", ""),
+        "dry_hire": opportunity_data["custom_fields"].get("dry_hire", ""),
+        "dry_hire_transport": opportunity_data["custom_fields"].get("dry_hire_transport", ""),
+        "status": opportunity_data.get("status", ""),
+        "status_name": opportunity_data.get("status_name", ""),
+        "weight_total": parse_decimal_safe(opportunity_data.get("weight_total")),
+        "is_active": True,
+    }
+    for field in (
+        "starts_at", "ends_at", "load_starts_at", "load_ends_at",
+        "deliver_starts_at", "deliver_ends_at", "setup_starts_at",
+        "setup_ends_at", "show_starts_at", "show_ends_at",
+        "takedown_starts_at", "takedown_ends_at", "collect_starts_at",
+        "collect_ends_at", "unload_starts_at", "unload_ends_at",
+    ):
+        opportunity[field] = parse_datetime_safe(opportunity_data.get(field))
+
+    date_out, time_out = set_opp_date_and_time_out(opportunity_data)
+
+    item_rows = {}
+    item_totals = defaultdict(lambda: Decimal("0"))
+    item_names = {}
+
+    for item in items:
+        current_item_id = item["item_id"]
+        name = item["name"].split('-')[0].strip()
+        raw_qty = item.get("quantity")
+        current_quantity = Decimal(raw_qty) / Decimal("2") if raw_qty is not None else Decimal("0")
+        item_totals[current_item_id] += current_quantity
+        item_names[current_item_id] = name
+        item_rows[item["id"]] = {
+            "opportunity_id": item.get("opportunity_id"),
+            "current_item_id": item.get("item_id"),
+            "current_item_type": item.get("item_type", ""),
+            "opportunity_item_type": item.get("opportunity_item_type"),
+            "opportunity_item_type_name": item.get("opportunity_item_type_name", ""),
+            "name": name,
+            "quantity": current_quantity,
+            "description": item.get("description", ""),
+            "is_active": True,
+        }
+
+    return {
+        "current_id": opportunity_data["id"],
+        "owner_id": owner_data["id"],
+        "owner": owner,
+        "owner_tags": owner_data.get("tag_list") or [],
+        "client_id": client_data["id"],
+        "client": client,
+        "client_tags": client_data.get("tag_list") or [],
+        "venue_id": dest["id"] if venue is not None else None,
+        "venue": venue,
+        "opportunity": opportunity,
+        "tags": opportunity_data.get("tag_list") or [],
+        "date_out": date_out,
+        "time_out": time_out,
+        "items": item_rows,
+        "item_totals": dict(item_totals),
+        "item_names": item_names,
+    }
+
+
+def sync_item_rows(plans):
+    """
+    Upserts the individual ScenicCalcItem rows for every planned opportunity.
+
+    previous_quantity comes from the stored quantity of the same product on
+    the same opportunity, keyed on (opportunity_id, current_item_id) and
+    taken from its first active row as loaded before the batch is written.
+    previously_updated_at comes from the row with the same current_id.
+    """
+    rows = {}
+    for plan in plans:
+        rows.update(plan["items"])
+
+    existing = load_existing(ScenicCalcItem, ("current_id",), rows.keys())
+
+    stored_quantities = {}
+    opportunity_ids = list({row["opportunity_id"] for row in rows.values()})
+    for chunk in chunked(opportunity_ids, get_batch_size()):
+        for opportunity_id, current_item_id, quantity in ScenicCalcItem.objects.filter(
+                opportunity_id__in=chunk, is_active=True
+        ).order_by("pk").values_list("opportunity_id", "current_item_id", "quantity"):
+            stored_quantities.setdefault((opportunity_id, current_item_id), quantity)
+
+    for row in rows.values():
+        previous_quantity = stored_quantities.get(
+            (row["opportunity_id"], row["current_item_id"]))
+        current_quantity = row["quantity"]
+        row["previous_quantity"] = (
+            previous_quantity
+            if previous_quantity and previous_quantity != current_quantity
+            else current_quantity
+        )
+
+    bulk_upsert(ScenicCalcItem, rows, existing=existing)
+
+
+def deactivate_stale_items(opportunities, plans):
+    """
+    Deactivates the items and item groups no longer on each opportunity.
+
+    ScenicCalcItem rows hold the Current RMS opportunity id, while the
+    ScenicCalcItems totals point at the Opportunity row, so the two are
+    keyed differently.
+    """
+    api_item_ids = {}
+    item_ids = {}
+    for plan in plans:
+        opportunity = opportunities[plan["current_id"]]
+        api_item_ids[plan["current_id"]] = set(plan["items"])
+        item_ids[opportunity.id] = set(plan["item_totals"])
+
+    stale_item_pks = [
+        pk for pk, opportunity_id, current_id in ScenicCalcItem.objects.filter(
+            opportunity_id__in=list(api_item_ids),
+            is_active=True
+        ).values_list("pk", "opportunity_id", "current_id")
+        if current_id not in api_item_ids[opportunity_id]
+    ]
+    record(ScenicCalcItem, deactivated=len(stale_item_pks))
+    for chunk in chunked(stale_item_pks, get_batch_size()):
+        ScenicCalcItem.objects.filter(pk__in=chunk).update(is_active=False)
+
+    stale_group_pks = [
+        pk for pk, opportunity_id, current_item_id in ScenicCalcItems.objects.filter(
+            opportunity_id__in=list(item_ids),
+            is_active=True
+        ).values_list("pk", "opportunity_id", "current_item_id")
+        if current_item_id not in item_ids[opportunity_id]
+    ]
+    record(ScenicCalcItems, deactivated=len(stale_group_pks))
+    for chunk in chunked(stale_group_pks, get_batch_size()):
+        ScenicCalcItems.objects.filter(pk__in=chunk).update(is_active=False)
+
+
+def sync_item_totals(opportunities, plans, active_product_ids):
+    """
+    Upserts the per-product ScenicCalcItems totals and returns the grand
+    total for each opportunity, keyed by its current_id.
+
+    Only items whose product is in active_product_ids are counted.
+    """
+    rows = {}
+    grand_totals = {}
+    skipped = 0
+
+    for plan in plans:
+        opportunity = opportunities[plan["current_id"]]
+        grand_total = Decimal(0)
+
+        for current_item_id, total_qty in plan["item_totals"].items():
+            name = plan["item_names"][current_item_id]
+            is_valid_item = current_item_id in active_product_ids
+            logger.debug(
+                "Grand total check: opportunity=%s item_id=%s name=%s qty=%s active=%s",
+                plan["current_id"], current_item_id, name, total_qty, is_valid_item)
+
+            if not is_valid_item:
+                skipped += 1
+                continue
+
+            rows[(opportunity.id, current_item_id)] = {
+                "name": name,
+                "item_total": total_qty,
+            }
+            grand_total += total_qty
+
+        grand_totals[plan["current_id"]] = grand_total
+
+    if skipped:
+        logger.debug("Left %s inactive products out of the grand totals", skipped)
+
+    existing = load_existing(
+        ScenicCalcItems, ("opportunity_id", "current_item_id"), rows.keys())
+    to_create = []
+    to_update = []
+    unchanged = 0
+
+    for (opportunity_id, current_item_id), row in rows.items():
+        sci = existing.get((opportunity_id, current_item_id))
+        if sci is None:
+            to_create.append(ScenicCalcItems(
+                opportunity_id=opportunity_id,
+                current_item_id=current_item_id,
+                name=row["name"],
+                item_total=row["item_total"],
+                previous_item_total=row["item_total"],
+            ))
+            continue
+
+        if not has_changes(sci, {"is_active": True, "item_total": row["item_total"]}):
+            unchanged += 1
+            continue
+
+        sci.is_active = True
+        sci.previous_item_total = sci.item_total
+        sci.item_total = row["item_total"]
+        sci.previously_updated_at = sci.updated_at
+        to_update.append((sci, SCENIC_ITEMS_UPDATE_FIELDS))
+
+    bulk_write(ScenicCalcItems, to_create, to_update, unchanged=unchanged)
+
+    return grand_totals
+
+
+def sync_custom_inputs(opportunities, plans, grand_totals):
+    """
+    Upserts the CustomInput for each opportunity and recalculates its
+    working days and start build date from the grand total.
+    """
+    plans_by_opportunity = {
+        opportunities[plan["current_id"]].id: plan for plan in plans
+    }
+    rows = {
+        opportunity_id: {
+            "num_of_carpenters": 1,
+            "include_weekends": False,
+            "built": False,
+            "date_out": plan["date_out"],
+            "time_out": plan["time_out"],
+        }
+        for opportunity_id, plan in plans_by_opportunity.items()
+    }
+
+    def schedule(custom_input, old=None):
+        if old is not None:
+            custom_input.apply_previous_values(old)
+
+        plan = plans_by_opportunity[custom_input.opportunity_id]
+        date_out = plan["date_out"]
+        if not date_out:
+            return
+
+        grand_total = grand_totals[plan["current_id"]]
+        num_of_carpenters = custom_input.num_of_carpenters or 1
+        working_days = calculate_working_days(grand_total, num_of_carpenters)
+        if custom_input.planned_finish_date:
+            start_build_date = create_start_build_date(
+                working_days=working_days or 0,
+                date_out=custom_input.planned_finish_date,
+                include_weekends=custom_input.include_weekends,
+                planned_finish=True
+            )
+        else:
+            start_build_date = create_start_build_date(
+                working_days=working_days or 0,
+                date_out=date_out,
+                include_weekends=custom_input.include_weekends,
+                planned_finish=False
+            )
+
+        custom_input.working_days = Decimal(working_days)
+        custom_input.start_build_date = start_build_date
+
+    existing = load_existing(CustomInput, ("opportunity_id",), rows.keys())
+    to_create = []
+    to_update = []
+    unchanged = 0
+
+    for opportunity_id, defaults in rows.items():
+        custom_input = existing.get(opportunity_id)
+        if custom_input is None:
+            custom_input = CustomInput(opportunity_id=opportunity_id, **defaults)
+            schedule(custom_input)
+            to_create.append(custom_input)
+            continue
+
+        old = copy.copy(custom_input)
+        apply_history(custom_input, defaults, CUSTOM_INPUT_PREVIOUS_FIELDS)
+        schedule(custom_input, old)
+        if not has_changes(old, {
+            field: getattr(custom_input, field) for field in CUSTOM_INPUT_VALUE_FIELDS
+        }):
+            unchanged += 1
+            continue
+        to_update.append((custom_input, CUSTOM_INPUT_UPDATE_FIELDS))
+
+    bulk_write(CustomInput, to_create, to_update, unchanged=unchanged)
+
+
+def sync_opportunities(opportunities_with_items, failed_ids=None):
+    """
+    Upserts a batch of opportunities and everything hanging off them.
+
+    The batch is written under one savepoint. If that write fails, the
+    batch is rolled back and each opportunity is written again under its
+    own savepoint, so one bad record is skipped without losing the rest.
+
+    Parameters:
+        opportunities_with_items: A list of {'opportunity', 'items'} dicts
+            as returned by get_opps_with_items.
+        failed_ids: An optional set the current_ids of the opportunities
+            that were skipped or failed to write are added to, so the
+            caller can hold its watermark back for them.
+
+    Returns:
+        The set of current_ids that were synced, including any whose items
+        could not be fetched or that failed to write and were left untouched.
+    """
+    if failed_ids is None:
+        failed_ids = set()
+
+    plans = []
+    unchanged_ids = set()
+    for opp_data in opportunities_with_items:
+        opportunity_id = (opp_data.get("opportunity") or {}).get("id")
+        if opp_data.get("items") is None:
+            # The item fetch failed, so keep the stored rows as they are
+            # rather than treating the opportunity as missing
+            logger.warning(f"Skipping Opportunity {opportunity_id}: items unavailable")
+            if opportunity_id is not None:
+                unchanged_ids.add(opportunity_id)
+                failed_ids.add(opportunity_id)
+            continue
+        try:
+            plans.append(build_opportunity_plan(opp_data))
+        except Exception as e:
+            logger.error(f"Failed to create Opportunity {opportunity_id}: {e}")
+            if opportunity_id is not None:
+                failed_ids.add(opportunity_id)
+
+    if not plans:
+        return unchanged_ids
+
+    # Outside a run's party_identity_map the parties are only shared
+    # within this call
+    parties = _party_map.get() or PartyIdentityMap()
+
+    try:
+        with transaction.atomic():
+            synced_ids = write_opportunity_plans(plans, parties)
+        parties.commit()
+        return synced_ids | unchanged_ids
+    except Exception as e:
+        parties.discard()
+        logger.error(f"Batch write of {len(plans)} opportunities failed, retrying one at a time: {e}")
+
+    for plan in plans:
+        try:
+            with transaction.atomic():
+                write_opportunity_plans([plan], parties)
+            parties.commit()
+        except Exception as e:
+            parties.discard()
+            failed_ids.add(plan["current_id"])
+            logger.error(f"Failed to write Opportunity {plan['current_id']}: {e}")
+
+    # Opportunities that failed to write are left as stored rather than
+    # deactivated as missing
+    return {plan["current_id"] for plan in plans} | unchanged_ids
+
+
+def write_opportunity_plans(plans, parties):
+    """
+    Writes parsed opportunity plans and everything hanging off them,
+    returning the set of current_ids written.
+
+    The owners, clients and venues are resolved through the run's
+    PartyIdentityMap, so each distinct current_id is written at most once
+    per run unless its payload changes.
+    """
+    # Every tag seen in the batch is resolved at once, and each object only
+    # gains or loses the tags that changed
+    with phase("write_tags"):
+        tag_ids = resolve_tags(
+            name
+            for plan in plans
+            for name in (*plan["owner_tags"], *plan["client_tags"], *plan["tags"])
+        )
+
+    with phase("write_parties"):
+        owners = upsert_parties(
+            Owner,
+            {plan["owner_id"]: plan["owner"] for plan in plans},
+            parties,
+            tags={plan["owner_id"]: plan["owner_tags"] for plan in plans},
+            tag_ids=tag_ids)
+        clients = upsert_parties(
+            Client,
+            {plan["client_id"]: plan["client"] for plan in plans},
+            parties,
+            tags={plan["client_id"]: plan["client_tags"] for plan in plans},
+            tag_ids=tag_ids)
+        venues = upsert_parties(
+            Venue, {
+                plan["venue_id"]: plan["venue"]
+                for plan in plans if plan["venue"] is not None
+            }, parties)
+
+    opportunity_rows = {}
+    for plan in plans:
+        opportunity_rows[plan["current_id"]] = {
+            "owner": owners[plan["owner_id"]],
+            "client": clients[plan["client_id"]],
+            "venue": venues.get(plan["venue_id"]),
+            **plan["opportunity"],
+        }
+
+    with phase("write_opportunities"):
+        opportunities, _ = bulk_upsert(
+            Opportunity,
+            opportunity_rows,
+            previous_fields=OPPORTUNITY_PREVIOUS_FIELDS,
+        )
+
+    with phase("write_tags"):
+        reconcile_tags(Opportunity, {
+            opportunities[plan["current_id"]].pk: plan["tags"] for plan in plans
+        }, tag_ids)
+
+    with phase("write_items"):
+        sync_item_rows(plans)
+        grand_totals = sync_item_totals(
+            opportunities, plans, load_active_product_ids())
+        deactivate_stale_items(opportunities, plans)
+
+    with phase("write_totals"):
+        bulk_upsert(
+            ScenicCalcTotal,
+            {
+                opportunities[current_id].id: {
+                    "grand_total": grand_total,
+                    "is_active": True,
+                }
+                for current_id, grand_total in grand_totals.items()
+            },
+            key_fields=("opportunity_id",),
+            previous_fields=SCENIC_TOTAL_PREVIOUS_FIELDS,
+        )
+
+        sync_custom_inputs(opportunities, plans, grand_totals)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for plan in plans:
+            opportunity = opportunities[plan["current_id"]]
+            logger.debug(
+                "Processed Opportunity: %s (%s) - Grand Total: %s, items: %s",
+                opportunity.opportunity_name, opportunity.current_id,
+                grand_totals[plan["current_id"]], len(plan["items"]))
+
+    return set(opportunities)
+
+
+def deactivate_missing_opportunities(seen_opportunity_ids):
+    """Marks every active opportunity not seen in this run as inactive"""
+    count = deactivate_opportunities(
+        Opportunity.objects.exclude(current_id__in=seen_opportunity_ids))
+    logger.info("Marked %s opportunities as inactive (missing from API)", count)
+    return count
+
+
+def deactivate_opportunities(opportunities):
+    """
+    Marks the active opportunities in a queryset inactive, along with their
+    items and totals, returning how many were deactivated
+    """
+    inactive_opps = opportunities.filter(is_active=True)
+    inactive_ids, inactive_current_ids = [], []
+    for pk, current_id in inactive_opps.values_list("id", "current_id"):
+        inactive_ids.append(pk)
+        inactive_current_ids.append(current_id)
+    count = inactive_opps.update(is_active=False)
+    record(Opportunity, deactivated=count)
+
+    # Items are keyed by the Current RMS opportunity id, not the row's pk
+    ScenicCalcItem.objects.filter(
+        opportunity_id__in=inactive_current_ids
+    ).update(is_active=False)
+
+    ScenicCalcItems.objects.filter(
+        opportunity_id__in=inactive_ids
+    ).update(is_active=False)
+
+    ScenicCalcTotal.objects.filter(
+        opportunity_id__in=inactive_ids
+    ).update(is_active=False)
+
+    return count
+
+
+def fetch_sweep(days, exclude_ids=()):
+    """
+    Fetches what the sweep needs from the API, without writing anything.
+
+    The incremental sync only sees opportunities that changed, so the sweep
+    catches the rest: opportunities that entered the window without being
+    edited are synced in full, and those that left the window or the
+    synced statuses are deactivated. Items are only fetched for
+    opportunities that are not already stored or in exclude_ids, the ones
+    this run is syncing anyway.
+
+    The Current RMS listing cannot be narrowed down to ids, so the sweep
+    pages through the window's full records. Only their ids are compared,
+    and the records are what the new opportunities are synced from.
+
+    Returns:
+        The set of current_ids listed in the window and the new
+        opportunities with their items.
+    """
+    opportunities = fetch_opportunities_within_date(days=days)
+    listed_ids = {opportunity["id"] for opportunity in opportunities}
+    new_opportunities = unstored_opportunities(opportunities, exclude_ids)
+
+    return listed_ids, get_opps_with_items(new_opportunities)
+
+
+def unstored_opportunities(opportunities, exclude_ids=()):
+    """
+    Returns the listed opportunities that are not stored as active, leaving
+    out those in exclude_ids
+    """
+    listed_ids = {opportunity["id"] for opportunity in opportunities}
+    known_ids = set(exclude_ids)
+    for chunk in chunked(list(listed_ids - known_ids), get_batch_size()):
+        known_ids.update(Opportunity.objects.filter(
+            current_id__in=chunk, is_active=True
+        ).values_list("current_id", flat=True))
+
+    return [
+        opportunity for opportunity in opportunities
+        if opportunity["id"] not in known_ids
+    ]
+
+
+def apply_sweep(listed_ids, new_opportunities_with_items):
+    """
+    Writes the result of fetch_sweep.
+
+    Returns:
+        The number of new opportunities synced and the number deactivated.
+    """
+    if new_opportunities_with_items:
+        sync_opportunities(new_opportunities_with_items)
+
+    deactivated = deactivate_missing_opportunities(listed_ids)
+    logger.info(
+        f"Sweep found {len(new_opportunities_with_items)} new opportunities, "
+        f"deactivated {deactivated}")
+
+    return len(new_opportunities_with_items), deactivated
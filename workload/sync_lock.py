@@ -0,0 +1,266 @@
+"""
+Single-flight locking for the workshop workload sync.
+
+Only one sync may run at a time. The lock is a token held in Redis under a
+lease that a heartbeat keeps renewing while the run is alive. A worker
+that dies stops renewing, so the lease runs out and the next trigger can
+run. Renewing and letting go compare the token and act on it in one Lua
+script, so a run whose lease has already run out can never extend or
+delete a lock another run has since taken.
+
+A trigger that finds the lock held records a follow-up request instead of
+running. However many triggers arrive during a run, they are merged into
+one request, held in a Redis hash and merged by a Lua script so no
+concurrent request is lost, which the run dispatches once it lets go of
+the lock. The request outlives the lease by FOLLOW_UP_LEASES, and every
+renewal of the lock refreshes it too, so it lasts however long the run
+takes.
+
+Without SYNC_LOCK_REDIS_URL the lock falls back to the Django cache behind
+a process-wide mutex. That is only single-flight within one process, since
+the cache is then per-process memory, so a warning is logged when it is
+used.
+"""
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import SyncRun
+
+logger = logging.getLogger(__name__)
+
+SYNC_LOCK_KEY = "workload:sync:lock"
+FOLLOW_UP_KEY = "workload:sync:follow_up"
+# Leases a follow-up request is kept for after the last renewal of the lock
+FOLLOW_UP_LEASES = 4
+
+# KEYS[1] the lock, KEYS[2] the follow-up hash, ARGV[1] the token, ARGV[2]
+# the lease in milliseconds, ARGV[3] the follow-up timeout in milliseconds
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[2], ARGV[3])
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1] the lock, ARGV[1] the token
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] the follow-up hash, ARGV[1] days, ARGV[2] mode, ARGV[3] "1" if
+# sharded, ARGV[4] the full mode, ARGV[5] the timeout in seconds
+MERGE_FOLLOW_UP_SCRIPT = """
+local days = tonumber(redis.call('hget', KEYS[1], 'days') or '0')
+if tonumber(ARGV[1]) > days then
+    redis.call('hset', KEYS[1], 'days', ARGV[1])
+end
+if ARGV[2] == ARGV[4] or not redis.call('hget', KEYS[1], 'mode') then
+    redis.call('hset', KEYS[1], 'mode', ARGV[2])
+end
+if ARGV[3] == '1' or not redis.call('hget', KEYS[1], 'sharded') then
+    redis.call('hset', KEYS[1], 'sharded', ARGV[3])
+end
+redis.call('expire', KEYS[1], ARGV[5])
+return 1
+"""
+
+
+class SyncLockLost(Exception):
+    """Raised when a sync finds its lease has run out and another run may hold the lock"""
+
+
+class RedisLockStore:
+    """Keeps the lock and the follow-up request in Redis, see the module docstring"""
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, **settings.REDIS_SSL_OPTIONS)
+        self.renew_script = self.client.register_script(RENEW_SCRIPT)
+        self.release_script = self.client.register_script(RELEASE_SCRIPT)
+        self.merge_script = self.client.register_script(MERGE_FOLLOW_UP_SCRIPT)
+
+    def acquire(self, token, lease):
+        return bool(self.client.set(SYNC_LOCK_KEY, token, nx=True, px=int(lease * 1000)))
+
+    def holder(self):
+        token = self.client.get(SYNC_LOCK_KEY)
+        return token.decode() if token is not None else None
+
+    def renew(self, token, lease):
+        return bool(self.renew_script(
+            keys=[SYNC_LOCK_KEY, FOLLOW_UP_KEY],
+            args=[token, int(lease * 1000), int(lease * FOLLOW_UP_LEASES * 1000)]))
+
+    def release(self, token):
+        self.release_script(keys=[SYNC_LOCK_KEY], args=[token])
+
+    def merge_follow_up(self, days, mode, sharded, timeout):
+        self.merge_script(keys=[FOLLOW_UP_KEY], args=[
+            days, mode, "1" if sharded else "0", SyncRun.MODE_FULL, timeout])
+
+    def pop_follow_up(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(FOLLOW_UP_KEY)
+        pipe.delete(FOLLOW_UP_KEY)
+        follow_up, _ = pipe.execute()
+        if not follow_up:
+            return None
+        follow_up = {key.decode(): value.decode() for key, value in follow_up.items()}
+        return {
+            "days": int(follow_up["days"]),
+            "mode": follow_up["mode"],
+            "sharded": follow_up["sharded"] == "1",
+        }
+
+
+class CacheLockStore:
+    """
+    Keeps the lock and the follow-up request in the Django cache, each
+    compare-and-act step made atomic by a process-wide mutex. Only
+    single-flight within this process, see the module docstring.
+    """
+
+    mutex = threading.Lock()
+
+    def acquire(self, token, lease):
+        return cache.add(SYNC_LOCK_KEY, token, timeout=lease)
+
+    def holder(self):
+        return cache.get(SYNC_LOCK_KEY)
+
+    def renew(self, token, lease):
+        with self.mutex:
+            if cache.get(SYNC_LOCK_KEY) != token:
+                return False
+            cache.touch(FOLLOW_UP_KEY, lease * FOLLOW_UP_LEASES)
+            return cache.touch(SYNC_LOCK_KEY, lease)
+
+    def release(self, token):
+        with self.mutex:
+            if cache.get(SYNC_LOCK_KEY) == token:
+                cache.delete(SYNC_LOCK_KEY)
+
+    def merge_follow_up(self, days, mode, sharded, timeout):
+        with self.mutex:
+            waiting = cache.get(FOLLOW_UP_KEY)
+            if waiting is not None:
+                days = max(days, waiting["days"])
+                if waiting["mode"] == SyncRun.MODE_FULL:
+                    mode = SyncRun.MODE_FULL
+                sharded = sharded or waiting["sharded"]
+            cache.set(
+                FOLLOW_UP_KEY, {"days": days, "mode": mode, "sharded": sharded},
+                timeout=timeout)
+
+    def pop_follow_up(self):
+        with self.mutex:
+            follow_up = cache.get(FOLLOW_UP_KEY)
+            if follow_up is not None:
+                cache.delete(FOLLOW_UP_KEY)
+            return follow_up
+
+
+_store = None
+_store_url = None
+_store_lock = threading.Lock()
+
+
+def get_lock_store():
+    """
+    Get the store the lock lives in: Redis when SYNC_LOCK_REDIS_URL is
+    set, otherwise the per-process cache with a warning
+    """
+    global _store, _store_url
+    url = settings.SYNC_LOCK_REDIS_URL
+    with _store_lock:
+        if _store is None or _store_url != url:
+            if url:
+                _store = RedisLockStore(url)
+            else:
+                logger.warning(
+                    "SYNC_LOCK_REDIS_URL is not set, so the sync lock only keeps "
+                    "syncs in this process from overlapping")
+                _store = CacheLockStore()
+            _store_url = url
+    return _store
+
+
+class SyncLock:
+    """
+    The single-flight lock for one sync run.
+
+    Parameters:
+    - token: The token of a lock already acquired elsewhere, for the
+    shard tasks of a sharded run. A new token is made when not given.
+    - lease: Seconds the lock is held without a renewal, defaults to
+    settings.SYNC_LOCK_LEASE_SECONDS
+    """
+
+    def __init__(self, token=None, lease=None):
+        self.token = token or uuid.uuid4().hex
+        self.lease = lease or settings.SYNC_LOCK_LEASE_SECONDS
+        self.store = get_lock_store()
+
+    def acquire(self):
+        """Take the lock if nobody holds it, returning whether it was taken"""
+        return self.store.acquire(self.token, self.lease)
+
+    def held(self):
+        return self.store.holder() == self.token
+
+    def renew(self):
+        """Extend the lease if the lock is still ours, returning whether it was"""
+        return self.store.renew(self.token, self.lease)
+
+    def ensure_held(self):
+        """Raise SyncLockLost unless the lock is still ours"""
+        if not self.renew():
+            raise SyncLockLost(f"Sync lock {self.token} is no longer held")
+
+    def release(self):
+        """Let go of the lock if it is still ours"""
+        self.store.release(self.token)
+
+    @contextmanager
+    def heartbeat(self):
+        """Renew the lease from a background thread while the block runs"""
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.lease / 3):
+                if not self.renew():
+                    logger.warning("Sync lock %s was lost before the run finished", self.token)
+                    return
+
+        thread = threading.Thread(target=beat, name="sync-lock-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+
+
+def request_follow_up(days, mode, sharded=False):
+    """
+    Record that a sync was asked for while another held the lock, merged
+    with any request already waiting: a full sync wins over an incremental
+    one and the widest window is kept, and a sharded run wins over a
+    single-task one
+    """
+    get_lock_store().merge_follow_up(
+        days, mode, sharded, timeout=settings.SYNC_LOCK_LEASE_SECONDS * FOLLOW_UP_LEASES)
+
+
+def pop_follow_up():
+    """Take the waiting follow-up request, or None if there is none"""
+    return get_lock_store().pop_follow_up()
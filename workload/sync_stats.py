@@ -0,0 +1,173 @@
+"""
+Per-run instrumentation for the workshop workload sync.
+
+While a run is collecting, the sync records how many rows of each model it
+created, updated, found unchanged or deactivated, how long each phase
+took, the HTTP calls and bytes it exchanged with Current RMS and the
+queries it ran per model. The task logs them as one summary record and
+stores them on the SyncRun.
+
+The run in progress is held in a context variable. Work handed to a thread
+pool must be submitted with submit_in_context so it is counted too.
+"""
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+
+from django.apps import apps
+from django.db import connection
+
+_current_stats = ContextVar("sync_stats", default=None)
+
+_TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE)
+_table_labels = None
+
+
+def table_label(sql):
+    """The model a SQL statement touches first, or 'other'"""
+    global _table_labels
+    if _table_labels is None:
+        _table_labels = {
+            model._meta.db_table: model.__name__
+            for model in apps.get_models(include_auto_created=True)
+        }
+    match = _TABLE_PATTERN.search(sql)
+    if match is None:
+        return "other"
+    return _table_labels.get(match.group(1), match.group(1))
+
+
+class SyncStats:
+    """
+    Row counts per model by outcome, phase timings, HTTP and query counters
+    for one sync run. Safe to update from worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(Counter)
+        self.phases = Counter()
+        self.http = Counter()
+        self.queries = Counter()
+        self.query_seconds = 0.0
+
+    def record(self, model, **counts):
+        with self.lock:
+            self.counts[model.__name__].update(counts)
+
+    def record_http(self, size, failed=False):
+        with self.lock:
+            self.http["calls"] += 1
+            self.http["bytes"] += size
+            if failed:
+                self.http["failed"] += 1
+
+    def record_query(self, label, seconds):
+        with self.lock:
+            self.queries[label] += 1
+            self.query_seconds += seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to the named phase"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] += time.perf_counter() - started
+
+    def merge(self, metrics):
+        """
+        Add in the counters of another run's as_dict(), such as one shard
+        of a sharded run. Phase timings add up to worker time rather than
+        wall time.
+        """
+        with self.lock:
+            for name, counts in metrics.get("rows", {}).items():
+                self.counts[name].update(counts)
+            self.phases.update(metrics.get("phases", {}))
+            self.http.update(metrics.get("http", {}))
+            self.queries.update(metrics.get("queries", {}))
+            self.query_seconds += metrics.get("query_seconds", 0)
+
+    def as_dict(self):
+        return {
+            "rows": {
+                name: dict(sorted(counts.items()))
+                for name, counts in sorted(self.counts.items())
+            },
+            "phases": {
+                name: round(seconds, 3) for name, seconds in self.phases.items()
+            },
+            "http": dict(self.http),
+            "queries": dict(sorted(self.queries.items())),
+            "query_count": sum(self.queries.values()),
+            "query_seconds": round(self.query_seconds, 3),
+        }
+
+    def __str__(self):
+        rows = "; ".join(
+            f"{name} " + " ".join(f"{outcome}={count}" for outcome, count in counts.items())
+            for name, counts in self.as_dict()["rows"].items()
+        ) or "nothing written"
+        return (
+            f"{rows} | {self.http['calls']} HTTP calls, "
+            f"{sum(self.queries.values())} queries"
+        )
+
+
+@contextmanager
+def collect_sync_stats():
+    """
+    Collect the counts recorded while the block runs into a new SyncStats,
+    counting the queries made on this thread's database connection
+    """
+    stats = SyncStats()
+    token = _current_stats.set(stats)
+
+    def count_query(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats.record_query(table_label(sql), time.perf_counter() - started)
+
+    try:
+        with connection.execute_wrapper(count_query):
+            yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def record(model, **counts):
+    """Add to the row counts of the run in progress, if there is one"""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(model, **counts)
+
+
+def record_http(size, failed=False):
+    """Count an HTTP call against the run in progress, if there is one"""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record_http(size, failed=failed)
+
+
+def phase(name):
+    """Time the block as the named phase of the run in progress, if there is one"""
+    stats = _current_stats.get()
+    if stats is None:
+        return nullcontext()
+    return stats.phase(name)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    Submit fn to a thread pool in a copy of the caller's context, so what it
+    records is counted against the caller's run
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
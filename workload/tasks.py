@@ -1,360 +1,557 @@
-from celery import shared_task
-from collections import defaultdict
+from celery import chord, shared_task
+from .api_calls import get_opportunity, get_opportunity_items, OpportunityNotFound
 from .utils import (
     fetch_workload_data,
-    parse_datetime_safe,
-    parse_decimal_safe,
-    get_previous_updated_at,
-    assign_tags,
-    calculate_working_days,
-    set_opp_date_and_time_out,
-    create_start_build_date,
-    update_model_with_history
+    in_sync_scope,
+    fetch_workload_listings,
+    fetch_opportunities_within_date,
+    get_opps_with_items,
+    latest_updated_at,
+    hold_back_watermark,
+    refresh_workload_summary,
+    publish_workshop_snapshot
 )
-from .models import (
-    Owner,
-    Client,
-    Opportunity,
-    Venue,
-    ScenicCalcItems,
-    ScenicCalcItem,
-    ScenicCalcTotal,
-    ActiveProducts,
-    CustomInput
+from .sync import (
+    sync_active_products,
+    sync_opportunities,
+    deactivate_missing_opportunities,
+    deactivate_opportunities,
+    fetch_sweep,
+    apply_sweep,
+    unstored_opportunities,
+    party_identity_map,
+    chunked
 )
+from .sync_stats import collect_sync_stats, phase
+from .sync_lock import SyncLock, request_follow_up, pop_follow_up
+from .webhooks import clear_resync
+from .models import Opportunity, SyncRun
 from django_celery_results.models import TaskResult
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
-from decimal import Decimal
-from datetime import timedelta, datetime
-from django.db.models import Sum, F
+from datetime import timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
+WATERMARK_OVERLAP = timedelta(minutes=1)
+RESYNC_MAX_RETRY_DELAY = 600
+
+def get_watermark_run():
+    """Get the latest successful sync run that recorded a watermark"""
+    return SyncRun.objects.filter(
+        status=SyncRun.STATUS_SUCCESS, watermark__isnull=False).first()
+
+
+def sweep_due():
+    """Check whether the last sweep is older than the sweep interval"""
+    last_sweep = SyncRun.objects.filter(
+        status=SyncRun.STATUS_SUCCESS, swept=True).first()
+    if last_sweep is None:
+        return True
+    interval = timedelta(minutes=settings.SYNC_SWEEP_INTERVAL_MINUTES)
+    return last_sweep.started_at < timezone.now() - interval
+
+
+def claim_sync(lock, days, mode, sharded=False):
+    """
+    Take the single-flight sync lock, or leave a follow-up request for the
+    run holding it.
+
+    Returns:
+    - The days and mode to run with, or None if the call was coalesced
+    into the follow-up of the run in progress, or handed to the other kind
+    of sync task because a merged request asked for a sharded run
+    """
+    if lock.acquire():
+        return days, mode
+
+    request_follow_up(days, mode, sharded)
+    # The holder may have let go in the meantime, missing the request
+    if not lock.acquire():
+        logger.info("A sync is already running, coalesced into its follow-up run")
+        return None
+
+    follow_up = pop_follow_up() or {"days": days, "mode": mode, "sharded": sharded}
+    if follow_up["sharded"] != sharded:
+        # The merged request, ours included, needs the other task to run it
+        request_follow_up(follow_up["days"], follow_up["mode"], follow_up["sharded"])
+        lock.release()
+        dispatch_follow_up()
+        return None
+    return follow_up["days"], follow_up["mode"]
+
+
+def dispatch_follow_up():
+    """Queue the one follow-up run asked for while the lock was held, if any"""
+    follow_up = pop_follow_up()
+    if follow_up is None:
+        return
+
+    task = fetch_workshop_workload_sharded if follow_up["sharded"] else fetch_workshop_workload
+    task.delay(follow_up["days"], mode=follow_up["mode"])
+    logger.info("Queued the follow-up %s sync asked for during the run", follow_up["mode"])
+
+
 @shared_task(name='fetch_workshop_workload_task')
-def fetch_workshop_workload(days):
-    """Celery task to fetch workload data asynchronously."""
-    logger.info(f"Running Celery Task with days={days}")
-    data = fetch_workload_data(days=days)
-    
-    seen_opportunity_ids = set()
-    opportunities = data.get("opportunities_with_items", [])
-    print(f"Total Opportunities: {len(opportunities)}")
-
-    active_products = data.get("active_products")
-    print(f"Total Active Products: {len(active_products)}")
-
-    for ap in active_products:
-        active_product, _ = ActiveProducts.objects.update_or_create(
-            current_id=ap["id"],
-            defaults={
-                "name": ap.get("name"),
-                "product_type": ap.get("type"),
-                "description": ap.get("description")
-            }
-        )
-    
-    logger.info("Finished processing active products.")
-
-    for opp_data in opportunities:
-        opportunity_data = opp_data.get("opportunity")
-        items = opp_data.get("items", [])
-        owner_data = opportunity_data.get("owner")
-        client_data = opportunity_data.get("member")
-
-        # Owner
-        try:
-            owner, _ = Owner.objects.update_or_create(
-                current_id=owner_data["id"],
-                defaults={
-                    "current_uuid": owner_data["uuid"],
-                    "name": owner_data["name"],
-                    "active": owner_data["active"],
-                    "bookable": owner_data["bookable"],
-                    "membership_id": owner_data["membership_id"],
-                    "membership_type": owner_data["membership_type"],
-                    "lawful_basis_id": owner_data["lawful_basis_type_id"],
-                    "lawful_basis_type_name": owner_data["lawful_basis_type_name"],
-                },
-            )
-            assign_tags(owner, owner_data.get("tag_list", []))
-        except Exception as e:
-            logger.error(f"Failed to create owner {owner_data['id']}: {e}")
-            continue
-
-        # Client
-        try:
-            client, _ = Client.objects.update_or_create(
-                current_id=client_data["id"],
-                defaults={
-                    "current_uuid": client_data["uuid"],
-                    "name": client_data["name"],
-                    "description": client_data.get("description", ""),
-                    "active": client_data["active"],
-                },
-            )
-            assign_tags(client, client_data.get("tag_list", []))
-        except Exception as e:
-            logger.error(f"Failed to create client {client_data['id']}: {e}")
-            continue
-
-        # Venue
-        destination = opportunity_data.get("destination") or {}
-        dest = destination.get("address") or {}
-        venue = None
-        if dest:
-            venue, _ = Venue.objects.update_or_create(
-                current_id=dest["id"],
-                defaults={
-                    "name": dest.get("name", ""),
-                    "street": dest.get("street", ""),
-                    "postcode": dest.get("postcode", ""),
-                    "city": dest.get("city", ""),
-                    "county": dest.get("county", ""),
-                    "country": dest.get("country", ""),
-                }
-            )
-        
-        # Opportunity
+def fetch_workshop_workload(days, mode=SyncRun.MODE_FULL):
+    """
+    Celery task to fetch workload data asynchronously.
+
+    mode='full' re-downloads every opportunity in the window and
+    deactivates the rest. mode='incremental' only asks for opportunities
+    updated since the last run's watermark, running the sweep when it
+    is due, and falls back to a full sync when there is no watermark yet.
+
+    Only one sync runs at a time. A call made while another holds the
+    sync lock returns straight away, and all such calls are merged into
+    one follow-up run queued when the lock is let go.
+    """
+    lock = SyncLock()
+    claimed = claim_sync(lock, days, mode)
+    if claimed is None:
+        return {"status": "coalesced", "mode": mode}
+    days, mode = claimed
+
+    try:
+        with lock.heartbeat():
+            return run_workshop_sync(days, mode, lock)
+    finally:
+        lock.release()
+        dispatch_follow_up()
+
+
+def run_workshop_sync(days, mode, lock):
+    """Run one sync while holding the sync lock, see fetch_workshop_workload"""
+    previous_run = get_watermark_run()
+    if mode == SyncRun.MODE_INCREMENTAL and previous_run is None:
+        logger.info("No sync watermark recorded, running a full sync")
+        mode = SyncRun.MODE_FULL
+
+    logger.info("Running Celery Task with days=%s, mode=%s", days, mode)
+    run = SyncRun.objects.create(mode=mode, days=days)
+
+    with collect_sync_stats() as stats, party_identity_map():
         try:
-            opportunity, created = update_model_with_history(
-                model=Opportunity,
-                lookup={"current_id": opportunity_data["id"]},
-                defaults={
-                    "owner": owner,
-                    "client": client,
-                    "order_number": opportunity_data.get("number", ""),
-                    "opportunity_name": opportunity_data.get("subject", ""),
-                    "dry_hire": opportunity_data["custom_fields"].get("dry_hire", ""),
-                    "dry_hire_transport": opportunity_data["custom_fields"].get("dry_hire_transport", ""),
-                    "status": opportunity_data.get("status", ""),
-                    "status_name": opportunity_data.get("status_name", ""),
-                    "starts_at": parse_datetime_safe(opportunity_data.get("starts_at")),
-                    "ends_at": parse_datetime_safe(opportunity_data.get("ends_at")),
-                    "load_starts_at": parse_datetime_safe(opportunity_data.get("load_starts_at")),
-                    "load_ends_at": parse_datetime_safe(opportunity_data.get("load_ends_at")),
-                    "deliver_starts_at": parse_datetime_safe(opportunity_data.get("deliver_starts_at")),
-                    "deliver_ends_at": parse_datetime_safe(opportunity_data.get("deliver_ends_at")),
-                    "setup_starts_at": parse_datetime_safe(opportunity_data.get("setup_starts_at")),
-                    "setup_ends_at": parse_datetime_safe(opportunity_data.get("setup_ends_at")),
-                    "show_starts_at": parse_datetime_safe(opportunity_data.get("show_starts_at")),
-                    "show_ends_at": parse_datetime_safe(opportunity_data.get("show_ends_at")),
-                    "takedown_starts_at": parse_datetime_safe(opportunity_data.get("takedown_starts_at")),
-                    "takedown_ends_at": parse_datetime_safe(opportunity_data.get("takedown_ends_at")),
-                    "collect_starts_at": parse_datetime_safe(opportunity_data.get("collect_starts_at")),
-                    "collect_ends_at": parse_datetime_safe(opportunity_data.get("collect_ends_at")),
-                    "unload_starts_at": parse_datetime_safe(opportunity_data.get("unload_starts_at")),
-                    "unload_ends_at": parse_datetime_safe(opportunity_data.get("unload_ends_at")),
-                    "weight_total": parse_decimal_safe(opportunity_data.get("weight_total")),
-                    "venue": venue,
-                },
-                previous_fields=["opportunity_name", "status_name"],
-            )
-            
-            assign_tags(opportunity, opportunity_data.get("tag_list", []))
-
-            date_out, time_out = set_opp_date_and_time_out(opportunity_data)
-
-            custom_input, created = update_model_with_history(
-                model=CustomInput,
-                lookup={"opportunity": opportunity},
-                defaults={
-                    "num_of_carpenters": 1,
-                    "include_weekends": False,
-                    "built": False,
-                    "date_out": date_out,
-                    "time_out": time_out,
-                },
-                previous_fields=["date_out", "time_out"]
-            )
-
-            seen_opportunity_ids.add(opportunity.current_id)
-
-            if not opportunity.is_active:
-                opportunity.is_active = True
-                opportunity.save(update_fields=["is_active"])
-
-        except Exception as e:
-            logger.error(f"Failed to create Opportunity {opportunity_data['id']}: {e}")
-            continue
-
-        item_totals = defaultdict(lambda: Decimal("0"))
-        item_names = {}
-        api_item_ids = set()
-
-        for item in items:
-            current_item_id = item["item_id"]
-            name = item["name"].split('-')[0].strip()
-            raw_qty = item.get("quantity")
-            current_quantity = Decimal(raw_qty) / Decimal("2") if raw_qty is not None else Decimal("0")
-            item_totals[current_item_id] += current_quantity
-            item_names[current_item_id] = name
-            existing_item = ScenicCalcItem.objects.filter(
-                opportunity_id=item.get("opportunity_id"),
-                current_item_id=current_item_id,
-                is_active=True
-            ).first()
-            previous_quantity = existing_item.quantity if existing_item else None
-            previous_updated_at_itm = get_previous_updated_at(ScenicCalcItem, {"current_id": item["id"]})
-            api_item_ids.add(item["id"])
-
-            # Scenic Calc Individual Items
-            try:
-                sci_item, created = ScenicCalcItem.objects.update_or_create(
-                    current_id=item["id"],
-                    defaults={
-                        "opportunity_id": item.get("opportunity_id"),
-                        "current_item_id": item.get("item_id"),
-                        "current_item_type": item.get("item_type", ""),
-                        "opportunity_item_type": item.get("opportunity_item_type"),
-                        "opportunity_item_type_name": item.get("opportunity_item_type_name", ""),
-                        "name": name,
-                        "quantity": current_quantity,
-                        "previous_quantity": previous_quantity if previous_quantity and previous_quantity != current_quantity else current_quantity,
-                        "description": item.get("description", ""),
-                        "previously_updated_at": previous_updated_at_itm
-                    },
-                )
-
-                if not sci_item.is_active:
-                    sci_item.is_active = True
-                    sci_item.save(update_fields=["is_active"])
-
-            except Exception as e:
-                logger.error(f"Failed to create ScenicCalcItem for {item['id']}: {e}")
-                continue
-        
-        stale_items = ScenicCalcItem.objects.filter(
-            opportunity_id=opportunity.id,
-            is_active=True
-        ).exclude(
-            current_id__in=api_item_ids
-        )
-
-        stale_items.update(is_active=False)
-
-        grand_total = Decimal(0)
-
-        for current_item_id, total_qty in item_totals.items():
-            name = item_names[current_item_id]
-            is_valid_item = (
-                current_item_id != 4977
-                and ActiveProducts.objects.filter(current_id=current_item_id).exists()
-            )
-            logger.warning(
-                f"GRAND TOTAL CHECK → "
-                f"item_id={current_item_id}, "
-                f"name={name}, "
-                f"qty={total_qty}, "
-                f"active={ActiveProducts.objects.filter(current_id=current_item_id).exists()}"
-            )
-
-            if not is_valid_item:
-                logger.error(
-                    f"❌ SKIPPED FROM TOTAL → "
-                    f"item_id={current_item_id}, "
-                    f"name={name}, "
-                    f"qty={total_qty}"
-                )
-                continue
-
-            # Scenic Calc Item totals
-            sci, sci_created = ScenicCalcItems.objects.get_or_create(
-                opportunity=opportunity,
-                current_item_id=current_item_id,
-                defaults={
-                    "name": name,
-                    "item_total": total_qty,
-                },
-            )
-
-            if not sci.is_active:
-                sci.is_active = True
-
-            last_updated_at = sci.updated_at
-            sci.previous_item_total = sci.item_total
-            sci.item_total = total_qty
-
-            if not sci_created:
-                sci.previously_updated_at = last_updated_at
-
-            sci.save()
-            grand_total += total_qty
-        
-        ScenicCalcItems.objects.filter(
-                opportunity=opportunity,
-                is_active=True
-            ).exclude(
-                current_item_id__in=item_totals.keys()
-            ).update(is_active=False)
-
-        # Grand totals
-        scenic_total, created = update_model_with_history(
-            model=ScenicCalcTotal,
-            lookup={"opportunity": opportunity},
-            defaults={"grand_total": grand_total},
-            previous_fields=["grand_total"],
-        )
-
-        custom_input = CustomInput.objects.filter(opportunity=opportunity).first()
-        if custom_input and date_out:
-            num_of_carpenters = custom_input.num_of_carpenters or 1
-            working_days = calculate_working_days(grand_total, num_of_carpenters)
-            if custom_input.planned_finish_date:
-                start_build_date = create_start_build_date(
-                    working_days=working_days or 0,
-                    date_out=custom_input.planned_finish_date,
-                    include_weekends=custom_input.include_weekends,
-                    planned_finish=True
-                )
+            if mode == SyncRun.MODE_INCREMENTAL:
+                # Step back a little so updates landing in the same second as
+                # the watermark are not missed; re-syncing them is harmless
+                updated_since = previous_run.watermark - WATERMARK_OVERLAP
+                data = fetch_workload_data(days=days, updated_since=updated_since)
             else:
-                start_build_date = create_start_build_date(
-                    working_days=working_days or 0,
-                    date_out=date_out,
-                    include_weekends=custom_input.include_weekends,
-                    planned_finish=False
-                )
-
-            custom_input.working_days = Decimal(working_days)
-            custom_input.start_build_date = start_build_date
-            custom_input.save(update_fields=["working_days", "start_build_date"])
-
-        logger.debug(f"Opportunity {opportunity.id} date_out={date_out}, time_out={time_out}, start_build_date={start_build_date}")
-
-        logger.info(
-            f"Processed Opportunity: {opportunity.opportunity_name} ({opportunity.current_id}) "
-            f"({opportunity.current_id}) - Grand Total: {grand_total}, "
-            f"Working Days: {working_days if custom_input else 'N/A'}"
-        )
-        logger.info(f"Items added: {len(items)}")
-
-    inactive_opps = Opportunity.objects.exclude(
-        current_id__in=seen_opportunity_ids
-    ).filter(
-        is_active=True
+                data = fetch_workload_data(days=days)
+
+            opportunities = data.get("opportunities_with_items", [])
+            logger.info("Total Opportunities: %s", len(opportunities))
+
+            active_products = data.get("active_products")
+            logger.info("Total Active Products: %s", len(active_products))
+
+            # The sweep's API calls are made up front so no transaction is
+            # held open across them
+            sweep = None
+            if mode == SyncRun.MODE_INCREMENTAL and sweep_due():
+                with phase("fetch_sweep"):
+                    sweep = fetch_sweep(days, exclude_ids={
+                        opp_data["opportunity"]["id"] for opp_data in opportunities
+                    })
+
+            # Everything is written in one transaction, so a failed run leaves
+            # the dashboard as it was and nothing is deactivated
+            lock.ensure_held()
+            with phase("write"), transaction.atomic():
+                with phase("write_products"):
+                    sync_active_products(active_products)
+                logger.info("Finished processing active products.")
+
+                failed_ids = set()
+                seen_opportunity_ids = sync_opportunities(opportunities, failed_ids)
+
+                with phase("deactivate"):
+                    if mode == SyncRun.MODE_FULL:
+                        deactivate_missing_opportunities(seen_opportunity_ids)
+                        run.swept = True
+                    elif sweep is not None:
+                        apply_sweep(*sweep)
+                        run.swept = True
+
+                logger.info("Finished processing opportunities.")
+
+                with phase("publish_snapshot"):
+                    publish_workshop_snapshot()
+        except Exception:
+            run.status = SyncRun.STATUS_FAILED
+            run.finished_at = timezone.now()
+            run.metrics = stats.as_dict()
+            run.save()
+            logger.error("Sync run %s failed and was rolled back", run.id)
+            raise
+
+    # One summary record per run; the counts are also attached for
+    # structured log handlers
+    logger.info(
+        "Sync run %s (%s) finished: %s", run.id, mode, stats,
+        extra={"sync_run": run.id, "sync_stats": stats.as_dict()})
+
+    # Opportunities that were skipped or failed to write are fetched again
+    # by the next run rather than lost behind the watermark
+    listed = [opp_data["opportunity"] for opp_data in opportunities]
+    run.watermark = hold_back_watermark(
+        latest_updated_at(listed, default=previous_run.watermark if previous_run else None),
+        [opportunity for opportunity in listed if opportunity["id"] in failed_ids],
+    )
+    run.opportunities_processed = len(opportunities)
+    run.status = SyncRun.STATUS_SUCCESS
+    run.finished_at = timezone.now()
+    run.metrics = stats.as_dict()
+    run.save()
+
+    return {
+        "status": "completed",
+        "mode": mode,
+        "opportunities_processed": len(opportunities),
+        "products_processed": len(active_products),
+        "sync_run": run.id,
+        "duration": run.duration.total_seconds(),
+        "metrics": run.metrics,
+    }
+
+
+@shared_task(name='fetch_workshop_workload_sharded_task')
+def fetch_workshop_workload_sharded(days, mode=SyncRun.MODE_FULL):
+    """
+    Celery task to fan the workshop sync out across the workers.
+
+    The coordinator lists the opportunities and writes the active
+    products, then hands the opportunities to sync_workshop_shard tasks in
+    chunks of settings.SYNC_SHARD_SIZE. Each shard fetches its items and
+    upserts its chunk. Once every shard has succeeded the chord callback,
+    finish_sharded_sync, deactivates what left the window and publishes
+    the snapshot.
+
+    Each shard commits on its own, so a failed run can leave some shards
+    written, unlike fetch_workshop_workload. Nothing is deactivated and
+    no snapshot is published for it, though.
+
+    The sync lock is taken by the coordinator, renewed by the shards and
+    let go by the chord callback or errback.
+    """
+    lock = SyncLock()
+    claimed = claim_sync(lock, days, mode, sharded=True)
+    if claimed is None:
+        return {"status": "coalesced", "mode": mode}
+    days, mode = claimed
+
+    try:
+        with lock.heartbeat():
+            run, sweep_ids, shards = plan_sharded_sync(days, mode)
+    except Exception:
+        lock.release()
+        dispatch_follow_up()
+        raise
+
+    callback = finish_sharded_sync.s(run.id, sweep_ids, lock.token).on_error(
+        fail_sharded_sync.s(run.id, lock.token))
+    chord([
+        sync_workshop_shard.s(run.id, shard, lock.token) for shard in shards
+    ])(callback)
+
+    logger.info("Sync run %s fanned out %s opportunities over %s shards",
+                run.id, run.opportunities_processed, run.shards)
+    return {
+        "status": "dispatched",
+        "mode": mode,
+        "sync_run": run.id,
+        "opportunities": run.opportunities_processed,
+        "shards": run.shards,
+    }
+
+
+def plan_sharded_sync(days, mode):
+    """
+    List the opportunities for a sharded sync and write the active products.
+
+    Returns:
+    - The SyncRun, the current_ids listed by the sweep or None when it did
+    not run, and the shards of opportunity payloads
+    """
+    previous_run = get_watermark_run()
+    if mode == SyncRun.MODE_INCREMENTAL and previous_run is None:
+        logger.info("No sync watermark recorded, running a full sync")
+        mode = SyncRun.MODE_FULL
+
+    logger.info("Running sharded sync with days=%s, mode=%s", days, mode)
+    run = SyncRun.objects.create(mode=mode, days=days)
+
+    with collect_sync_stats() as stats:
+        try:
+            updated_since = None
+            if mode == SyncRun.MODE_INCREMENTAL:
+                updated_since = previous_run.watermark - WATERMARK_OVERLAP
+            opportunities, active_products = fetch_workload_listings(
+                days=days, updated_since=updated_since)
+
+            # The sweep's listing decides what is deactivated, and the
+            # opportunities in it that are not stored yet are synced too
+            to_sync = opportunities
+            sweep_ids = None
+            if mode == SyncRun.MODE_INCREMENTAL and sweep_due():
+                with phase("fetch_sweep"):
+                    listed = fetch_opportunities_within_date(days=days)
+                sweep_ids = sorted({opportunity["id"] for opportunity in listed})
+                to_sync = opportunities + unstored_opportunities(listed, exclude_ids={
+                    opportunity["id"] for opportunity in opportunities
+                })
+
+            with phase("write_products"), transaction.atomic():
+                sync_active_products(active_products)
+        except Exception:
+            run.status = SyncRun.STATUS_FAILED
+            run.finished_at = timezone.now()
+            run.metrics = stats.as_dict()
+            run.save()
+            logger.error("Sharded sync run %s failed before fanning out", run.id)
+            raise
+
+    shards = list(chunked(to_sync, settings.SYNC_SHARD_SIZE))
+    run.watermark = latest_updated_at(
+        opportunities,
+        default=previous_run.watermark if previous_run else None,
     )
-    count = inactive_opps.update(is_active=False)
-    logger.warning(f"Marked {count} opportunities as inactive (missing from API)")
+    run.opportunities_processed = len(to_sync)
+    run.shards = len(shards)
+    run.metrics = stats.as_dict()
+    run.save()
+
+    return run, sweep_ids, shards
+
+
+@shared_task(name='sync_workshop_shard_task')
+def sync_workshop_shard(run_id, opportunities, lock_token):
+    """
+    Celery task to fetch the items of one shard of a sharded sync and
+    upsert its opportunities in one transaction.
+
+    Returns:
+    - The current_ids synced, the id and updated_at of those that were
+    skipped or failed to write, and the shard's SyncStats counters
+    """
+    logger.info("Sync run %s: syncing a shard of %s opportunities",
+                run_id, len(opportunities))
+    lock = SyncLock(lock_token)
+    lock.ensure_held()
+
+    with lock.heartbeat(), collect_sync_stats() as stats, party_identity_map():
+        with phase("fetch_items"):
+            opportunities_with_items = get_opps_with_items(opportunities)
+        lock.ensure_held()
+        failed_ids = set()
+        with phase("write"), transaction.atomic():
+            synced_ids = sync_opportunities(opportunities_with_items, failed_ids)
+
+    return {
+        "synced_ids": sorted(synced_ids),
+        "failed": [
+            {"id": opportunity["id"], "updated_at": opportunity.get("updated_at")}
+            for opportunity in opportunities if opportunity["id"] in failed_ids
+        ],
+        "metrics": stats.as_dict(),
+    }
+
 
-    ScenicCalcItem.objects.filter(
-        opportunity_id__in=inactive_opps.values_list("id", flat=True)
-    ).update(is_active=False)
+@shared_task(name='finish_sharded_sync_task')
+def finish_sharded_sync(shard_results, run_id, sweep_ids, lock_token):
+    """
+    Celery chord callback for a sharded sync, run once every shard has
+    succeeded. Deactivates the opportunities missing from the run, publishes
+    the snapshot and records the run, with the shards' counters added in,
+    then lets go of the sync lock.
+    """
+    lock = SyncLock(lock_token)
+    try:
+        lock.ensure_held()
+        return record_sharded_sync(shard_results, run_id, sweep_ids)
+    finally:
+        lock.release()
+        dispatch_follow_up()
+
+
+def record_sharded_sync(shard_results, run_id, sweep_ids):
+    """Finish a sharded sync once every shard has succeeded, see finish_sharded_sync"""
+    run = SyncRun.objects.get(pk=run_id)
+
+    with collect_sync_stats() as stats:
+        with phase("write"), transaction.atomic():
+            with phase("deactivate"):
+                if run.mode == SyncRun.MODE_FULL:
+                    deactivate_missing_opportunities({
+                        current_id
+                        for result in shard_results
+                        for current_id in result["synced_ids"]
+                    })
+                    run.swept = True
+                elif sweep_ids is not None:
+                    deactivate_missing_opportunities(sweep_ids)
+                    run.swept = True
+
+            with phase("publish_snapshot"):
+                publish_workshop_snapshot()
+
+    stats.merge(run.metrics)
+    for result in shard_results:
+        stats.merge(result["metrics"])
+
+    # The watermark was planned before the shards ran, so hold it back for
+    # the opportunities they skipped or failed to write
+    run.watermark = hold_back_watermark(run.watermark, [
+        opportunity for result in shard_results for opportunity in result.get("failed", [])
+    ])
+
+    logger.info(
+        "Sync run %s (%s, %s shards) finished: %s", run.id, run.mode, run.shards, stats,
+        extra={"sync_run": run.id, "sync_stats": stats.as_dict()})
+
+    run.status = SyncRun.STATUS_SUCCESS
+    run.finished_at = timezone.now()
+    run.metrics = stats.as_dict()
+    run.save()
+
+    return {
+        "status": "completed",
+        "mode": run.mode,
+        "opportunities_processed": run.opportunities_processed,
+        "shards": run.shards,
+        "sync_run": run.id,
+        "duration": run.duration.total_seconds(),
+        "metrics": run.metrics,
+    }
 
-    ScenicCalcItems.objects.filter(
-        opportunity__in=inactive_opps
-    ).update(is_active=False)
 
-    ScenicCalcTotal.objects.filter(
-        opportunity__in=inactive_opps
-    ).update(is_active=False)
+@shared_task(name='fail_sharded_sync_task')
+def fail_sharded_sync(request, exc, traceback, run_id, lock_token):
+    """
+    Celery errback marking a sharded sync failed when a shard or the
+    callback fails, and letting go of the sync lock
+    """
+    SyncRun.objects.filter(pk=run_id, status=SyncRun.STATUS_RUNNING).update(
+        status=SyncRun.STATUS_FAILED, finished_at=timezone.now())
+    logger.error("Sharded sync run %s failed: %s", run_id, exc)
+
+    SyncLock(lock_token).release()
+    dispatch_follow_up()
+
+
+@shared_task(bind=True, name='resync_opportunity_task', max_retries=20, default_retry_delay=30)
+def resync_opportunity(self, current_id, days=91):
+    """
+    Celery task to bring one opportunity up to date after a Current RMS
+    webhook: the opportunity, its items, totals and custom input schedule.
+
+    An opportunity that was deleted, or has left the synced statuses or the
+    window, is deactivated instead. The task waits for a running sync to
+    finish rather than writing alongside it, and retries later if the
+    opportunity could not be fetched, backing off exponentially. Once the
+    retries run out the opportunity is handed to an incremental sync, see
+    retry_or_hand_off.
+    """
+    lock = SyncLock()
+    if not lock.acquire():
+        return retry_or_hand_off(self, current_id, days)
+
+    try:
+        # Events from here on schedule another resync, as this one may read
+        # the opportunity before they happened
+        clear_resync(current_id)
+        with lock.heartbeat(), collect_sync_stats() as stats, party_identity_map():
+            outcome = resync_one_opportunity(current_id, days, lock)
+    finally:
+        lock.release()
+        dispatch_follow_up()
+
+    if outcome is None:
+        return retry_or_hand_off(self, current_id, days)
+
+    logger.info(
+        "Resync of opportunity %s %s: %s", current_id, outcome, stats,
+        extra={"sync_stats": stats.as_dict()})
+    return {
+        "status": "completed",
+        "opportunity": current_id,
+        "outcome": outcome,
+        "metrics": stats.as_dict(),
+    }
 
-    print(f"Saving {len(opportunities)} opportunities")
-    logger.info("Finished processing opportunities.")
 
+def retry_or_hand_off(task, current_id, days):
+    """
+    Retry a resync that could not run, waiting twice as long each time up
+    to RESYNC_MAX_RETRY_DELAY seconds.
+
+    When the retries run out the event is not dropped: the opportunity's
+    debounce marker is cleared, so later events schedule a resync again,
+    and an incremental sync is queued, which picks the opportunity up by its
+    updated_at. A sync already running merges it into its follow-up run.
+    """
+    if task.request.retries >= task.max_retries:
+        clear_resync(current_id)
+        fetch_workshop_workload.delay(days, mode=SyncRun.MODE_INCREMENTAL)
+        logger.warning(
+            "Gave up resyncing opportunity %s after %s retries, queued an incremental sync",
+            current_id, task.request.retries)
+        return {"status": "handed_off", "opportunity": current_id}
+
+    countdown = min(RESYNC_MAX_RETRY_DELAY, task.default_retry_delay * 2 ** task.request.retries)
+    raise task.retry(countdown=countdown)
+
+
+def resync_one_opportunity(current_id, days, lock):
+    """
+    Resync one opportunity while holding the sync lock, see
+    resync_opportunity.
+
+    Returns:
+    - 'synced' or 'deactivated', or None if the opportunity or its items
+    could not be fetched, or its write failed
+    """
+    in_scope = False
+    try:
+        opportunity = get_opportunity(current_id)
+        if opportunity is None:
+            return None
+        in_scope = in_sync_scope(opportunity, days)
+    except OpportunityNotFound:
+        logger.info("Opportunity %s no longer exists in Current RMS", current_id)
+
+    if in_scope:
+        items = get_opportunity_items(current_id)
+        if items is None:
+            return None
+
+    lock.ensure_held()
+    with transaction.atomic():
+        if in_scope:
+            failed_ids = set()
+            sync_opportunities([{"opportunity": opportunity, "items": items}], failed_ids)
+            if current_id in failed_ids:
+                return None
+            outcome = "synced"
+        else:
+            deactivate_opportunities(Opportunity.objects.filter(current_id=current_id))
+            outcome = "deactivated"
+        publish_workshop_snapshot()
+
+    return outcome
+
+
+@shared_task(name='refresh_workload_cache_task')
+def refresh_workload_cache(days=14):
+    """Celery task to rebuild the cached api_workload summary."""
+    entry = refresh_workload_summary(days)
     return {
         "status": "completed",
-        "opportunities_processed": len(opportunities),
-        "products_processed": len(active_products)
+        "days": days,
+        "refreshed_at": entry["refreshed_at"].isoformat(),
     }
 
 
@@ -368,5 +565,4 @@ def delete_old_task_results():
 @shared_task
 def test_celery_task():
     logger.info("✅ Celery task ran successfully.")
-    print("✅ Celery task ran successfully.")
     return "Task completed"
@@ -1,3 +1,1080 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import Retry
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from lfms.celery import app as celery_app
+
+from .benchmark import api_datetime, parse_api_datetime, replay_fixture, synthetic_fixture
+from . import api_calls
+from .api_calls import (
+    CurrentRMSClient,
+    PageCursor,
+    PageFetchError,
+    RateLimiter,
+    collect_records,
+    get_opportunity_items,
+    get_rate_limiter,
+    iter_opportunities,
+    iter_records
+)
+from .models import (
+    Owner,
+    Client,
+    Venue,
+    Opportunity,
+    Tag,
+    ScenicCalcItem,
+    ScenicCalcItems,
+    ScenicCalcTotal,
+    CustomInput,
+    ActiveProducts,
+    SyncRun,
+    WorkshopSnapshot
+)
+from .sync_stats import collect_sync_stats
+from .events import EVENTS_CHANNEL, event_stream
+from .sync_lock import (
+    SYNC_LOCK_KEY, FOLLOW_UP_KEY, SyncLock, SyncLockLost, pop_follow_up, request_follow_up
+)
+from .tasks import (
+    claim_sync,
+    fetch_workshop_workload,
+    fetch_workshop_workload_sharded,
+    dispatch_follow_up,
+    refresh_workload_cache,
+    resync_opportunity
+)
+from .webhooks import (
+    SIGNATURE_HEADER, TIMESTAMP_HEADER, build_event, claim_resync, sign_payload
+)
+from .sync import (
+    deactivate_opportunities,
+    sync_opportunities,
+    load_active_product_ids,
+    sync_item_totals,
+    resolve_tags,
+    reconcile_tags,
+    party_identity_map
+)
+from .utils import (
+    build_workshop_workload_data,
+    get_opps_with_items,
+    publish_workshop_snapshot,
+    date_window_filters,
+    workload_cache_key
+)
+from .views import api_workload, get_workshop_workload_data, bulk_custom_input
+
+
+def create_opportunity(current_id, starts_at):
+    """Create an active opportunity with every relation the dashboard reads"""
+    owner = Owner.objects.create(
+        current_id=current_id, current_uuid=uuid.uuid4(), name=f"Owner {current_id}",
+        membership_id=current_id, membership_type="User",
+        lawful_basis_id=1, lawful_basis_type_name="Legitimate interest")
+    client = Client.objects.create(
+        current_id=current_id, current_uuid=uuid.uuid4(), name=f"Client {current_id}")
+    venue = Venue.objects.create(current_id=current_id, name=f"Venue {current_id}")
+    opportunity = Opportunity.objects.create(
+        current_id=current_id, owner=owner, client=client, venue=venue,
+        order_number=str(current_id), opportunity_name=f"Job {current_id}",
+        dry_hire="No", dry_hire_transport="No", status=1, status_name="Provisional",
+        starts_at=starts_at, ends_at=starts_at + timedelta(days=1))
+    tag, _ = Tag.objects.get_or_create(name="Scenic")
+    opportunity.tags.add(tag)
+    for current_item_id in (1, 2):
+        ScenicCalcItems.objects.create(
+            opportunity=opportunity, current_item_id=current_item_id,
+            name=f"Calc {current_item_id}", item_total=Decimal("4"))
+    ScenicCalcTotal.objects.create(opportunity=opportunity, grand_total=Decimal("8"))
+    CustomInput.objects.create(
+        opportunity=opportunity, include_weekends=False, num_of_carpenters=1, built=False)
+    return opportunity
+
+
+def opportunity_payload(current_id, owner_uuid=None):
+    """Build a Current RMS opportunity payload with no items"""
+    starts_at = (timezone.now() + timedelta(days=7)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    return {
+        "opportunity": {
+            "id": current_id, "number": str(current_id), "subject": f"Job {current_id}",
+            "custom_fields": {"dry_hire": "No", "dry_hire_transport": "No"},
+            "status": 1, "status_name": "Provisional",
+            "starts_at": starts_at, "ends_at": starts_at,
+            "owner": {
+                "id": current_id, "uuid": owner_uuid or str(uuid.uuid4()),
+                "name": f"Owner {current_id}", "active": True, "bookable": False,
+                "membership_id": current_id, "membership_type": "User",
+                "lawful_basis_type_id": 1, "lawful_basis_type_name": "Legitimate interest",
+            },
+            "member": {"id": current_id, "uuid": str(uuid.uuid4()), "name": f"Client {current_id}", "active": True},
+        },
+        "items": [],
+    }
+
+
+class WorkshopWorkloadDataTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.starts_at = timezone.now() + timedelta(days=7)
+
+    def test_query_count_does_not_grow_with_opportunities(self):
+        # One query for the opportunities and their joined relations, one
+        # each for the prefetched item groups and tags
+        create_opportunity(1, self.starts_at)
+        with self.assertNumQueries(3):
+            build_workshop_workload_data()
+
+        for current_id in range(2, 12):
+            create_opportunity(current_id, self.starts_at)
+        with self.assertNumQueries(3):
+            data = build_workshop_workload_data()
+
+        self.assertEqual(len(data), 11)
+
+    def test_endpoint_serves_latest_snapshot(self):
+        create_opportunity(1, self.starts_at)
+        publish_workshop_snapshot()
+        create_opportunity(2, self.starts_at)
+
+        with self.assertNumQueries(1):
+            response = get_workshop_workload_data(self.factory.get("/"))
+        self.assertEqual(len(json.loads(response.content)["result"]), 1)
+
+        snapshot = publish_workshop_snapshot()
+        response = get_workshop_workload_data(self.factory.get("/"))
+        self.assertEqual(len(json.loads(response.content)["result"]), 2)
+        self.assertEqual(response["X-Snapshot-Version"], str(snapshot.id))
+
+    def test_opportunity_without_scenic_total(self):
+        opportunity = create_opportunity(1, self.starts_at)
+        opportunity.scenic_calc_total.delete()
+
+        response = get_workshop_workload_data(self.factory.get("/"))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_endpoint_answers_if_none_match_with_not_modified(self):
+        create_opportunity(1, self.starts_at)
+        response = get_workshop_workload_data(self.factory.get("/"))
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        response = get_workshop_workload_data(
+            self.factory.get("/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+
+        publish_workshop_snapshot()
+        response = get_workshop_workload_data(
+            self.factory.get("/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+
+        create_opportunity(2, self.starts_at)
+        publish_workshop_snapshot()
+        response = get_workshop_workload_data(
+            self.factory.get("/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class WorkloadSummaryTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        patcher = mock.patch.object(refresh_workload_cache, "delay")
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, days):
+        return api_workload(self.factory.get("/workload/api/workload/", {"days": days}))
+
+    def cache_summary(self, refreshed_at):
+        cache.set(workload_cache_key(14), {
+            "data": {"confirmed_weight": 1}, "etag": "abc", "refreshed_at": refreshed_at,
+        })
+
+    def test_days_outside_the_allowed_set_are_refused(self):
+        for days in ("abc", "5", "100000"):
+            self.assertEqual(self.get(days).status_code, 400)
+        self.delay.assert_not_called()
+
+    def test_cold_cache_queues_one_refresh_without_waiting_on_the_api(self):
+        with mock.patch("workload.utils.build_workload_summary") as build:
+            responses = [self.get(14), self.get(14)]
+
+        build.assert_not_called()
+        self.assertEqual([response.status_code for response in responses], [202, 202])
+        self.assertEqual(responses[0]["Retry-After"], "5")
+        self.delay.assert_called_once_with(14)
+
+    def test_cached_summary_is_served_and_refreshed_once_stale(self):
+        self.cache_summary(timezone.now())
+        response = self.get(14)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"confirmed_weight": 1})
+        self.delay.assert_not_called()
+
+        self.cache_summary(timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.get(14).status_code, 200)
+        self.delay.assert_called_once_with(14)
+
+
+class BulkCustomInputTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        starts_at = timezone.now() + timedelta(days=7)
+        self.opportunities = [
+            create_opportunity(current_id, starts_at) for current_id in (1, 2, 3)
+        ]
+
+    def post(self, updates):
+        request = self.factory.post(
+            "/", json.dumps({"updates": updates}), content_type="application/json")
+        return bulk_custom_input(request)
+
+    def test_get_returns_every_requested_opportunity_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = bulk_custom_input(self.factory.get("/", {"ids": "1,2,3"}))
+
+        results = json.loads(response.content)["results"]
+        self.assertEqual(sorted(results), ["1", "2", "3"])
+        self.assertEqual(results["2"]["num_of_carpenters"], 1)
+
+    def test_post_applies_every_edit(self):
+        response = self.post([
+            {"opportunity_id": 1, "num_of_carpenters": 3},
+            {"opportunity_id": 2, "include_weekends": True},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CustomInput.objects.get(opportunity__current_id=1).num_of_carpenters, 3)
+        self.assertTrue(CustomInput.objects.get(opportunity__current_id=2).include_weekends)
+
+    def test_post_with_unknown_opportunity_saves_nothing(self):
+        response = self.post([
+            {"opportunity_id": 1, "num_of_carpenters": 3},
+            {"opportunity_id": 99, "num_of_carpenters": 2},
+        ])
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(CustomInput.objects.get(opportunity__current_id=1).num_of_carpenters, 1)
+
+
+class SyncItemTotalsTests(TestCase):
+
+    def test_totals_count_only_active_products_without_per_item_queries(self):
+        opportunity = create_opportunity(1, timezone.now() + timedelta(days=7))
+        for current_id in (10, 11, 4977):
+            ActiveProducts.objects.create(current_id=current_id, name=f"Product {current_id}")
+        item_ids = (10, 11, 12, 4977)
+        plan = {
+            "current_id": 1,
+            "item_totals": {item_id: Decimal("2") for item_id in item_ids},
+            "item_names": {item_id: f"Calc {item_id}" for item_id in item_ids},
+        }
+
+        active_product_ids = load_active_product_ids()
+        # One query to load the existing item groups and one to create them
+        with self.assertNumQueries(2):
+            grand_totals = sync_item_totals({1: opportunity}, [plan], active_product_ids)
+
+        self.assertEqual(grand_totals, {1: Decimal("4")})
+
+
+class ReconcileTagsTests(TestCase):
+
+    def test_only_changed_tags_are_written(self):
+        opportunity = create_opportunity(1, timezone.now() + timedelta(days=7))
+        through = Opportunity.tags.through
+        kept = through.objects.get(opportunity=opportunity)
+
+        tag_ids = resolve_tags(["Scenic", "Build"])
+        reconcile_tags(Opportunity, {opportunity.pk: ["Scenic", "Build"]}, tag_ids)
+        self.assertTrue(through.objects.filter(pk=kept.pk).exists())
+        self.assertEqual(
+            sorted(opportunity.tags.values_list("name", flat=True)), ["Build", "Scenic"])
+
+        reconcile_tags(Opportunity, {opportunity.pk: ["Build"]}, tag_ids)
+        self.assertEqual(list(opportunity.tags.values_list("name", flat=True)), ["Build"])
+
+    def test_resolve_creates_missing_tags_once(self):
+        Tag.objects.create(name="Scenic")
+
+        with self.assertNumQueries(3):
+            tag_ids = resolve_tags(["Scenic", "Build", "Build"])
+
+        self.assertEqual(set(tag_ids), {"Scenic", "Build"})
+        self.assertEqual(Tag.objects.count(), 2)
+
+
+class FakeResponse:
+
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+@override_settings(CURRENT_RMS_RATE_LIMIT=0)
+class PageIteratorTests(SimpleTestCase):
+
+    def fake_get(self, url, params=None, timeout=None):
+        """Serve 60 opportunities 25 to a page, failing page 2 once"""
+        page = params["page"]
+        if page == 2 and not self.failed:
+            self.failed = True
+            return None
+        start = (page - 1) * params["per_page"]
+        return FakeResponse({
+            "opportunities": [{"id": i} for i in range(start, min(start + params["per_page"], 60))],
+            "meta": {"total_row_count": 60, "per_page": params["per_page"], "page": page},
+        })
+
+    def setUp(self):
+        self.failed = False
+        patcher = mock.patch.object(CurrentRMSClient, "get", side_effect=self.fake_get)
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def test_failed_walk_resumes_from_the_failed_page(self):
+        cursor = PageCursor()
+        seen = []
+
+        with self.assertRaises(PageFetchError):
+            for opportunity in iter_opportunities(cursor=cursor):
+                seen.append(opportunity["id"])
+        self.assertEqual(cursor.page, 2)
+
+        for opportunity in iter_opportunities(cursor=cursor):
+            seen.append(opportunity["id"])
+
+        self.assertEqual(seen, list(range(60)))
+        self.assertTrue(cursor.done)
+
+    def test_date_window_is_sent_as_ransack_predicates(self):
+        window = date_window_filters(14)
+        self.failed = True
+
+        list(iter_opportunities(**window))
+
+        params = self.get.call_args.kwargs["params"]
+        self.assertEqual(params["q[starts_at_gteq]"], window["starts_at_gteq"].isoformat())
+        self.assertEqual(params["q[starts_at_lteq]"], window["starts_at_lteq"].isoformat())
+
+
+class ScriptedServer:
+    """
+    A local HTTP server answering each request with the next scripted
+    (status, headers, body) response, repeating the last one, so the
+    client's real session, adapter and urllib3 retries are exercised
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append((self.command, self.path))
+                status, headers, body = (
+                    server.responses.pop(0) if len(server.responses) > 1 else server.responses[0])
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/api/v1/opportunities"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@override_settings(CURRENT_RMS_RATE_LIMIT=0)
+class CurrentRMSClientTests(SimpleTestCase):
+
+    def client_for(self, **kwargs):
+        client = CurrentRMSClient(
+            subdomain="test", auth_token="test", backoff_factor=0, **kwargs)
+        self.addCleanup(client.session.close)
+        return client
+
+    def page(self, count=2):
+        return {
+            "opportunities": [{"id": i} for i in range(count)],
+            "meta": {"total_row_count": count, "per_page": 25, "page": 1},
+        }
+
+    def test_server_errors_and_rate_limits_are_retried(self):
+        with ScriptedServer((503, {}, {}), (429, {}, {}), (200, {}, self.page())) as server:
+            response = self.client_for(max_retries=3).get(server.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_retry_after_is_capped(self):
+        with mock.patch("urllib3.util.retry.time.sleep") as sleep, ScriptedServer(
+                (429, {"Retry-After": "120"}, {}), (200, {}, self.page())) as server:
+            response = self.client_for(max_retries=3, max_retry_after=2).get(server.url)
+
+        self.assertEqual(response.status_code, 200)
+        sleep.assert_called_once_with(2)
+
+    def test_post_is_not_retried(self):
+        with ScriptedServer((503, {}, {}), (200, {}, {})) as server:
+            response = self.client_for(max_retries=3).session.post(server.url, json={})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.requests, [("POST", "/api/v1/opportunities")])
+
+    def test_exhausted_retries_fail_the_listing_without_raising(self):
+        client = self.client_for(max_retries=2)
+        with self.assertLogs("workload.api_calls", "WARNING") as logs, \
+                mock.patch.object(api_calls, "_client", client), \
+                ScriptedServer((500, {}, {})) as server:
+            response = client.get(server.url)
+            records = collect_records(iter_records(
+                server.url, {"per_page": 25}, "opportunities", "opportunities"))
+
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNone(records)
+        self.assertEqual(len(logs.records), 2)
+        # The first call and two retries, for each of the two requests
+        self.assertEqual(len(server.requests), 6)
+
+
+class ItemFetchTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("builtins.print")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_fetches_give_no_items_without_failing_the_batch(self):
+        def fetch(opportunity_id):
+            if opportunity_id == 2:
+                raise ConnectionError("reset by peer")
+            if opportunity_id == 3:
+                return None
+            return [{"id": opportunity_id * 10}]
+
+        opportunities = [{"id": 1}, {"id": 2}, {"id": 3}, {"id": 4}]
+        with mock.patch("workload.utils.get_opportunity_items", side_effect=fetch):
+            with override_settings(CURRENT_RMS_RATE_LIMIT=0):
+                opps_with_items = get_opps_with_items(opportunities, max_workers=2)
+
+        self.assertEqual(
+            [(o["opportunity"]["id"], o["items"]) for o in opps_with_items],
+            [(1, [{"id": 10}]), (2, None), (3, None), (4, [{"id": 40}])])
+
+    def test_rate_limiter_spaces_calls_out(self):
+        limiter = RateLimiter(20)
+        with mock.patch("workload.api_calls.time.monotonic", return_value=100.0), \
+                mock.patch("workload.api_calls.time.sleep") as sleep:
+            for _ in range(5):
+                limiter.wait()
+
+        # The first call goes straight away, each later one a slot after the last
+        self.assertEqual(
+            [round(call.args[0], 6) for call in sleep.call_args_list], [0.05, 0.1, 0.15, 0.2])
+
+    def test_rate_limiter_is_shared_across_threads(self):
+        limiter = RateLimiter(50)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            list(executor.map(lambda _: limiter.wait(), range(6)))
+
+        # Six calls at 50 a second need at least five intervals
+        self.assertGreaterEqual(time.monotonic() - started, 0.1 - 0.01)
+
+    def test_callers_share_one_limiter_per_host(self):
+        limiter = get_rate_limiter("https://api.current-rms.com/api/v1/opportunities")
+        self.assertIs(get_rate_limiter("https://api.current-rms.com/api/v1/products"), limiter)
+        self.assertEqual(limiter.rate, settings.CURRENT_RMS_RATE_LIMIT)
+
+    def test_no_rate_never_waits(self):
+        with mock.patch("workload.api_calls.time.sleep") as sleep:
+            for _ in range(5):
+                RateLimiter(0).wait()
+
+        sleep.assert_not_called()
+
+
+class SyncOpportunitiesTests(TestCase):
+
+    def test_bad_record_is_skipped_without_losing_the_batch(self):
+        # Two different owners sharing a uuid fail the batch insert, so
+        # each opportunity is retried under its own savepoint
+        owner_uuid = str(uuid.uuid4())
+        payloads = [
+            opportunity_payload(1, owner_uuid),
+            opportunity_payload(2, owner_uuid),
+            opportunity_payload(3),
+        ]
+
+        seen_ids = sync_opportunities(payloads)
+
+        self.assertEqual(seen_ids, {1, 2, 3})
+        self.assertEqual(
+            sorted(Opportunity.objects.values_list("current_id", flat=True)), [1, 3])
+
+    def test_unchanged_opportunity_is_not_written(self):
+        payload = opportunity_payload(1)
+        sync_opportunities([payload])
+        payload["opportunity"]["subject"] = "Renamed"
+        sync_opportunities([payload])
+        updated_at = Opportunity.objects.get(current_id=1).updated_at
+
+        sync_opportunities([payload])
+
+        opportunity = Opportunity.objects.get(current_id=1)
+        self.assertEqual(opportunity.updated_at, updated_at)
+        self.assertEqual(opportunity.previous_opportunity_name, "Job 1")
+
+    def test_items_removed_in_current_rms_are_deactivated(self):
+        def item(item_id, current_id):
+            return {
+                "id": item_id, "opportunity_id": current_id, "item_id": 7, "item_type": "Product",
+                "opportunity_item_type": 2, "opportunity_item_type_name": "Principal",
+                "name": "Flat - 8x4", "quantity": "4", "description": "",
+            }
+
+        ActiveProducts.objects.create(current_id=7, name="Flat", product_type="Product")
+        payload = opportunity_payload(1000)
+        payload["items"] = [item(601, 1000), item(602, 1000)]
+        sync_opportunities([payload])
+        # Another opportunity whose Current RMS id is the first one's pk
+        other = opportunity_payload(Opportunity.objects.get(current_id=1000).pk)
+        other["items"] = [item(701, other["opportunity"]["id"])]
+        sync_opportunities([other])
+
+        payload["items"] = [item(601, 1000)]
+        sync_opportunities([payload, other])
+
+        active = set(ScenicCalcItem.objects.filter(is_active=True).values_list("current_id", flat=True))
+        self.assertEqual(active, {601, 701})
+
+        deactivate_opportunities(Opportunity.objects.filter(current_id=1000))
+        active = set(ScenicCalcItem.objects.filter(is_active=True).values_list("current_id", flat=True))
+        self.assertEqual(active, {701})
+
+    def test_history_is_kept_across_two_syncs_of_a_changed_opportunity(self):
+        ActiveProducts.objects.create(current_id=7, name="Flat", product_type="Product")
+        payload = opportunity_payload(1)
+        payload["items"] = [{
+            "id": 501, "opportunity_id": 1, "item_id": 7, "item_type": "Product",
+            "opportunity_item_type": 2, "opportunity_item_type_name": "Principal",
+            "name": "Flat - 8x4", "quantity": "40", "description": "",
+        }]
+        sync_opportunities([payload])
+        first_item = ScenicCalcItem.objects.get(current_id=501)
+        first_input = CustomInput.objects.get(opportunity__current_id=1)
+        self.assertEqual(first_item.previous_quantity, Decimal("20"))
+
+        starts_at = timezone.now() + timedelta(days=14)
+        payload["opportunity"].update(
+            subject="Renamed", status_name="Reserved",
+            starts_at=starts_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+        payload["items"][0]["quantity"] = "80"
+        sync_opportunities([payload])
+
+        item = ScenicCalcItem.objects.get(current_id=501)
+        self.assertEqual((item.quantity, item.previous_quantity), (Decimal("40"), Decimal("20")))
+        self.assertEqual(item.previously_updated_at, first_item.updated_at)
+
+        opportunity = Opportunity.objects.get(current_id=1)
+        self.assertEqual(
+            (opportunity.opportunity_name, opportunity.previous_opportunity_name),
+            ("Renamed", "Job 1"))
+        self.assertEqual(
+            (opportunity.status_name, opportunity.previous_status_name),
+            ("Reserved", "Provisional"))
+
+        custom_input = CustomInput.objects.get(opportunity__current_id=1)
+        self.assertEqual(custom_input.date_out, starts_at.date())
+        self.assertEqual(custom_input.previous_date_out, first_input.date_out)
+        self.assertEqual(custom_input.previous_working_days, first_input.working_days)
+        self.assertGreater(custom_input.working_days, first_input.working_days)
+        self.assertEqual(custom_input.previously_updated_at, first_input.updated_at)
+
+        # An unchanged third sync leaves the history describing the last change
+        sync_opportunities([payload])
+        self.assertEqual(ScenicCalcItem.objects.get(current_id=501).previous_quantity, Decimal("20"))
+        self.assertEqual(
+            CustomInput.objects.get(opportunity__current_id=1).previous_date_out,
+            first_input.date_out)
+
+    def test_parties_are_resolved_once_per_run(self):
+        first = opportunity_payload(1)
+        second = opportunity_payload(2)
+        second["opportunity"]["owner"] = first["opportunity"]["owner"]
+
+        with party_identity_map():
+            sync_opportunities([first])
+            with CaptureQueriesContext(connection) as queries:
+                sync_opportunities([second])
+            second["opportunity"]["owner"] = dict(first["opportunity"]["owner"], name="Renamed")
+            sync_opportunities([second])
+
+        owner_table = Owner._meta.db_table
+        self.assertFalse([query for query in queries if owner_table in query["sql"]])
+        self.assertEqual(Opportunity.objects.get(current_id=2).owner.name, "Renamed")
+        self.assertEqual(Owner.objects.count(), 1)
+
+    def test_run_records_rows_phases_and_queries(self):
+        with collect_sync_stats() as stats:
+            sync_opportunities([opportunity_payload(1)])
+
+        metrics = stats.as_dict()
+        self.assertEqual(metrics["rows"]["Opportunity"]["created"], 1)
+        self.assertIn("write_opportunities", metrics["phases"])
+        self.assertGreater(metrics["queries"]["Opportunity"], 0)
+        self.assertEqual(metrics["query_count"], sum(metrics["queries"].values()))
+
+
+class BenchmarkFixtureTests(TestCase):
+
+    def setUp(self):
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def test_sync_runs_against_replayed_fixture(self):
+        fixture = synthetic_fixture(40, days=91)
+        synced_ids = {
+            record["id"] for record in fixture["opportunities"]
+            if (record["state"], record["status"]) in ((2, 1), (2, 5), (3, 0))
+        }
+
+        with replay_fixture(fixture) as adapter:
+            result = fetch_workshop_workload(91, mode=SyncRun.MODE_FULL)
+
+        self.assertEqual(result["status"], "completed")
+        self.assertEqual(
+            set(Opportunity.objects.filter(is_active=True).values_list("current_id", flat=True)),
+            synced_ids)
+        self.assertEqual(result["metrics"]["http"]["calls"], adapter.calls)
+
+    @override_settings(SYNC_SHARD_SIZE=10)
+    def test_sharded_sync_matches_single_task_sync(self):
+        fixture = synthetic_fixture(60, days=91)
+        with replay_fixture(fixture):
+            fetch_workshop_workload(91, mode=SyncRun.MODE_FULL)
+        expected_ids = set(
+            Opportunity.objects.filter(is_active=True).values_list("current_id", flat=True))
+        Opportunity.objects.filter(current_id__in=list(expected_ids)[:5]).update(is_active=False)
+        create_opportunity(99999, timezone.now() + timedelta(days=7))
+
+        # Run the chord's shards and callback in process
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        with replay_fixture(fixture):
+            result = fetch_workshop_workload_sharded(91, mode=SyncRun.MODE_FULL)
+
+        run = SyncRun.objects.get(pk=result["sync_run"])
+        self.assertEqual(run.status, SyncRun.STATUS_SUCCESS)
+        self.assertEqual(run.shards, result["shards"])
+        self.assertGreater(run.shards, 1)
+        self.assertEqual(
+            set(Opportunity.objects.filter(is_active=True).values_list("current_id", flat=True)),
+            expected_ids)
+        self.assertEqual(WorkshopSnapshot.objects.first().opportunity_count, len(expected_ids))
+
+
+class IncrementalSyncTests(TestCase):
+
+    def setUp(self):
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+        self.fixture = synthetic_fixture(40, days=91)
+
+    def sync(self, mode=SyncRun.MODE_INCREMENTAL):
+        with replay_fixture(self.fixture):
+            return fetch_workshop_workload(91, mode=mode)
+
+    def stored_records(self, count):
+        """Fixture records of opportunities the first sync stored, oldest edit first"""
+        stored = set(Opportunity.objects.filter(is_active=True).values_list("current_id", flat=True))
+        records = [record for record in self.fixture["opportunities"] if record["id"] in stored]
+        return sorted(records, key=lambda record: record["updated_at"])[:count]
+
+    def edit(self, record, subject, updated_at):
+        record["subject"] = subject
+        record["updated_at"] = api_datetime(updated_at)
+
+    def test_incremental_without_watermark_runs_full_sync(self):
+        result = self.sync()
+
+        run = SyncRun.objects.get(pk=result["sync_run"])
+        self.assertEqual(result["mode"], SyncRun.MODE_FULL)
+        self.assertTrue(run.swept)
+        self.assertEqual(run.watermark, max(
+            parse_api_datetime(record["updated_at"]) for record in self.stored_records(40)))
+
+    def test_incremental_fetches_only_edits_since_watermark_less_overlap(self):
+        self.sync(SyncRun.MODE_FULL)
+        watermark = SyncRun.objects.get().watermark
+        latest, older = self.stored_records(40)[-1], self.stored_records(1)[0]
+        # Edits landing in the watermark's own minute are read again
+        self.edit(latest, "Edited at the watermark", watermark)
+        older["subject"] = "Edited without a new updated_at"
+
+        result = self.sync()
+
+        self.assertEqual(result["mode"], SyncRun.MODE_INCREMENTAL)
+        self.assertEqual(result["opportunities_processed"], 1)
+        self.assertEqual(
+            Opportunity.objects.get(current_id=latest["id"]).opportunity_name,
+            "Edited at the watermark")
+        self.assertNotEqual(
+            Opportunity.objects.get(current_id=older["id"]).opportunity_name,
+            "Edited without a new updated_at")
+
+    def test_sweep_runs_when_due_and_deactivates_what_left_the_window(self):
+        self.sync(SyncRun.MODE_FULL)
+        left, = self.stored_records(1)
+        self.fixture["opportunities"].remove(left)
+
+        with override_settings(SYNC_SWEEP_INTERVAL_MINUTES=60):
+            result = self.sync()
+        self.assertFalse(SyncRun.objects.get(pk=result["sync_run"]).swept)
+        self.assertTrue(Opportunity.objects.get(current_id=left["id"]).is_active)
+
+        with override_settings(SYNC_SWEEP_INTERVAL_MINUTES=0):
+            result = self.sync()
+        self.assertTrue(SyncRun.objects.get(pk=result["sync_run"]).swept)
+        self.assertFalse(Opportunity.objects.get(current_id=left["id"]).is_active)
+
+    def test_opportunity_whose_items_failed_is_fetched_again(self):
+        self.sync(SyncRun.MODE_FULL)
+        failed, written = self.stored_records(2)
+        now = timezone.now().replace(microsecond=0)
+        self.edit(failed, "Items failed", now - timedelta(minutes=10))
+        self.edit(written, "Written", now)
+
+        real_items = get_opportunity_items
+
+        def fail_one(current_id):
+            return None if current_id == failed["id"] else real_items(current_id)
+
+        with mock.patch("workload.utils.get_opportunity_items", side_effect=fail_one):
+            result = self.sync()
+        run = SyncRun.objects.get(pk=result["sync_run"])
+        self.assertEqual(run.watermark, now - timedelta(minutes=10))
+        self.assertEqual(Opportunity.objects.get(current_id=written["id"]).opportunity_name, "Written")
+
+        result = self.sync()
+        self.assertEqual(result["opportunities_processed"], 2)
+        self.assertEqual(Opportunity.objects.get(current_id=failed["id"]).opportunity_name, "Items failed")
+        self.assertEqual(SyncRun.objects.get(pk=result["sync_run"]).watermark, now)
+
+
+class SyncLockTests(TestCase):
+
+    def setUp(self):
+        cache.delete_many([SYNC_LOCK_KEY, FOLLOW_UP_KEY])
+        self.addCleanup(cache.delete_many, [SYNC_LOCK_KEY, FOLLOW_UP_KEY])
+
+    def test_triggers_during_a_run_coalesce_into_one_follow_up(self):
+        holder = SyncLock()
+        self.assertTrue(holder.acquire())
+
+        results = [
+            fetch_workshop_workload(91, mode=SyncRun.MODE_INCREMENTAL),
+            fetch_workshop_workload(91, mode=SyncRun.MODE_FULL),
+            fetch_workshop_workload(91, mode=SyncRun.MODE_INCREMENTAL),
+        ]
+        holder.release()
+        with mock.patch.object(fetch_workshop_workload, "delay") as delay:
+            dispatch_follow_up()
+            dispatch_follow_up()
+
+        self.assertEqual({result["status"] for result in results}, {"coalesced"})
+        self.assertFalse(SyncRun.objects.exists())
+        delay.assert_called_once_with(91, mode=SyncRun.MODE_FULL)
+
+    def test_run_whose_lease_ran_out_cannot_touch_the_next_holders_lock(self):
+        stale = SyncLock()
+        self.assertTrue(stale.acquire())
+        cache.delete(SYNC_LOCK_KEY)
+        holder = SyncLock()
+        self.assertTrue(holder.acquire())
+
+        self.assertFalse(stale.renew())
+        stale.release()
+        self.assertTrue(holder.held())
+        with self.assertRaises(SyncLockLost):
+            stale.ensure_held()
+
+    @override_settings(SYNC_LOCK_LEASE_SECONDS=10)
+    def test_follow_up_lasts_as_long_as_the_run_renews_its_lock(self):
+        started = time.time()
+        holder = SyncLock()
+        self.assertTrue(holder.acquire())
+        request_follow_up(91, SyncRun.MODE_INCREMENTAL)
+
+        # Well past the follow-up's own timeout of four leases
+        with mock.patch("time.time") as clock:
+            for elapsed in range(8, 64, 8):
+                clock.return_value = started + elapsed
+                self.assertTrue(holder.renew())
+            follow_up = pop_follow_up()
+
+        self.assertEqual(follow_up, {"days": 91, "mode": SyncRun.MODE_INCREMENTAL, "sharded": False})
+
+    def test_sharded_follow_up_is_run_by_the_sharded_task(self):
+        holder = SyncLock()
+        self.assertTrue(holder.acquire())
+        request_follow_up(91, SyncRun.MODE_FULL, sharded=True)
+        holder.release()
+
+        # The holder lets go between the trigger missing the lock and retrying it
+        lock = SyncLock()
+        with mock.patch.object(lock.store, "acquire", side_effect=[False, True]), \
+                mock.patch.object(fetch_workshop_workload_sharded, "delay") as delay:
+            claimed = claim_sync(lock, 28, SyncRun.MODE_INCREMENTAL)
+
+        self.assertIsNone(claimed)
+        delay.assert_called_once_with(91, mode=SyncRun.MODE_FULL)
+        self.assertIsNone(pop_follow_up())
+
+    def test_run_that_lost_its_lock_writes_nothing(self):
+        def lose_lock(**kwargs):
+            cache.delete(SYNC_LOCK_KEY)
+            return {"opportunities_with_items": [opportunity_payload(1)], "active_products": []}
+
+        with mock.patch("workload.tasks.fetch_workload_data", side_effect=lose_lock):
+            with self.assertRaises(SyncLockLost):
+                fetch_workshop_workload(91)
+
+        self.assertFalse(Opportunity.objects.exists())
+        self.assertEqual(SyncRun.objects.get().status, SyncRun.STATUS_FAILED)
+        self.assertTrue(SyncLock().acquire())
+
+
+@override_settings(CURRENT_RMS_WEBHOOK_SECRET="webhook-secret")
+class WebhookTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def send(self, payload, secret="webhook-secret", sent_at=None):
+        """Post a webhook signed the way Current RMS's stand-in signs it"""
+        body = json.dumps(payload).encode()
+        timestamp = str(int(sent_at if sent_at is not None else time.time()))
+        return self.client.post(
+            "/workload/webhooks/current-rms/", data=body, content_type="application/json",
+            headers={
+                TIMESTAMP_HEADER: timestamp,
+                SIGNATURE_HEADER: sign_payload(body, timestamp, secret),
+            })
+
+    @mock.patch.object(resync_opportunity, "apply_async")
+    def test_badly_signed_or_stale_requests_are_refused(self, apply_async):
+        self.assertEqual(self.send(build_event(1), secret="wrong").status_code, 401)
+        self.assertEqual(self.send(build_event(1), sent_at=time.time() - 3600).status_code, 401)
+        apply_async.assert_not_called()
+
+    @mock.patch.object(resync_opportunity, "apply_async")
+    def test_burst_of_events_queues_one_resync(self, apply_async):
+        statuses = [
+            self.send(build_event(7, action)).json()["status"]
+            for action in ("create", "update", "update")
+        ]
+
+        self.assertEqual(statuses, ["queued", "debounced", "debounced"])
+        apply_async.assert_called_once_with((7,), countdown=10)
+        self.assertEqual(self.send(build_event(8, "update")).json()["status"], "queued")
+
+    def test_resync_updates_then_deactivates_one_opportunity(self):
+        fixture = synthetic_fixture(30, days=91)
+        with replay_fixture(fixture):
+            fetch_workshop_workload(91, mode=SyncRun.MODE_FULL)
+        record = next(
+            record for record in fixture["opportunities"]
+            if Opportunity.objects.filter(current_id=record["id"], is_active=True).exists())
+        record["subject"] = "Renamed in Current RMS"
+
+        with replay_fixture(fixture) as adapter:
+            result = resync_opportunity(record["id"])
+        self.assertEqual(result["outcome"], "synced")
+        self.assertEqual(adapter.calls, 2)
+        self.assertEqual(
+            Opportunity.objects.get(current_id=record["id"]).opportunity_name,
+            "Renamed in Current RMS")
+        self.assertIn("Renamed in Current RMS", WorkshopSnapshot.objects.first().payload)
+
+        fixture["opportunities"].remove(record)
+        with replay_fixture(fixture):
+            result = resync_opportunity(record["id"])
+        self.assertEqual(result["outcome"], "deactivated")
+        self.assertFalse(Opportunity.objects.get(current_id=record["id"]).is_active)
+
+    def test_resync_whose_write_failed_is_retried_not_reported_synced(self):
+        fixture = synthetic_fixture(5, days=91)
+        record = fixture["opportunities"][0]
+
+        def fail_write(opportunities_with_items, failed_ids):
+            failed_ids.add(opportunities_with_items[0]["opportunity"]["id"])
+
+        with replay_fixture(fixture), \
+                mock.patch("workload.tasks.in_sync_scope", return_value=True), \
+                mock.patch("workload.tasks.sync_opportunities", side_effect=fail_write), \
+                mock.patch.object(resync_opportunity, "retry", side_effect=Retry) as retry:
+            resync_opportunity.apply((record["id"],))
+
+        retry.assert_called_once_with(countdown=30)
+
+    def test_resync_backs_off_then_hands_off_while_a_sync_holds_the_lock(self):
+        self.assertTrue(claim_resync(7))
+        lock = SyncLock()
+        self.assertTrue(lock.acquire())
+        self.addCleanup(lock.release)
+
+        with mock.patch.object(resync_opportunity, "retry", side_effect=Retry) as retry:
+            resync_opportunity.apply((7,), retries=3)
+        retry.assert_called_once_with(countdown=240)
+        self.assertFalse(claim_resync(7))
+
+        with mock.patch.object(fetch_workshop_workload, "delay") as delay:
+            result = resync_opportunity.apply((7,), retries=resync_opportunity.max_retries).get()
+        self.assertEqual(result["status"], "handed_off")
+        delay.assert_called_once_with(91, mode=SyncRun.MODE_INCREMENTAL)
+        # Later events for the opportunity schedule a resync again
+        self.assertTrue(claim_resync(7))
+
+
+class FakePubSub:
+    """Stands in for a Redis pub/sub connection, delivering the given messages then going quiet"""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.subscribed = []
+        self.closed = False
+
+    async def subscribe(self, channel):
+        self.subscribed.append(channel)
+
+    async def get_message(self, timeout=None):
+        if self.messages:
+            return {"type": "message", "data": self.messages.pop(0)}
+        return None
+
+    async def aclose(self):
+        self.closed = True
+
+
+@override_settings(WORKLOAD_EVENTS_REDIS_URL="redis://events.test:6379")
+class DashboardEventsTests(TestCase):
+
+    def setUp(self):
+        self.publisher = mock.Mock()
+        patcher = mock.patch("workload.events.get_publisher", return_value=self.publisher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_opportunity(1, timezone.now() + timedelta(days=7))
+
+    def published(self):
+        return [
+            json.loads(message) for channel, message in
+            (call.args for call in self.publisher.publish.call_args_list)
+            if channel == EVENTS_CHANNEL
+        ]
+
+    def test_new_snapshot_is_announced_once_committed(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            snapshot = publish_workshop_snapshot()
+            self.publisher.publish.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(
+            self.published(),
+            [{"type": "workshop", "version": snapshot.id, "opportunity_ids": None}])
+
+        # Publishing unchanged data writes no version, so nobody is told to refetch
+        with self.captureOnCommitCallbacks(execute=True):
+            publish_workshop_snapshot()
+        self.assertEqual(len(self.published()), 1)
+
+    def test_custom_input_edit_names_the_opportunity(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                "/workload/opportunities/1/custom_input/",
+                data=json.dumps({"num_of_carpenters": 4}), content_type="application/json")
+
+        event, = self.published()
+        self.assertEqual(event["type"], "workshop")
+        self.assertEqual(event["opportunity_ids"], [1])
+
+    def test_stream_is_refused_to_anonymous_users(self):
+        self.assertEqual(self.client.get("/workload/events/").status_code, 401)
+        self.assertEqual(
+            asyncio.run(self.async_client.get("/workload/events/")).status_code, 401)
+
+    def test_stream_is_refused_outside_asgi(self):
+        self.client.force_login(get_user_model().objects.create_user("viewer"))
+        self.assertEqual(self.client.get("/workload/events/").status_code, 204)
+
+    def test_stream_frames_events_and_keeps_idle_connection_alive(self):
+        pubsub = FakePubSub([json.dumps({"type": "workshop", "version": 3}).encode(), b"not json"])
+        redis_client = mock.Mock(pubsub=mock.Mock(return_value=pubsub), aclose=mock.AsyncMock())
+
+        async def read(count):
+            stream = event_stream(heartbeat=0)
+            frames = [await anext(stream) for _ in range(count)]
+            await stream.aclose()
+            return frames
+
+        with mock.patch("redis.asyncio.Redis.from_url", return_value=redis_client):
+            frames = asyncio.run(read(3))
+
+        self.assertEqual(frames, [
+            "retry: 5000\n\n",
+            'event: workshop\ndata: {"type": "workshop", "version": 3}\n\n',
+            ": keep-alive\n\n",
+        ])
+        self.assertEqual(pubsub.subscribed, [EVENTS_CHANNEL])
+        self.assertTrue(pubsub.closed)
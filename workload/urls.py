@@ -4,11 +4,14 @@ from . import views
 urlpatterns = [
     path('', views.workload, name='workload'),
     path('api/workload/', views.api_workload, name='api_workload'),
+    path('events/', views.workload_events, name='workload_events'),
     
     # Workshop Workload Views
     path('workshop_workload/', views.workshop_workload, name='workshop_workload'),
     path('get_workshop_workload_data/', views.get_workshop_workload_data, name='get_workshop_workload_data'),
     path('opportunities/<int:current_id>/custom_input/', views.custom_input, name="custom_input"),
+    path('opportunities/custom_inputs/', views.bulk_custom_input, name="bulk_custom_input"),
+    path('webhooks/current-rms/', views.current_rms_webhook, name="current_rms_webhook"),
 
     # Celery Task Endpoints
     # path('api/start_workshop_workload_task/', views.start_workshop_workload_task, name='start_workload_task'),  # Potentially won't be using this url anymore
@@ -5,15 +5,43 @@ from datetime import (
     timezone,
     date
 )
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from dateutil import parser
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone as django_timezone
 from .api_calls import (
+    PageCursor,
+    PageFetchError,
     get_opportunities,
     get_products,
-    get_opportunity_items,)
-from .models import Tag
+    get_opportunity_items,
+    get_rate_limiter,
+    iter_opportunities,)
+from .sync_stats import phase, submit_in_context
+from .events import publish_change
+from .models import Opportunity, ScenicCalcItems, WorkshopSnapshot
 from django.db import models
+from django.db.models import Prefetch
+from django.db.models.functions import Coalesce
+import hashlib
+import json
+import logging
 import math
 
+logger = logging.getLogger(__name__)
+
+# How many times a streamed page walk is resumed after a page fails
+PAGE_RESUME_ATTEMPTS = 2
+# Slack added to each side of the date window sent to the API
+DATE_WINDOW_MARGIN = timedelta(days=1)
+# The (state, status) buckets of opportunities the workshop sync lists:
+# provisional and reserved quotations, and open orders
+SYNCED_OPPORTUNITY_BUCKETS = ((2, 1), (2, 5), (3, 0))
+
+
 def round_to_decimal(value, decimal_places=2):
     """
     Round a value to a given number of decimal places.
@@ -95,15 +123,50 @@ def weight_calc(opportunities_within_date):
     return total_weight
 
 
-def get_opps_with_items(opportunities):
+def get_opps_with_items(opportunities, max_workers=None):
+    """
+    Get opportunity items for each opportunity in the list.
+
+    The items are fetched on a thread pool, with the requests to the
+    Current RMS host spaced out by the host's shared rate limiter, at
+    settings.CURRENT_RMS_RATE_LIMIT.
+
+    Parameters:
+    - opportunities: The opportunities to fetch items for
+    - max_workers: The number of concurrent fetches, defaults to
+    settings.ITEM_FETCH_WORKERS
+
+    Returns:
+    - A list of {'opportunity', 'items'} dicts in the same order as the
+    input. 'items' is None where the fetch failed, so one bad opportunity
+    does not abort the batch.
     """
-    Get opportunity items for each opportunity in the list."""
+    if max_workers is None:
+        max_workers = settings.ITEM_FETCH_WORKERS
+
+    limiter = get_rate_limiter(settings.API_URL)
+
+    def fetch_items(opportunity):
+        limiter.wait()
+        try:
+            return get_opportunity_items(opportunity['id'])
+        except Exception as e:
+            logger.error(
+                f"Failed to fetch items for opportunity {opportunity['id']}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [
+            submit_in_context(executor, fetch_items, opportunity)
+            for opportunity in opportunities
+        ]
+        results = [future.result() for future in futures]
+
     opps_with_items = []
-    for opportunity in opportunities:
-        id = opportunity['id']
-        items = []
-        opportunity_items = get_opportunity_items(id)
-        items.extend(opportunity_items)
+    for opportunity, items in zip(opportunities, results):
+        if items is None:
+            logger.warning(
+                f"Items unavailable for opportunity {opportunity['id']}")
         opps_with_items.append({
             'opportunity': opportunity,
             'items': items
@@ -126,36 +189,121 @@ def remove_product(active_products, num):
     return active_products
 
 
-def fetch_workload_data(days=14):
+def run_concurrently(*calls):
     """
-    Fetch and process the workshop workload data.
-    This logic is used by both the view and the Celery task.
+    Run independent API calls at the same time.
+
+    Parameters:
+    - calls: Zero-argument callables, such as functools.partial objects
+
+    Returns:
+    - The results in the same order as the calls, so the total wait is
+    the slowest call rather than the sum of them all
     """
-    # Get the opportunities from the API
-    provisional_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=2, status_eq=1)
-    reserved_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=2, status_eq=5)
-    confirmed_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=3, status_eq=0)
+    with ThreadPoolExecutor(max_workers=max(1, len(calls))) as executor:
+        futures = [submit_in_context(executor, call) for call in calls]
+        return [future.result() for future in futures]
 
-    all_active_products = get_products(
-        page=1, per_page=20, filtermode='active', product_group='Scenic Calcs')
 
-    active_products = remove_product(all_active_products, 4597)
+def date_window_filters(days):
+    """
+    Build the starts_at bounds that ask the API for the opportunities
+    starting within the given days.
 
-    # Create lists to store the opportunities within the specified days
-    opportunities_within_date = []
+    The window is a day wider on each side than date_check's, so clock
+    and timezone differences can only let extra opportunities through for
+    date_check to discard, never hold back ones it would keep.
+    """
+    today = datetime.now(timezone.utc)
+    return {
+        'starts_at_gteq': today - DATE_WINDOW_MARGIN,
+        'starts_at_lteq': today + timedelta(days=days) + DATE_WINDOW_MARGIN,
+    }
+
+
+def stream_within_date(days, resume_attempts=PAGE_RESUME_ATTEMPTS, **filters):
+    """
+    Stream one opportunity status bucket through date_check as its pages
+    arrive, so only the opportunities within the given days are kept.
+
+    A page that fails is retried from the page cursor, keeping everything
+    already checked, up to resume_attempts times before the
+    PageFetchError is raised.
+    """
+    within_date = []
+    cursor = PageCursor()
+
+    for attempt in range(resume_attempts + 1):
+        try:
+            return date_check(
+                iter_opportunities(cursor=cursor, **filters), within_date, days)
+        except PageFetchError as e:
+            if attempt == resume_attempts:
+                raise
+            logger.warning(f"{e}, resuming from page {cursor.page}")
+
+
+def fetch_opportunities_within_date(days=14, updated_since=None):
+    """
+    Fetch the provisional, reserved and confirmed opportunities that start
+    within the given days, optionally only those updated since a datetime.
+    """
+    # Stream the opportunities from the API, one status bucket per thread.
+    # The API filters on the date window and date_check stays as a safety net
+    window = date_window_filters(days)
+    buckets = run_concurrently(*(
+        partial(stream_within_date, days, per_page=25, state_eq=state,
+                status_eq=status, updated_at_gt=updated_since, **window)
+        for state, status in SYNCED_OPPORTUNITY_BUCKETS
+    ))
+
+    return [opportunity for bucket in buckets for opportunity in bucket]
 
-    # Check the dates of the opportunities and append to the lists
-    date_check(
-        provisional_opportunities, opportunities_within_date, days)
-    date_check(reserved_opportunities, opportunities_within_date, days)
-    date_check(confirmed_opportunities, opportunities_within_date, days)
+
+def in_sync_scope(opportunity, days):
+    """
+    Check whether the sync would list an opportunity: it is in one of the
+    synced state and status buckets and starts within the given days
+    """
+    bucket = (opportunity.get('state'), opportunity.get('status'))
+    return bucket in SYNCED_OPPORTUNITY_BUCKETS and bool(
+        date_check([opportunity], [], days))
+
+
+def fetch_workload_listings(days=14, updated_since=None):
+    """
+    Fetch the opportunities within the given days and the active Scenic
+    Calc products at the same time, without the opportunity items.
+
+    Returns:
+    - The opportunities and the active products
+    """
+    with phase("fetch_listings"):
+        opportunities_within_date, all_active_products = run_concurrently(
+            partial(fetch_opportunities_within_date,
+                    days=days, updated_since=updated_since),
+            partial(get_products, page=1, per_page=20, filtermode='active',
+                    product_group='Scenic Calcs'),
+        )
+
+    return opportunities_within_date, remove_product(all_active_products, 4597)
+
+
+def fetch_workload_data(days=14, updated_since=None):
+    """
+    Fetch and process the workshop workload data.
+    This logic is used by both the view and the Celery task.
+
+    When updated_since is given only the opportunities updated after it
+    are fetched, for the incremental sync.
+    """
+    opportunities_within_date, active_products = fetch_workload_listings(
+        days=days, updated_since=updated_since)
 
     # Get the opportunity items for each opportunity
-    opportunities_with_items = get_opps_with_items(
-        opportunities_within_date)
+    with phase("fetch_items"):
+        opportunities_with_items = get_opps_with_items(
+            opportunities_within_date)
 
     data = {
         'opportunities_with_items': opportunities_with_items,
@@ -165,6 +313,274 @@ def fetch_workload_data(days=14):
     return data
 
 
+def build_workload_summary(days=14):
+    """
+    Build the warehouse workload summary served by api_workload from the
+    live API.
+
+    Parameters:
+    - days: The number of days ahead to weigh the opportunities over
+
+    Returns:
+    - A dict of the weight per status and the confirmed and active
+    opportunities
+    """
+    # Get the opportunities from the API, one status bucket per thread.
+    # Every confirmed and active opportunity is returned, so only the
+    # provisional and reserved buckets are filtered on the date window
+    window = date_window_filters(days)
+    (
+        provisional_opportunities,
+        reserved_opportunities,
+        confirmed_opportunities,
+        active_opportunities,
+    ) = run_concurrently(
+        partial(get_opportunities, page=1, per_page=25, state_eq=2, status_eq=1, **window),
+        partial(get_opportunities, page=1, per_page=25, state_eq=2, status_eq=5, **window),
+        partial(get_opportunities, page=1, per_page=25, state_eq=3, status_eq=0),
+        partial(get_opportunities, page=1, per_page=25, state_eq=3, status_eq=20),
+    )
+
+    # Create lists to store the opportunities within the specified days
+    provisional_within_date = []
+    reserved_within_date = []
+    confirmed_within_date = []
+
+    # Check the dates of the opportunities and append to the lists
+    date_check(
+        provisional_opportunities, provisional_within_date, days)
+    date_check(reserved_opportunities, reserved_within_date, days)
+    date_check(confirmed_opportunities, confirmed_within_date, days)
+
+    # Calculate the weight of the opportunities
+    provisional_weight = weight_calc(provisional_within_date)
+    reserved_weight = weight_calc(reserved_within_date)
+    confirmed_weight = weight_calc(confirmed_within_date)
+
+    return {
+        'provisional_weight': provisional_weight,
+        'reserved_weight': reserved_weight,
+        'confirmed_weight': confirmed_weight,
+        'confirmed_opportunities': confirmed_opportunities,
+        'active_opportunities': active_opportunities,
+    }
+
+
+def workload_cache_key(days):
+    """The cache key for the api_workload summary over the given days"""
+    return f'workload:api_workload:{days}'
+
+
+def refresh_workload_summary(days=14):
+    """
+    Rebuild the api_workload summary and store it in the cache, stamped
+    with the time it was built so readers can tell when it has gone stale
+    and with a content hash that only changes when the data does.
+    """
+    data = build_workload_summary(days)
+    serialised = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+    entry = {
+        'data': data,
+        'etag': hashlib.sha1(serialised.encode()).hexdigest(),
+        'refreshed_at': django_timezone.now(),
+    }
+    previous = cache.get(workload_cache_key(days))
+    cache.set(
+        workload_cache_key(days), entry,
+        timeout=settings.WORKLOAD_CACHE_MAX_AGE)
+
+    # Only screens showing a summary that has changed need to refetch it
+    if previous is None or previous.get('etag') != entry['etag']:
+        publish_change('workload', days=days)
+    return entry
+
+
+def serialize_workshop_opportunity(opp):
+    """
+    Serialise an opportunity for the workshop workload dashboard.
+
+    Expects the relations loaded by build_workshop_workload_data, so no
+    further queries are made.
+    """
+    items = []
+    tags = [tag.name for tag in opp.tags.all()]
+
+    for sci in opp.scenic_calc_items.all():
+        items.append({
+            "current_item_id": sci.current_item_id,
+            "name": sci.name,
+            "item_total": float(sci.item_total or 0),
+            "previous_item_total": float(sci.previous_item_total or 0),
+            "item_updated_at": sci.updated_at.isoformat() if sci.updated_at else None,
+            "item_previously_updated_at": sci.previously_updated_at.isoformat() if sci.previously_updated_at else None,
+        })
+    scenic_total = getattr(opp, "scenic_calc_total", None)
+
+    return {
+        "opportunity_id": opp.current_id,
+        "name": opp.opportunity_name,
+        "previous_name": opp.previous_opportunity_name,
+        "client": opp.client.name,
+        "owner": opp.owner.name,
+        "venue": opp.venue.name if opp.venue else None,
+        "order_number": opp.order_number,
+        "status": opp.status,
+        "status_name": opp.status_name,
+        "previous_status_name": opp.previous_status_name,
+        "dry_hire": opp.dry_hire,
+        "dry_hire_transport": opp.dry_hire_transport,
+        "starts_at": opp.starts_at,
+        "ends_at": opp.ends_at,
+        "load_starts_at": opp.load_starts_at,
+        "deliver_starts_at": opp.deliver_starts_at,
+        "setup_starts_at": opp.setup_starts_at,
+        "show_starts_at": opp.show_starts_at,
+        "tags": tags,
+        "opp_updated_at": opp.updated_at,
+        "items": items,
+        "custom_input": {
+            "include_weekends": opp.custom_input.include_weekends,
+            "previous_include_weekends": opp.custom_input.previous_include_weekends,
+            "num_of_carpenters": opp.custom_input.num_of_carpenters,
+            "previous_num_of_carpenters": opp.custom_input.previous_num_of_carpenters,
+            "planned_finish_date": opp.custom_input.planned_finish_date,
+            "previous_planned_finish_date": opp.custom_input.previous_planned_finish_date,
+            "built": opp.custom_input.built,
+            "updated_at": opp.custom_input.updated_at,
+            "previously_updated_at": opp.custom_input.previously_updated_at,
+            "working_days": float(opp.custom_input.working_days or 0),
+            "previous_working_days": float(opp.custom_input.previous_working_days or 0),
+            "date_out": opp.custom_input.date_out,
+            "previous_date_out": opp.custom_input.previous_date_out,
+            "time_out": opp.custom_input.time_out.strftime("%H:%M") if opp.custom_input.time_out else None,
+            "previous_time_out":opp.custom_input.previous_time_out.strftime("%H:%M") if opp.custom_input.previous_time_out else None,
+            "start_build_date": opp.custom_input.start_build_date,
+        },
+        "totals": {
+            "grand_total": float(scenic_total.grand_total) if scenic_total else 0,
+            "previous_grand_total": float(scenic_total.previous_grand_total) if scenic_total and scenic_total.previous_grand_total else 0,
+        },
+    }
+
+
+def active_opportunities_starting_within(days):
+    """
+    Return the active opportunities whose effective start (load, else
+    deliver, else the opportunity start) falls within the given days.
+
+    The filter matches the opp_active_effective_start_idx index expression.
+    """
+    today = django_timezone.now().date()
+    future_date = today + timedelta(days=days)
+
+    return Opportunity.objects.annotate(
+        effective_start = Coalesce("load_starts_at", "deliver_starts_at", "starts_at")
+    ).filter(
+        is_active=True,
+        effective_start__range=[today, future_date]
+    )
+
+
+def build_workshop_workload_data(days=91):
+    """
+    Build the workshop workload dashboard data for the active opportunities
+    starting within the given days.
+
+    The single-valued relations are joined in and the tags and active item
+    groups prefetched, so the query count does not grow with the number of
+    opportunities.
+    """
+    opportunities = (
+        active_opportunities_starting_within(days).select_related(
+            "client",
+            "owner",
+            "venue",
+            "custom_input",
+            "scenic_calc_total",
+        ).prefetch_related(
+            Prefetch(
+                "scenic_calc_items",
+                queryset=ScenicCalcItems.objects.filter(is_active=True)
+            ),
+            "tags",
+        ).order_by("effective_start")
+    )
+
+    return [serialize_workshop_opportunity(opp) for opp in opportunities]
+
+
+def publish_workshop_snapshot(keep=5, opportunity_ids=None):
+    """
+    Serialise the workshop workload dashboard data into a new snapshot
+    version and prune all but the latest `keep` versions.
+
+    When the data is the same as the latest snapshot's no new version is
+    written, so clients holding its ETag are not sent it again. A new
+    version is announced to the open dashboards with a "workshop" event,
+    naming the opportunity_ids edited when a custom input edit caused it.
+
+    Returns:
+    - The new WorkshopSnapshot, or the latest one if nothing changed
+    """
+    data = build_workshop_workload_data()
+    payload = json.dumps({"result": data}, cls=DjangoJSONEncoder)
+
+    latest = WorkshopSnapshot.objects.first()
+    if latest is not None and latest.payload == payload:
+        return latest
+
+    snapshot = WorkshopSnapshot.objects.create(
+        payload=payload,
+        opportunity_count=len(data),
+    )
+
+    stale_ids = WorkshopSnapshot.objects.values_list(
+        "id", flat=True)[keep:]
+    WorkshopSnapshot.objects.filter(id__in=list(stale_ids)).delete()
+
+    publish_change(
+        'workshop', version=snapshot.id,
+        opportunity_ids=sorted(opportunity_ids) if opportunity_ids else None)
+    return snapshot
+
+
+def get_workshop_snapshot():
+    """
+    Get the latest workshop snapshot, publishing the first one if none
+    exists yet
+    """
+    snapshot = WorkshopSnapshot.objects.first()
+    if snapshot is None:
+        snapshot = publish_workshop_snapshot()
+    return snapshot
+
+
+def latest_updated_at(opportunities, default=None):
+    """
+    Get the latest updated_at across the opportunities, as the high-water
+    mark for the next incremental sync
+    """
+    latest = default
+    for opportunity in opportunities:
+        updated_at = parse_datetime_safe(opportunity.get('updated_at'))
+        if updated_at and (latest is None or updated_at > latest):
+            latest = updated_at
+    return latest
+
+
+def hold_back_watermark(watermark, failed_opportunities):
+    """
+    Hold a watermark back to the earliest updated_at of the opportunities
+    that were skipped or failed to write, so the next incremental sync,
+    which asks for those updated after it, fetches them again
+    """
+    for opportunity in failed_opportunities:
+        updated_at = parse_datetime_safe(opportunity.get('updated_at'))
+        if updated_at and (watermark is None or updated_at < watermark):
+            watermark = updated_at
+    return watermark
+
+
 def parse_datetime_safe(date_str):
     """A function to parse datetime strings to a datetime object"""
 
@@ -183,32 +599,6 @@ def parse_decimal_safe(value):
         return Decimal("0.0")
 
 
-def get_previous_updated_at(model_cls, lookup: dict):
-    """A helper function to get the previous updated_at value from a model"""
-    try:
-        return model_cls.objects.get(**lookup).updated_at
-    except model_cls.DoesNotExist:
-        return None
-
-
-def assign_tags(model_obj, tag_names):
-    """
-    Assigns tags to a model instance with a ManyToManyField to Tag.
-
-    Parameters:
-        model_obj: The instance (e.g. owner, client, opportunity).
-        tag_names: A list of tag name strings.
-    """
-    if not model_obj:
-        return
-    try:
-        model_obj.tags.clear()
-        tags = [Tag.objects.get_or_create(name=name)[0] for name in tag_names]
-        model_obj.tags.add(*tags)
-    except Exception as e:
-        print(f"[ERROR] Failed to assign tags to {model_obj}: {e}")
-
-
 def calculate_working_days(total_hours, carpenters_input):
     """
     Calcaulates the number of working days required for an opportunity
@@ -294,70 +684,87 @@ def create_start_build_date(working_days, date_out, include_weekends, planned_fi
     return start_build_date
 
 
-def update_model_with_history(
-    model,
-    lookup,
+def changed_fields(instance, values):
+    """
+    Returns the names of the given fields whose values differ from the
+    instance's.
+
+    Values are compared as the field would store them, so a payload string
+    and the stored UUID, date or decimal it stands for are equal, decimals
+    are rounded to the column's places, and relations are compared by id
+    without loading the related object.
+    """
+    changed = []
+    for name, value in values.items():
+        field = instance._meta.get_field(name)
+        if field.is_relation:
+            current = getattr(instance, field.attname)
+            value = getattr(value, "pk", value)
+        else:
+            current = getattr(instance, name)
+            if value is not None:
+                value = field.to_python(value)
+                if isinstance(field, models.DecimalField):
+                    value = round(value, field.decimal_places)
+        if current != value:
+            changed.append(name)
+    return changed
+
+
+def has_changes(instance, values):
+    """Returns whether any of the given field values differ from the instance's"""
+    return bool(changed_fields(instance, values))
+
+
+def apply_history(
+    instance,
     defaults,
     previous_fields,
     updated_at_field="updated_at",
 ):
-    print("\n--- update_model_with_history CALLED ---")
-    print("Model:", model.__name__)
-    print("Lookup:", lookup)
-    print("Defaults BEFORE applying:", defaults)
-
-    # 1 - Load the existing instance properly
-    instance = model.objects.filter(**lookup).first()
-    created = False
-
-    print("Fetched instance:", instance)
-
-    if not instance:
-        # New object: create normally
-        print("No instance found — creating new one")
-
-        instance = model.objects.create(**lookup, **defaults)
-        created = True
-
-        print("Created new instance:", instance)
-        return instance, created
-
-    # 2 - Existing instance — set previous_* BEFORE updating
-    print("EXISTING instance detected -- setting previous_ values")
+    """
+    Applies new values to an existing instance in memory, keeping the
+    stored values of the tracked fields on their previous_* counterparts.
 
+    Parameters:
+        instance: The existing model instance to update.
+        defaults: A dict of field names to their new values.
+        previous_fields: The fields whose old value is kept on previous_<field>.
+        updated_at_field: The timestamp copied to previously_updated_at.
+    """
     for field in previous_fields:
-        old = getattr(instance, field, None)
-        new = defaults.get(field)
-
-        prev_field = f"previous_{field}"
-
-        print(f"[FIELD] {field}: old={old}, new={new}")
-        print(f"--> Setting {prev_field} = {old}")
+        setattr(instance, f"previous_{field}", getattr(instance, field, None))
+        setattr(instance, field, defaults.get(field))
 
-        setattr(instance, prev_field, old)
-
-        # Apply the new value
-        setattr(instance, field, new)
-
-    # 3 - Handle previously_updated_at
     if hasattr(instance, "previously_updated_at"):
-        old_timestamp = getattr(instance, updated_at_field, None)
-        print(f"Saving previously_updated_at = {old_timestamp}")
-        instance.previously_updated_at = old_timestamp
+        instance.previously_updated_at = getattr(
+            instance, updated_at_field, None)
 
-    # 4 - Apply any other non-tracked defaults
     for key, value in defaults.items():
         if key not in previous_fields:
             setattr(instance, key, value)
 
-    print("Saving instance with updated values...")
-    instance.save()
 
-    print("AFTER SAVE:")
-    if hasattr(instance, "previously_updated_at"):
-        print(f"previously_updated_at: {instance.previously_updated_at}")
-        
-    for f in previous_fields:
-        print(f"  {f}: {getattr(instance, f)} | previous_{f}: {getattr(instance, 'previous_'+f)}")
+def history_values(defaults):
+    """
+    The incoming values that decide whether a row changed, leaving out the
+    previous_* values derived from them
+    """
+    return {
+        field: value for field, value in defaults.items()
+        if not field.startswith("previous_")
+    }
+
 
-    return instance, created
+def history_update_fields(model, changed, previous_fields):
+    """
+    The columns written for a changed row: the changed fields, every
+    previous_* field that apply_history moves along, previously_updated_at
+    and the auto_now timestamps.
+    """
+    fields = set(changed)
+    fields.update(f"previous_{field}" for field in previous_fields)
+    for field in model._meta.concrete_fields:
+        if field.name == "previously_updated_at" or getattr(field, "auto_now", False):
+            fields.add(field.name)
+    return sorted(fields)
@@ -3,25 +3,38 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, get_object_or_404
 from django.views import View
-from django.http import JsonResponse, QueryDict
+from django.db import transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, QueryDict, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django_celery_results.models import TaskResult
 from django.utils import timezone
-from django.db.models.functions import Coalesce
-from django.db.models import Prefetch
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.core.serializers.json import DjangoJSONEncoder
 
 from datetime import timedelta
 from decimal import Decimal
 import json
 import logging
-from .tasks import fetch_workshop_workload
-from celery.result import AsyncResult
-from .api_calls import get_opportunities
+from django.core.cache import cache
+from .tasks import fetch_workshop_workload, refresh_workload_cache, resync_opportunity
 from .utils import (
-    weight_calc,
-    date_check,
     fetch_workload_data,
+    workload_cache_key,
+    get_workshop_snapshot,
+    publish_workshop_snapshot,
+)
+from .models import Opportunity, CustomInput
+from .events import event_stream
+from .webhooks import (
+    SIGNATURE_HEADER,
+    TIMESTAMP_HEADER,
+    verify_signature,
+    parse_opportunity_event,
+    claim_resync,
 )
-from .models import Opportunity, CustomInput, ScenicCalcItems
 
 logger = logging.getLogger(__name__)
 
@@ -47,50 +60,79 @@ def workshop_workload(request):
     return render(request, template)
 
 
+def conditional_json_response(request, content, etag, last_modified):
+    """
+    Answer a GET with 304 Not Modified when the client's If-None-Match or
+    If-Modified-Since shows its copy is current, otherwise with the JSON
+    from content(). Both carry the ETag and Last-Modified validators and
+    ask the browser to revalidate on every poll.
+    """
+    last_modified = int(last_modified.timestamp())
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(content(), content_type="application/json")
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+# Seconds a client is asked to wait before asking again for a summary that
+# is still being built
+WORKLOAD_REFRESH_RETRY_AFTER = 5
+
+
+def queue_workload_refresh(days):
+    """Queue a background refresh of the api_workload summary unless one already is"""
+    refresh_lock = f'{workload_cache_key(days)}:refreshing'
+    if cache.add(refresh_lock, True, timeout=settings.WORKLOAD_CACHE_TTL):
+        refresh_workload_cache.delay(days)
+
+
 def api_workload(request: QueryDict):
     """
     A view to expose the workload data to the frontend for
     the workload display for the warehouse
+
+    The data is served from the cache. Once it is older than
+    WORKLOAD_CACHE_TTL a background refresh is queued. When nothing has
+    been cached yet the refresh is queued and the view answers 202 with a
+    Retry-After, so a request never waits on the API.
     """
 
     # Get the 'days' query parameter, otherwise default to 14
-    days = int(request.GET.get('days', 14))
-
-    # Get the opportunities from the API
-    provisional_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=2, status_eq=1)
-    reserved_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=2, status_eq=5)
-    confirmed_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=3, status_eq=0)
-    active_opportunities = get_opportunities(
-        page=1, per_page=25, state_eq=3, status_eq=20)
-
-    # Create lists to store the opportunities within the specified days
-    provisional_within_date = []
-    reserved_within_date = []
-    confirmed_within_date = []
-
-    # Check the dates of the opportunities and append to the lists
-    date_check(
-        provisional_opportunities, provisional_within_date, days)
-    date_check(reserved_opportunities, reserved_within_date, days)
-    date_check(confirmed_opportunities, confirmed_within_date, days)
-
-    # Calculate the weight of the opportunities
-    provisional_weight = weight_calc(provisional_within_date)
-    reserved_weight = weight_calc(reserved_within_date)
-    confirmed_weight = weight_calc(confirmed_within_date)
-
-    data = {
-        'provisional_weight': provisional_weight,
-        'reserved_weight': reserved_weight,
-        'confirmed_weight': confirmed_weight,
-        'confirmed_opportunities': confirmed_opportunities,
-        'active_opportunities': active_opportunities,
-    }
-
-    return JsonResponse(data)
+    try:
+        days = int(request.GET.get('days', 14))
+    except ValueError:
+        days = None
+    if days not in settings.WORKLOAD_SUMMARY_DAYS:
+        return JsonResponse({
+            "error": "days must be one of "
+                     + ", ".join(str(allowed) for allowed in settings.WORKLOAD_SUMMARY_DAYS),
+        }, status=400)
+
+    entry = cache.get(workload_cache_key(days))
+
+    if entry is None or 'etag' not in entry:
+        queue_workload_refresh(days)
+        response = JsonResponse({"status": "refreshing", "days": days}, status=202)
+        response["Retry-After"] = str(WORKLOAD_REFRESH_RETRY_AFTER)
+        patch_cache_control(response, no_store=True)
+        return response
+
+    age = timezone.now() - entry['refreshed_at']
+    if age > timedelta(seconds=settings.WORKLOAD_CACHE_TTL):
+        queue_workload_refresh(days)
+
+    return conditional_json_response(
+        request,
+        lambda: json.dumps(entry['data'], cls=DjangoJSONEncoder),
+        etag=f'"workload-{days}-{entry["etag"]}"',
+        last_modified=entry['refreshed_at'],
+    )
 
 
 # def api_workshop_workload(request=None):
@@ -109,93 +151,123 @@ def api_workload(request: QueryDict):
 
 
 def get_workshop_workload_data(request):
-    """A view to get the latest workload result from the database in the next 91 days"""
-
-    today = timezone.now().date()
-    future_date = today + timedelta(days=91)
-
-    opportunities = (
-        Opportunity.objects.annotate(
-            effective_start = Coalesce("load_starts_at", "deliver_starts_at", "starts_at")
-        ).filter(
-            is_active=True,
-            effective_start__range=[today, future_date]
-        ).prefetch_related(
-            Prefetch(
-                "scenic_calc_items",
-                queryset=ScenicCalcItems.objects.filter(is_active=True)
-            ),
-            "tags",
-            "client",
-            "owner",
-            "venue",
-            "custom_input"
-        ).order_by("effective_start")
+    """
+    A view to get the latest workload result from the database in the next 91 days
+
+    Serves the pre-serialised snapshot written by the sync task and custom
+    input edits rather than rebuilding it from the ORM on every poll.
+    """
+    snapshot = get_workshop_snapshot()
+
+    response = conditional_json_response(
+        request,
+        lambda: snapshot.payload,
+        etag=f'"workshop-{snapshot.id}"',
+        last_modified=snapshot.created_at,
     )
+    response["X-Snapshot-Version"] = str(snapshot.id)
+    return response
 
-    data = []
-    for opp in opportunities:
-        items = []
-        tags = [tag.name for tag in opp.tags.all()]
-
-        for sci in opp.scenic_calc_items.all():
-            items.append({
-                "current_item_id": sci.current_item_id,
-                "name": sci.name,
-                "item_total": float(sci.item_total or 0),
-                "previous_item_total": float(sci.previous_item_total or 0),
-                "item_updated_at": sci.updated_at.isoformat() if sci.updated_at else None,
-                "item_previously_updated_at": sci.previously_updated_at.isoformat() if sci.previously_updated_at else None,
-            })
-        scenic_total = getattr(opp, "scenic_calc_total", None)
-
-        data.append({
-            "opportunity_id": opp.current_id,
-            "name": opp.opportunity_name,
-            "previous_name": opp.previous_opportunity_name,
-            "client": opp.client.name,
-            "owner": opp.owner.name,
-            "venue": opp.venue.name if opp.venue else None,
-            "order_number": opp.order_number,
-            "status": opp.status,
-            "status_name": opp.status_name,
-            "previous_status_name": opp.previous_status_name,
-            "dry_hire": opp.dry_hire,
-            "dry_hire_transport": opp.dry_hire_transport,
-            "starts_at": opp.starts_at,
-            "ends_at": opp.ends_at,
-            "load_starts_at": opp.load_starts_at,
-            "deliver_starts_at": opp.deliver_starts_at,
-            "setup_starts_at": opp.setup_starts_at,
-            "show_starts_at": opp.show_starts_at,
-            "tags": tags,
-            "opp_updated_at": opp.updated_at,
-            "items": items,
-            "custom_input": {
-                "include_weekends": opp.custom_input.include_weekends,
-                "previous_include_weekends": opp.custom_input.previous_include_weekends,
-                "num_of_carpenters": opp.custom_input.num_of_carpenters,
-                "previous_num_of_carpenters": opp.custom_input.previous_num_of_carpenters,
-                "planned_finish_date": opp.custom_input.planned_finish_date,
-                "previous_planned_finish_date": opp.custom_input.previous_planned_finish_date,
-                "built": opp.custom_input.built,
-                "updated_at": opp.custom_input.updated_at,
-                "previously_updated_at": opp.custom_input.previously_updated_at,
-                "working_days": float(opp.custom_input.working_days or 0),
-                "previous_working_days": float(opp.custom_input.previous_working_days or 0),
-                "date_out": opp.custom_input.date_out,
-                "previous_date_out": opp.custom_input.previous_date_out,
-                "time_out": opp.custom_input.time_out.strftime("%H:%M") if opp.custom_input.time_out else None,
-                "previous_time_out":opp.custom_input.previous_time_out.strftime("%H:%M") if opp.custom_input.previous_time_out else None,
-                "start_build_date": opp.custom_input.start_build_date,
-            },
-            "totals": {
-                "grand_total": float(scenic_total.grand_total) if scenic_total else 0,
-                "previous_grand_total": float(scenic_total.previous_grand_total) if scenic_total.previous_grand_total else 0,
-            },
-        })
-    
-    return JsonResponse({"result": data})
+
+async def workload_events(request):
+    """
+    A view streaming change notifications to the dashboards as server-sent
+    events, see events.py, so they refetch only when the data changes.
+
+    Like the dashboards, the stream is only for signed in users, and
+    anyone else is answered 401 rather than redirected to the login page.
+
+    Answers 204 No Content, which tells the browser not to reconnect, when
+    no Redis is configured for the events or when served over WSGI, where a
+    never-ending stream would tie up a worker. The dashboards then fall
+    back to polling.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+
+    if not settings.WORKLOAD_EVENTS_REDIS_URL or not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop proxies buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+CUSTOM_INPUT_FIELDS = (
+    "num_of_carpenters",
+    "include_weekends",
+    "planned_finish_date",
+    "built",
+    "working_days",
+    "start_build_date",
+)
+
+
+def apply_custom_input_edit(opportunity, data):
+    """
+    Save the editable custom input fields present in data onto the
+    opportunity's custom input, creating it with the defaults if needed.
+
+    Returns the fields that were updated.
+    """
+    input_obj, _ = CustomInput.objects.get_or_create(
+        opportunity=opportunity,
+        defaults={
+            "num_of_carpenters": 1,
+            "include_weekends": False,
+            "planned_finish_date": None,
+            "built": False,
+        }
+    )
+
+    updated_fields = {}
+
+    for field in CUSTOM_INPUT_FIELDS:
+        if field in data:
+            setattr(input_obj, field, data[field])
+            updated_fields[field] = data[field]
+
+    input_obj.save()
+
+    return updated_fields
+
+
+def serialize_custom_input(current_id, input_obj):
+    """Serialise an opportunity's custom input, or the defaults if it has none"""
+    if not input_obj:
+        return {
+            "opportunity_id": current_id,
+            "num_of_carpenters": 1,
+            "include_weekends": False,
+            "planned_finish_date": None,
+            "built": False,
+            "updated_at": None,
+            "previously_updated_at": None,
+        }
+
+    return {
+        "opportunity_id": current_id,
+        "num_of_carpenters": input_obj.num_of_carpenters,
+        "include_weekends": input_obj.include_weekends,
+        "working_days": input_obj.working_days,
+        "start_build_date": (
+            input_obj.start_build_date.isoformat()
+            if input_obj.start_build_date else None
+        ),
+        "planned_finish_date": (
+            input_obj.planned_finish_date.isoformat()
+            if input_obj.planned_finish_date else None
+        ),
+        "built": input_obj.built,
+        "updated_at": input_obj.updated_at.isoformat(),
+        "previously_updated_at": (
+            input_obj.previously_updated_at.isoformat()
+            if input_obj.previously_updated_at else None
+        ),
+    }
 
 
 def custom_input(request, current_id):
@@ -204,38 +276,8 @@ def custom_input(request, current_id):
 
     if request.method == "POST":
         data = json.loads(request.body.decode("utf-8"))
-        input_obj, _ = CustomInput.objects.get_or_create(
-            opportunity=opportunity,
-            defaults={
-                "num_of_carpenters": 1,
-                "include_weekends": False,
-                "planned_finish_date": None,
-                "built": False,
-            }
-        )
-
-        updated_fields = {}
-
-        if "num_of_carpenters" in data:
-            input_obj.num_of_carpenters = data["num_of_carpenters"]
-            updated_fields["num_of_carpenters"] = data["num_of_carpenters"]
-        if "include_weekends" in data:
-            input_obj.include_weekends = data["include_weekends"]
-            updated_fields["include_weekends"] = data["include_weekends"]
-        if "planned_finish_date" in data:
-            input_obj.planned_finish_date = data["planned_finish_date"]
-            updated_fields["planned_finish_date"] = data["planned_finish_date"]
-        if "built" in data:
-            input_obj.built = data["built"]
-            updated_fields["built"] = data["built"]
-        if "working_days" in data:
-            input_obj.working_days = data["working_days"]
-            updated_fields["working_days"] = data["working_days"]
-        if "start_build_date" in data:
-            input_obj.start_build_date = data["start_build_date"]
-            updated_fields["start_build_date"] = data["start_build_date"]
-        
-        input_obj.save()
+        updated_fields = apply_custom_input_edit(opportunity, data)
+        publish_workshop_snapshot(opportunity_ids=[current_id])
 
         return JsonResponse({
             "status": "ok",
@@ -244,70 +286,104 @@ def custom_input(request, current_id):
     
     elif request.method == "GET":
         input_obj = getattr(opportunity, "custom_input", None)
+        return JsonResponse(serialize_custom_input(current_id, input_obj))
+    else:
+        return JsonResponse({"error": "Unsupported method"}, status=405)
 
-        if not input_obj:
-            return JsonResponse({
-                "opportunity_id": current_id,
-                "num_of_carpenters": 1,
-                "include_weekends": False,
-                "planned_finish_date": None,
-                "built": False,
-                "updated_at": None,
-                "previously_updated_at": None,
-            })
-        
-        data = {
-            "opportunity_id": current_id,
-            "num_of_carpenters": input_obj.num_of_carpenters,
-            "include_weekends": input_obj.include_weekends,
-            "working_days": input_obj.working_days,
-            "start_build_date": (
-                input_obj.start_build_date.isoformat()
-                if input_obj.start_build_date else None
-            ),
-            "planned_finish_date": (
-                input_obj.planned_finish_date.isoformat()
-                if input_obj.planned_finish_date else None
-            ),
-            "built": input_obj.built,
-            "updated_at": input_obj.updated_at.isoformat(),
-            "previously_updated_at": (
-                input_obj.previously_updated_at.isoformat()
-                if input_obj.previously_updated_at else None
-            ),
+
+def bulk_custom_input(request):
+    """
+    A view to retrieve or save the custom inputs for many opportunities at once
+
+    GET ?ids=1,2,3 returns {"results": {id: custom input}} in one query.
+    POST {"updates": [{"opportunity_id": id, <fields>}, ...]} applies every
+    edit in one transaction, so either all of them are saved or none are.
+    """
+    if request.method == "POST":
+        try:
+            updates = json.loads(request.body.decode("utf-8"))["updates"]
+            ids = {int(update["opportunity_id"]) for update in updates}
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": "Expected a list of updates with opportunity_id"}, status=400)
+
+        opportunities = Opportunity.objects.in_bulk(ids, field_name="current_id")
+        missing = sorted(ids - set(opportunities))
+        if missing:
+            return JsonResponse({"error": "Unknown opportunities", "missing": missing}, status=404)
+
+        results = {}
+        with transaction.atomic():
+            for update in updates:
+                current_id = int(update["opportunity_id"])
+                results[current_id] = apply_custom_input_edit(
+                    opportunities[current_id], update)
+        publish_workshop_snapshot(opportunity_ids=ids)
+
+        return JsonResponse({
+            "status": "ok",
+            "updated_data": results,
+        })
+
+    elif request.method == "GET":
+        try:
+            ids = [int(value) for value in request.GET.get("ids", "").split(",") if value]
+        except ValueError:
+            return JsonResponse({"error": "ids must be a comma separated list of integers"}, status=400)
+
+        opportunities = Opportunity.objects.filter(
+            current_id__in=ids
+        ).select_related("custom_input")
+
+        results = {
+            opportunity.current_id: serialize_custom_input(
+                opportunity.current_id, getattr(opportunity, "custom_input", None))
+            for opportunity in opportunities
         }
-        return JsonResponse(data)
+        return JsonResponse({"results": results})
     else:
         return JsonResponse({"error": "Unsupported method"}, status=405)
 
 
-# def start_workshop_workload_task(request):
-#     """Trigger Celery task and return task ID."""
-#     try:
-#         days_param = request.GET.get('days', '14')
-#         logger.info(f"📩 Received request to start Celery task with days={days_param}")
-        
-#         days = int(days_param)
+@csrf_exempt
+@require_POST
+def current_rms_webhook(request):
+    """
+    A view receiving signed Current RMS opportunity webhooks, see webhooks.py
 
-#         task = fetch_workshop_workload.delay(days)
-        
-#         logger.info(f"Celery task {task.id} triggered successfully with {days} days")
-#         return JsonResponse({"task_id": task.id})
-    
-#     except ValueError as ve:
-#         logger.error(f"❌ Invalid 'days' parameter: {ve}", exc_info=True)
-#         return JsonResponse({"error": "Invalid 'days' parameter"}, status=400)
-    
-#     except Exception as e:
-#         logger.error(f"🔥 Unexpected error: {e}", exc_info=True)
-#         return JsonResponse({"error": "Internal server error"}, status=500)
-
-
-# def check_task_status(request, task_id):
-#     """Check if Celery task is complete and return result."""
-#     result = AsyncResult(task_id)
-#     if result.ready():
-#         print(f"Task {task_id} completed with result")
-#         return JsonResponse({"status": "completed", "result": result.result})
-#     print(f"Task {task_id} still pending")
-#     return JsonResponse({"status": "pending"})
+    Create, update and delete events queue a resync of just that
+    opportunity, debounced so a burst of events for it is resynced once.
+    Other events are accepted and ignored.
+    """
+    secret = settings.CURRENT_RMS_WEBHOOK_SECRET
+    if not secret:
+        return JsonResponse({"error": "Webhooks are not configured"}, status=503)
+
+    if not verify_signature(
+            request.body,
+            request.headers.get(TIMESTAMP_HEADER),
+            request.headers.get(SIGNATURE_HEADER),
+            secret):
+        return JsonResponse({"error": "Invalid signature"}, status=401)
+
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    event = parse_opportunity_event(payload)
+    if event is None:
+        return JsonResponse({"status": "ignored"}, status=202)
+
+    current_id, action = event
+    queued = claim_resync(current_id)
+    if queued:
+        resync_opportunity.apply_async(
+            (current_id,), countdown=settings.WEBHOOK_DEBOUNCE_SECONDS)
+
+    logger.info("Webhook %s for opportunity %s %s", action, current_id,
+                "queued a resync" if queued else "was debounced")
+    return JsonResponse({
+        "status": "queued" if queued else "debounced",
+        "opportunity_id": current_id,
+        "action": action,
+    }, status=202)
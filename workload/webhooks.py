@@ -0,0 +1,110 @@
+"""
+Signed Current RMS webhooks for resyncing one opportunity at a time.
+
+A webhook request carries X-Webhook-Timestamp, the unix time it was sent,
+and X-Webhook-Signature, the hex HMAC-SHA256 of "<timestamp>.<body>" keyed
+with settings.CURRENT_RMS_WEBHOOK_SECRET. Requests older than
+settings.WEBHOOK_SIGNATURE_TOLERANCE_SECONDS are refused so a captured
+request cannot be replayed later.
+
+Events for the same opportunity are debounced: the first schedules a
+resync settings.WEBHOOK_DEBOUNCE_SECONDS later and the rest are dropped
+until that resync starts, since it reads the opportunity's latest state
+from the API anyway.
+"""
+import hashlib
+import hmac
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+SIGNATURE_HEADER = "X-Webhook-Signature"
+TIMESTAMP_HEADER = "X-Webhook-Timestamp"
+
+OPPORTUNITY_ACTIONS = ("create", "update", "delete")
+# How long a scheduled resync holds off further events for its opportunity
+# if it never starts, after which the next event schedules another; the
+# hourly sync catches anything dropped in between
+RESYNC_PENDING_TIMEOUT = 900
+
+
+def sign_payload(body, timestamp, secret):
+    """The signature of a webhook body sent at the given unix timestamp"""
+    message = f"{timestamp}.".encode() + body
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body, timestamp, signature, secret, tolerance=None):
+    """
+    Check a webhook's signature and that it was sent recently enough.
+
+    Parameters:
+    - body: The raw request body
+    - timestamp: The X-Webhook-Timestamp header
+    - signature: The X-Webhook-Signature header
+    - secret: The shared webhook secret
+    - tolerance: Seconds a request stays valid, defaults to
+    settings.WEBHOOK_SIGNATURE_TOLERANCE_SECONDS
+    """
+    if not (timestamp and signature and secret):
+        return False
+    if tolerance is None:
+        tolerance = settings.WEBHOOK_SIGNATURE_TOLERANCE_SECONDS
+
+    try:
+        sent_at = int(timestamp)
+    except ValueError:
+        return False
+    if abs(time.time() - sent_at) > tolerance:
+        return False
+
+    return hmac.compare_digest(sign_payload(body, timestamp, secret), signature)
+
+
+def build_event(current_id, action="update"):
+    """A Current RMS style webhook payload for an opportunity event"""
+    return {
+        "webhook": {"event": f"opportunity_{action}"},
+        "action": {
+            "subject_id": current_id,
+            "subject_type": "Opportunity",
+            "action_type": action,
+        },
+    }
+
+
+def parse_opportunity_event(payload):
+    """
+    Get the opportunity id and action from a webhook payload, or None if it
+    is not an opportunity create, update or delete event
+    """
+    action = payload.get("action") if isinstance(payload, dict) else None
+    if not isinstance(action, dict):
+        return None
+    if action.get("subject_type") != "Opportunity":
+        return None
+    if action.get("action_type") not in OPPORTUNITY_ACTIONS:
+        return None
+
+    try:
+        return int(action["subject_id"]), action["action_type"]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def resync_pending_key(current_id):
+    return f"workload:webhook:resync:{current_id}"
+
+
+def claim_resync(current_id):
+    """
+    Mark a resync of the opportunity as scheduled, returning False if one
+    already is, so the event can be dropped
+    """
+    return cache.add(resync_pending_key(current_id), True, timeout=RESYNC_PENDING_TIMEOUT)
+
+
+def clear_resync(current_id):
+    """Let the next event for the opportunity schedule a new resync"""
+    cache.delete(resync_pending_key(current_id))